@@ -0,0 +1,38 @@
+"""Compare message decoding in ``uri_from_message`` with the rdflib path.
+
+Run from the project root with ``python -m benchmarks.decode``. Each
+recorded message body in ``tests/fixtures/messages`` is decoded with both
+implementations and the mean time per message is reported.
+"""
+import glob
+import os.path
+import timeit
+
+from pit.index import _uri_from_graph, uri_from_message
+
+
+FIXTURES = 'tests/fixtures/messages'
+
+
+def bench(func, data, number):
+    return timeit.timeit(lambda: func(data), number=number) / number
+
+
+def main(number=1000):
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*.json'))):
+        with open(path) as fp:
+            data = fp.read()
+        name = os.path.basename(path)
+        fast = bench(uri_from_message, data, number)
+        try:
+            slow = bench(_uri_from_graph, data, max(1, number // 10))
+        except Exception as e:
+            print('{:<24} fast {:>9.1f}us  rdflib failed: {}'
+                  .format(name, fast * 1e6, e))
+            continue
+        print('{:<24} fast {:>9.1f}us  rdflib {:>9.1f}us  {:>6.1f}x'
+              .format(name, fast * 1e6, slow * 1e6, slow / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+"""Measure end-to-end indexing throughput against local stand-ins.
+
+Run from the project root with ``python -m benchmarks.e2e``. Three
+stand-ins are started in this process:
+
+* a Fedora server built with :mod:`aiohttp.web`, serving a collection of
+  synthetic theses generated from the ``tests/fixtures/thesis_*.n3``
+  templates, with a configurable response latency,
+* an Elasticsearch stub answering the index and ``_bulk`` APIs, and
+* a minimal STOMP broker that sends one Fedora modification message per
+  thesis and honours client acknowledgements and prefetch.
+
+The ``reindex`` scenario runs :func:`pit.index.index_collection` over the
+collection. The ``worker`` scenario connects the ``pit run`` worker to
+the broker. A thesis' latency is the time from Fedora being asked for it
+(``reindex``) or the broker sending its message (``worker``) until the
+Elasticsearch stub receives its document. Documents per second, p50 and
+p99 latency and the peak RSS of the process are printed and saved as
+JSON, along with the configuration and the current commit, so runs can
+be compared between commits.
+"""
+import asyncio
+import glob
+import json
+import os
+import platform
+import re
+import resource
+import subprocess
+import time
+
+from aioes import Elasticsearch
+from aiohttp import web
+import click
+import rdflib
+
+from pit.es import BulkIndex, Index
+from pit.fedora import Client
+from pit.index import Indexer, index_collection
+from pit.parse import ParsePool
+from pit.stomp import FrameParser, Protocol
+from pit.worker import work
+
+
+FIXTURES = 'tests/fixtures'
+TEMPLATE_URI = re.compile(r'mock://example\.com/theses/\d+')
+RESOURCE_TYPE = 'http://pcdm.org/models#Object'
+EVENT_TYPE = 'http://fedora.info/definitions/v4/event#ResourceModification'
+
+
+class Recorder:
+    """Record when each thesis started and when its document arrived."""
+    def __init__(self, count, loop):
+        self.count = count
+        self.started = {}
+        self.finished = {}
+        self.done = asyncio.Event(loop=loop)
+
+    def start(self, uri):
+        self.started.setdefault(uri, time.perf_counter())
+
+    def finish(self, uri):
+        if uri not in self.finished:
+            self.finished[uri] = time.perf_counter()
+            if len(self.finished) >= self.count:
+                self.done.set()
+
+    def latencies(self):
+        return sorted(self.finished[uri] - self.started[uri]
+                      for uri in self.finished if uri in self.started)
+
+
+class Fedora:
+    def __init__(self, count, latency, text_size, recorder):
+        self.count, self.latency = count, latency
+        self.recorder = recorder
+        self.text = ('lorem ipsum ' * (text_size // 12 + 1))[:text_size]
+        self.templates = []
+        for path in sorted(glob.glob(os.path.join(FIXTURES,
+                                                  'thesis_*.n3'))):
+            with open(path) as fp:
+                n3 = TEMPLATE_URI.sub('{uri}', fp.read())
+            nt = rdflib.Graph().parse(data=n3.replace('{uri}', 'urn:x'),
+                                      format='n3').serialize(format='nt')
+            nt = nt.decode('utf-8').replace('urn:x', '{uri}')
+            self.templates.append((n3, nt))
+
+    def app(self, loop):
+        app = web.Application(loop=loop)
+        app.router.add_get('/theses', self.collection)
+        app.router.add_get('/theses/{id}', self.thesis)
+        app.router.add_get('/theses/{id}/{file}', self.file)
+        return app
+
+    def uri(self, request, i):
+        return 'http://{}/theses/{}'.format(request.host, i)
+
+    async def collection(self, request):
+        await asyncio.sleep(self.latency)
+        members = ',\n'.join('<{}>'.format(self.uri(request, i))
+                             for i in range(self.count))
+        body = ('@prefix ldp: <http://www.w3.org/ns/ldp#> .\n'
+                '<{}> a ldp:Container; ldp:contains {} .\n'
+                .format(self.uri(request, '')[:-1], members))
+        return web.Response(text=body, content_type='text/n3')
+
+    async def thesis(self, request):
+        uri = self.uri(request, request.match_info['id'])
+        self.recorder.start(uri)
+        await asyncio.sleep(self.latency)
+        n3, nt = self.templates[int(request.match_info['id']) %
+                                len(self.templates)]
+        if 'application/n-triples' in request.headers.get('Accept', ''):
+            return web.Response(text=nt.replace('{uri}', uri),
+                                content_type='application/n-triples')
+        return web.Response(text=n3.replace('{uri}', uri),
+                            content_type='text/n3')
+
+    async def file(self, request):
+        await asyncio.sleep(self.latency)
+        return web.Response(text=self.text, content_type='text/plain')
+
+
+class Elasticsearch_:
+    def __init__(self, latency, recorder):
+        self.latency = latency
+        self.recorder = recorder
+        self.documents = 0
+        self.requests = 0
+
+    def app(self, loop):
+        # Bulk requests of large full text documents exceed the default
+        # 1 MiB limit on request bodies.
+        app = web.Application(loop=loop, client_max_size=1073741824)
+        app.router.add_route('HEAD', '/', self.ping)
+        app.router.add_post('/_bulk', self.bulk)
+        app.router.add_route('*', '/{index}/{type}/{id}', self.index)
+        return app
+
+    async def ping(self, request):
+        return web.Response()
+
+    async def index(self, request):
+        self.requests += 1
+        document = await request.json()
+        await asyncio.sleep(self.latency)
+        self.documents += 1
+        self.recorder.finish(document['uri'])
+        return web.json_response({'_id': request.match_info['id'],
+                                  'result': 'created', 'created': True})
+
+    async def bulk(self, request):
+        self.requests += 1
+        lines = (await request.text()).splitlines()
+        await asyncio.sleep(self.latency)
+        items = []
+        for document in lines[1::2]:
+            self.documents += 1
+            self.recorder.finish(json.loads(document)['uri'])
+            items.append({'index': {'status': 201}})
+        return web.json_response({'took': 1, 'errors': False,
+                                  'items': items})
+
+
+class Broker:
+    """Send one modification message per URI to the first subscriber."""
+    def __init__(self, uris, recorder, loop):
+        self.uris = uris
+        self.recorder = recorder
+        self.loop = loop
+        self.acked = 0
+        self.nacked = 0
+        self.settled = asyncio.Event(loop=loop)
+
+    async def handle(self, reader, writer):
+        parser = FrameParser()
+        sender = None
+        unacked = None
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            parser.add(data)
+            while parser.canRead():
+                frame = parser.get()
+                command = getattr(frame, 'command', None)
+                if command in ('CONNECT', 'STOMP'):
+                    writer.write(b'CONNECTED\nversion:1.2\n'
+                                 b'heart-beat:0,0\n\n\x00')
+                elif command == 'SUBSCRIBE':
+                    prefetch = int(frame.headers.get(
+                        'activemq.prefetchSize', 1000))
+                    auto = frame.headers.get('ack', 'auto') == 'auto'
+                    unacked = None if auto else \
+                        asyncio.Semaphore(prefetch, loop=self.loop)
+                    sender = asyncio.ensure_future(
+                        self.send(writer, frame.headers['id'], unacked),
+                        loop=self.loop)
+                elif command in ('ACK', 'NACK'):
+                    if command == 'ACK':
+                        self.acked += 1
+                    else:
+                        self.nacked += 1
+                    unacked.release()
+                    if self.acked + self.nacked >= len(self.uris):
+                        self.settled.set()
+                elif command == 'DISCONNECT':
+                    writer.close()
+                    break
+        if sender is not None:
+            sender.cancel()
+
+    async def send(self, writer, subscription, unacked):
+        for i, uri in enumerate(self.uris):
+            if unacked is not None:
+                await unacked.acquire()
+            body = json.dumps({'@id': uri, '@type': RESOURCE_TYPE})
+            headers = {
+                'destination': '/queue/fedora', 'subscription': subscription,
+                'message-id': str(i), 'ack': str(i),
+                'org.fcrepo.jms.resourceType': RESOURCE_TYPE,
+                'org.fcrepo.jms.eventType': EVENT_TYPE,
+                'content-length': str(len(body)),
+            }
+            head = ''.join('{}:{}\n'.format(k, v) for k, v in headers.items())
+            self.recorder.start(uri)
+            writer.write('MESSAGE\n{}\n{}\x00'.format(head, body)
+                         .encode('utf-8'))
+            await writer.drain()
+
+
+async def start(app, loop):
+    server = await loop.create_server(app.make_handler(), '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def reindex(config, loop):
+    recorder = Recorder(config['theses'], loop)
+    fedora = Fedora(config['theses'], config['fedora_latency'],
+                    config['text_size'], recorder)
+    es = Elasticsearch_(config['es_latency'], recorder)
+    fedora_server, fedora_port = await start(fedora.app(loop), loop)
+    es_server, es_port = await start(es.app(loop), loop)
+    os.environ['NGINX_PROXY_SERVICE_PORT'] = str(fedora_port)
+    conn = Elasticsearch(['127.0.0.1:{}'.format(es_port)], loop=loop)
+    client = Client(limit_per_host=config['repo_connections'], loop=loop)
+    pool = ParsePool(config['parse_workers'], loop)
+    start_time = time.perf_counter()
+    try:
+        await index_collection(
+            'http://127.0.0.1:{}/theses'.format(fedora_port),
+            Index(conn, 'bench'), client, bulk_size=config['bulk_size'],
+            stream=False, pool=pool)
+        elapsed = time.perf_counter() - start_time
+    finally:
+        await client.close()
+        pool.close()
+        conn.close()
+        fedora_server.close()
+        es_server.close()
+    return summary(recorder, elapsed, es)
+
+
+async def worker(config, loop):
+    recorder = Recorder(config['theses'], loop)
+    fedora = Fedora(config['theses'], config['fedora_latency'],
+                    config['text_size'], recorder)
+    es = Elasticsearch_(config['es_latency'], recorder)
+    fedora_server, fedora_port = await start(fedora.app(loop), loop)
+    es_server, es_port = await start(es.app(loop), loop)
+    os.environ['NGINX_PROXY_SERVICE_PORT'] = str(fedora_port)
+    uris = ['http://127.0.0.1:{}/theses/{}'.format(fedora_port, i)
+            for i in range(config['theses'])]
+    broker = Broker(uris, recorder, loop)
+    broker_server = await asyncio.start_server(broker.handle, '127.0.0.1', 0,
+                                               loop=loop)
+    broker_port = broker_server.sockets[0].getsockname()[1]
+    conn = Elasticsearch(['127.0.0.1:{}'.format(es_port)], loop=loop)
+    client = Client(limit_per_host=config['repo_connections'], loop=loop)
+    pool = ParsePool(config['parse_workers'], loop)
+    idx = Index(conn, 'bench')
+    if config['bulk_size']:
+        idx = BulkIndex(idx, size=config['bulk_size'], loop=loop)
+    stomp = Protocol('127.0.0.1', broker_port, loop)
+    await stomp.connect()
+    idxer = Indexer(idx, loop, client, pool=pool)
+    start_time = time.perf_counter()
+    task = asyncio.ensure_future(
+        work(stomp, idxer.on_message, loop, ack='client-individual',
+             prefetch=config['prefetch'],
+             max_in_flight=config['max_in_flight']), loop=loop)
+    try:
+        await asyncio.wait_for(recorder.done.wait(), config['timeout'],
+                               loop=loop)
+        elapsed = time.perf_counter() - start_time
+        # Let the last acknowledgements reach the broker before stopping.
+        await asyncio.wait_for(broker.settled.wait(), 10, loop=loop)
+    finally:
+        task.cancel()
+        await task
+        if config['bulk_size']:
+            await idx.close()
+        await client.close()
+        pool.close()
+        conn.close()
+        for server in (fedora_server, es_server, broker_server):
+            server.close()
+    result = summary(recorder, elapsed, es)
+    result.update(acked=broker.acked, nacked=broker.nacked)
+    return result
+
+
+def summary(recorder, elapsed, es):
+    latencies = recorder.latencies()
+
+    def percentile(q):
+        if not latencies:
+            return None
+        return latencies[int(q * (len(latencies) - 1))]
+
+    return {
+        'documents': len(recorder.finished),
+        'elapsed_seconds': elapsed,
+        'docs_per_second': len(recorder.finished) / elapsed,
+        'latency_p50_seconds': percentile(0.5),
+        'latency_p99_seconds': percentile(0.99),
+        'es_requests': es.requests,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if platform.system() == 'Darwin' else rss * 1024
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+SCENARIOS = {'reindex': reindex, 'worker': worker}
+
+
+@click.command()
+@click.option('--scenario', 'scenarios', multiple=True,
+              type=click.Choice(sorted(SCENARIOS)))
+@click.option('--theses', default=1000)
+@click.option('--fedora-latency', default=0.005)
+@click.option('--es-latency', default=0.001)
+@click.option('--text-size', default=65536)
+@click.option('--bulk-size', default=0)
+@click.option('--parse-workers', default=0)
+@click.option('--repo-connections', default=10)
+@click.option('--prefetch', default=20)
+@click.option('--max-in-flight', default=20)
+@click.option('--timeout', default=600.0,
+              help='Seconds to wait for the worker to index every thesis.')
+@click.option('--output', default='benchmark-results.json',
+              type=click.Path(dir_okay=False))
+def main(scenarios, output, **config):
+    """Run the end-to-end benchmarks and save the results to OUTPUT."""
+    os.environ['NGINX_PROXY_SERVICE_HOST'] = '127.0.0.1'
+    loop = asyncio.get_event_loop()
+    results = {}
+    for name in scenarios or sorted(SCENARIOS):
+        result = loop.run_until_complete(SCENARIOS[name](config, loop))
+        results[name] = result
+        click.echo('{:<8} {:>8.1f} docs/s  p50 {:>7.1f}ms  p99 {:>7.1f}ms  '
+                   'peak RSS {:>6.1f} MiB'.format(
+                       name, result['docs_per_second'],
+                       (result['latency_p50_seconds'] or 0) * 1000,
+                       (result['latency_p99_seconds'] or 0) * 1000,
+                       result['peak_rss_bytes'] / 1048576))
+    with open(output, 'w') as fp:
+        json.dump({'commit': commit(), 'timestamp': time.time(),
+                   'python': platform.python_version(), 'config': config,
+                   'results': results}, fp, indent=2, sort_keys=True)
+    click.echo('Results saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Compare building a package on the event loop with the current ``Zip``.
+
+Run from the project root with ``python -m benchmarks.package``. A
+package is built from copies of the PDF fixtures in ``tests/fixtures``
+and a text file per thesis. The old way deflated every member on the
+event loop. The current ``Zip`` stores the PDFs and deflates the text
+in a thread. The build time and the longest the event loop went without
+running a callback are reported for both. Before Python 3.6 both collect
+each member in a temporary file and add it from there, as the archive
+does without streaming.
+
+The fixtures are only a few KiB. A second, synthetic run pads them with
+random bytes to the size of a real thesis. Random bytes are the worst
+case for deflate, so it overstates the savings on real PDFs, whose
+compressed streams sit among some compressible structure.
+"""
+import asyncio
+import glob
+import os
+import os.path
+import tempfile
+import time
+
+from pit.archive import STREAMING, Zip
+from pit.packager import CHUNK_SIZE
+
+
+FIXTURES = 'tests/fixtures'
+
+
+class LegacyZip(Zip):
+    """Deflate every member on the event loop."""
+    async def write_stream(self, chunks, membername):
+        if not STREAMING:
+            with tempfile.NamedTemporaryFile() as fp:
+                async for chunk in chunks:
+                    fp.write(chunk)
+                fp.flush()
+                self.archive.write(fp.name, membername)
+            return
+        with self.archive.open(membername, 'w', force_zip64=True) as member:
+            async for chunk in chunks:
+                member.write(chunk)
+
+
+class Chunks:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.pos >= len(self.data):
+            raise StopAsyncIteration
+        chunk = self.data[self.pos:self.pos + CHUNK_SIZE]
+        self.pos += len(chunk)
+        # A chunk arriving from the network.
+        await asyncio.sleep(0)
+        return chunk
+
+
+def members(count, size=0):
+    pdfs = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*.pdf'))):
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        pdfs.append(data + os.urandom(max(size - len(data), 0)))
+    text = b'lorem ipsum dolor sit amet ' * (max(size, 65536) // 270)
+    for i in range(count):
+        yield '{}.pdf'.format(i), pdfs[i % len(pdfs)]
+        yield '{}.txt'.format(i), text
+
+
+async def watch(loop, stop):
+    """Return the longest gap between two runs of this coroutine."""
+    longest = 0
+    last = loop.time()
+    while not stop.is_set():
+        await asyncio.sleep(0.001, loop=loop)
+        now = loop.time()
+        longest = max(longest, now - last)
+        last = now
+    return longest
+
+
+async def build(cls, data, loop):
+    stop = asyncio.Event(loop=loop)
+    watcher = asyncio.ensure_future(watch(loop, stop), loop=loop)
+    with tempfile.TemporaryFile() as fp:
+        arx = cls(fp, loop=loop)
+        start = time.perf_counter()
+        for name, body in data:
+            await arx.write_stream(Chunks(body), name)
+        arx.close()
+        elapsed = time.perf_counter() - start
+        size = fp.tell()
+    stop.set()
+    return elapsed, await watcher, size
+
+
+def main(count=50, padded_size=4194304):
+    if not STREAMING:
+        print('ZipFile.open() cannot write on this Python, so members are '
+              'collected in temporary files first')
+    loop = asyncio.get_event_loop()
+    for label, size in (('fixtures', 0),
+                        ('synthetic, PDFs padded with random bytes',
+                         padded_size)):
+        data = list(members(count, size))
+        total = sum(len(body) for name, body in data)
+        print('{}: {} members, {:.1f} MiB'.format(label, len(data),
+                                                  total / 1048576))
+        for name, cls in (('legacy', LegacyZip), ('current', Zip)):
+            elapsed, stall, archive_size = loop.run_until_complete(
+                build(cls, data, loop))
+            print('  {:<8} {:>6.2f}s  longest loop stall {:>6.1f}ms  '
+                  'archive {:.1f} MiB'.format(name, elapsed, stall * 1000,
+                                              archive_size / 1048576))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""Compare thesis metadata parsing with rdflib and ``pit.ntriples``.
+
+Run from the project root with ``python -m benchmarks.parse``. Each thesis
+fixture is parsed from N3 and N-Triples with rdflib and from N-Triples
+with the lightweight parser, keeping only the predicates the indexer
+uses, and the mean time per document is reported.
+"""
+import glob
+import os.path
+import timeit
+
+import rdflib
+
+from pit import ntriples
+from pit.index import THESIS_PREDICATES
+
+
+FIXTURES = 'tests/fixtures'
+
+
+def bench(func, number):
+    return timeit.timeit(func, number=number) / number
+
+
+def main(number=500):
+    for path in sorted(glob.glob(os.path.join(FIXTURES, 'thesis_*.n3'))):
+        with open(path) as fp:
+            n3 = fp.read()
+        nt = rdflib.Graph().parse(data=n3, format='n3').serialize(format='nt')
+        results = [
+            ('rdflib n3', bench(
+                lambda: rdflib.Graph().parse(data=n3, format='n3'), number)),
+            ('rdflib nt', bench(
+                lambda: rdflib.Graph().parse(data=nt.decode('utf-8'),
+                                             format='nt'), number)),
+            ('ntriples', bench(
+                lambda: ntriples.parse(nt, THESIS_PREDICATES), number)),
+        ]
+        baseline = results[0][1]
+        print(os.path.basename(path))
+        for name, t in results:
+            print('  {:<10} {:>9.1f}us  {:>6.1f}x'
+                  .format(name, t * 1e6, baseline / t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Compare STOMP frame throughput of ``AsyncTransport`` with the old one.
+
+Run from the project root with ``python -m benchmarks.stomp``. The
+recorded message bodies in ``tests/fixtures/messages`` are wrapped in
+MESSAGE frames with the headers Fedora sends, interleaved with
+heartbeats, and read back through each transport from an in-memory
+stream. A burst of ACKs is then sent through each transport to a writer
+that counts writes. Frames per second are reported for both.
+"""
+import asyncio
+from collections import deque
+import glob
+import os.path
+import time
+
+from stompest.protocol import StompFrame, StompParser, StompSpec
+
+from pit.stomp import AsyncTransport, BrokenSocketError
+
+
+FIXTURES = 'tests/fixtures/messages'
+
+HEADERS = {
+    'destination': '/queue/fedora',
+    'subscription': '1',
+    'ack': '1',
+    'org.fcrepo.jms.resourceType': 'http://pcdm.org/models#Object',
+    'org.fcrepo.jms.eventType': 'http://fedora.info/definitions/v4/event'
+                                '#ResourceModification',
+    'org.fcrepo.jms.identifier': '/theses/1',
+}
+
+
+class LegacyTransport(AsyncTransport):
+    """The transport as it was: 1 KiB reads into stompest's parser and a
+    write and drain for every frame."""
+    def __init__(self, host, port, loop):
+        super().__init__(host, port, loop)
+        self._parser = StompParser(StompSpec.VERSION_1_2)
+
+    async def send(self, frame):
+        self._writer.write(bytes(frame))
+        await self._writer.drain()
+
+    async def _read_frames(self):
+        while not self._parser.canRead():
+            data = await self._reader.read(1024)
+            if not data:
+                raise BrokenSocketError()
+            self._parser.add(data)
+        while self._parser.canRead():
+            self._frames.append(self._parser.get())
+
+
+class CountingWriter:
+    def __init__(self):
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+    async def drain(self):
+        pass
+
+
+def recorded_stream(count):
+    bodies = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, '*.json'))):
+        with open(path, 'rb') as fp:
+            bodies.append(fp.read())
+    # Fedora messages for large objects can carry much bigger bodies.
+    bodies.append(bodies[0] * 20)
+    frames = deque()
+    for i in range(count):
+        headers = dict(HEADERS, **{'message-id': 'ID:{}'.format(i)})
+        body = bodies[i % len(bodies)]
+        frame = StompFrame('MESSAGE', headers, body,
+                           version=StompSpec.VERSION_1_2)
+        frames.append(bytes(frame))
+        if i % 10 == 0:
+            frames.append(b'\n')
+    return b''.join(frames)
+
+
+async def receive(transport, data, count, loop):
+    reader = asyncio.StreamReader(limit=len(data) + 1, loop=loop)
+    reader.feed_data(data)
+    reader.feed_eof()
+    transport._reader = reader
+    received = 0
+    start = time.perf_counter()
+    while received < count:
+        frame = await transport.receive()
+        if frame:
+            received += 1
+    return count / (time.perf_counter() - start)
+
+
+async def send(transport, count, loop):
+    transport._writer = writer = CountingWriter()
+    acks = [StompFrame('ACK', {'id': str(i)}, version=StompSpec.VERSION_1_2)
+            for i in range(count)]
+    start = time.perf_counter()
+    await asyncio.gather(*[transport.send(f) for f in acks], loop=loop)
+    return count / (time.perf_counter() - start), writer.writes
+
+
+def main(count=10000):
+    loop = asyncio.get_event_loop()
+    data = recorded_stream(count)
+    print('{} frames, {:.1f} MiB'.format(count, len(data) / 1048576))
+    for name, cls in (('legacy', LegacyTransport), ('async', AsyncTransport)):
+        rate = loop.run_until_complete(
+            receive(cls('localhost', 61613, loop), data, count, loop))
+        ack_rate, writes = loop.run_until_complete(
+            send(cls('localhost', 61613, loop), count, loop))
+        print('  {:<8} receive {:>9.0f} frames/s  ack {:>9.0f} frames/s '
+              '({} writes)'.format(name, rate, ack_rate, writes))
+
+
+if __name__ == '__main__':
+    main()
@@ -29,3 +29,13 @@ def rewrite_host(url):
         new_host = host
     parts[1] = new_host
     return urlunsplit(parts)
+
+
+def consume_exception(fut):
+    """Mark a future's exception as retrieved.
+
+    Used as a done callback on futures whose failures are already logged
+    elsewhere, so asyncio doesn't warn when nobody awaits them.
+    """
+    if not fut.cancelled():
+        fut.exception()
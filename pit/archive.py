@@ -1,12 +1,45 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import partial
+import mimetypes
 import os
+import sys
+import tempfile
+import time
 import zipfile
 
 
+# ZipFile.open() can only write members from Python 3.6.
+STREAMING = sys.version_info >= (3, 6)
+
+# Formats that are already compressed and gain nothing from deflating.
+COMPRESSED_TYPES = {
+    'application/gzip', 'application/pdf', 'application/zip',
+    'application/x-bzip2', 'application/x-xz', 'image/gif', 'image/jpeg',
+    'image/png',
+}
+COMPRESSED_PREFIXES = ('audio/', 'video/')
+
+
+def compression_for(membername, default=zipfile.ZIP_DEFLATED):
+    """Return the compression to use for ``membername``.
+
+    Members whose type, guessed from the name, is already compressed are
+    stored. Everything else gets ``default``.
+    """
+    mimetype, encoding = mimetypes.guess_type(membername)
+    mimetype = mimetype or ''
+    if (encoding is not None or mimetype in COMPRESSED_TYPES or
+            mimetype.startswith(COMPRESSED_PREFIXES)):
+        return zipfile.ZIP_STORED
+    return default
+
+
 @contextmanager
-def archive(filename):
+def archive(filename, **kwargs):
     try:
-        arx = Zip(filename)
+        arx = Zip(filename, **kwargs)
         yield arx
     except:
         if os.path.isfile(filename):
@@ -17,12 +50,64 @@ def archive(filename):
 
 
 class Zip:
-    def __init__(self, filename, compression=zipfile.ZIP_DEFLATED):
+    """A zip archive that only compresses members worth compressing.
+
+    ``compression`` is used for members that aren't already compressed.
+    :meth:`write_stream` compresses in a thread of the archive's own, so
+    deflating a large member doesn't block the event loop. Having a
+    single thread keeps every operation on the archive in order, even
+    when a write is cancelled while it is running.
+    """
+    def __init__(self, filename, compression=zipfile.ZIP_DEFLATED,
+                 loop=None):
         self.archive = zipfile.ZipFile(filename, mode='w',
                                        compression=compression)
+        self.compression = compression
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(1)
 
     def write(self, filename, membername=None):
-        self.archive.write(filename, membername)
+        membername = membername or os.path.basename(filename)
+        self.archive.write(filename, membername,
+                           compression_for(membername, self.compression))
+
+    async def write_file(self, filename, membername=None):
+        """Add the file ``filename`` without blocking the event loop."""
+        await self._run(self.write, filename, membername)
+
+    async def write_stream(self, chunks, membername):
+        """Add a member read from the async iterable ``chunks``.
+
+        The chunks are compressed into the archive as they arrive. Where
+        :meth:`zipfile.ZipFile.open` can't write, they are collected in a
+        temporary file first.
+        """
+        if not STREAMING:
+            with tempfile.NamedTemporaryFile() as fp:
+                async for chunk in chunks:
+                    fp.write(chunk)
+                fp.flush()
+                await self.write_file(fp.name, membername)
+            return
+        info = zipfile.ZipInfo(membername, time.localtime()[:6])
+        info.compress_type = compression_for(membername, self.compression)
+        # What ZipFile.open() sets when given a name.
+        info.external_attr = 0o600 << 16
+        # The size isn't known up front, so allow for members over 2 GiB.
+        member = await self._run(partial(self.archive.open, info, 'w',
+                                         force_zip64=True))
+        try:
+            async for chunk in chunks:
+                await self._run(member.write, chunk)
+        finally:
+            # Queued behind any write still running, even if cancelled.
+            close = self._run(member.close)
+            await asyncio.shield(close, loop=self.loop)
 
     def close(self):
-        self.archive.close()
+        """Close the archive once everything queued has been written."""
+        self.executor.submit(self.archive.close).result()
+        self.executor.shutdown()
+
+    def _run(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
@@ -0,0 +1,234 @@
+"""Persistent cache of Fedora responses validated with conditional requests.
+
+Responses carrying an ETag or Last-Modified header are stored in a SQLite
+database. The next request for the same resource sends If-None-Match and
+If-Modified-Since, and if Fedora answers 304 Not Modified the body is
+served from disk instead of being downloaded again. The least recently
+used entries are evicted once the cache grows past its size limit.
+
+Only RDF is cached: it is always read into memory to be parsed anyway,
+whereas other bodies, such as full text, are streamed. The database is
+only touched from :attr:`Cache.executor`, so :class:`pit.fedora.Client`
+keeps disk I/O off the event loop.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import time
+
+from pit.pcdm import RDF_TYPES
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    headers TEXT,
+    body BLOB,
+    size INTEGER,
+    accessed REAL
+)
+"""
+
+
+class Cache:
+    """A size limited, least recently used store of response bodies.
+
+    ``max_size`` limits the total size of stored bodies and bodies larger
+    than ``max_entry_size`` aren't stored.
+    """
+    def __init__(self, directory, max_size=1073741824,
+                 max_entry_size=16777216):
+        os.makedirs(directory, exist_ok=True)
+        self.max_size, self.max_entry_size = max_size, max_entry_size
+        self.executor = ThreadPoolExecutor(1)
+        self.db = sqlite3.connect(os.path.join(directory, 'cache.db'),
+                                  check_same_thread=False)
+        self.db.execute(SCHEMA)
+        self.db.execute('CREATE INDEX IF NOT EXISTS accessed_idx '
+                        'ON entries (accessed)')
+        self.size = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        # Access times are only written with the next change to the cache,
+        # so serving a hit doesn't commit a transaction.
+        self._accessed = {}
+
+    @staticmethod
+    def key(url, headers):
+        # Fedora varies the representation on these headers.
+        return '\n'.join([url, headers.get('Accept', ''),
+                          headers.get('Prefer', '')])
+
+    def get(self, key):
+        row = self.db.execute(
+            'SELECT etag, last_modified, headers, body FROM entries '
+            'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, headers, body = row
+        return Entry(key, etag, last_modified, json.loads(headers), body)
+
+    def cacheable(self, resp):
+        """Return whether ``resp`` is RDF that can be revalidated.
+
+        Its size isn't checked, since Content-Length is the compressed
+        length of a gzipped body. :meth:`put` checks the size instead.
+        """
+        content_type = resp.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip() not in RDF_TYPES:
+            return False
+        return 'ETag' in resp.headers or 'Last-Modified' in resp.headers
+
+    def put(self, key, headers, body):
+        """Store ``body`` and return its entry.
+
+        A body larger than ``max_entry_size`` isn't stored, but an entry
+        is still returned for it.
+        """
+        names = ('Content-Type', 'ETag', 'Last-Modified')
+        headers = {name: headers[name] for name in names if name in headers}
+        entry = Entry(key, headers.get('ETag'), headers.get('Last-Modified'),
+                      headers, body)
+        if len(body) > self.max_entry_size:
+            return entry
+        self._write_accessed()
+        old = self.db.execute('SELECT size FROM entries WHERE key = ?',
+                              (key,)).fetchone()
+        if old:
+            self.size -= old[0]
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, entry.etag, entry.last_modified, json.dumps(headers),
+                 body, len(body), time.time()))
+        self.size += len(body)
+        self.evict()
+        return entry
+
+    def hit(self, entry):
+        self.hits += 1
+        self.bytes_saved += len(entry.body)
+        self._accessed[entry.key] = time.time()
+
+    def miss(self):
+        self.misses += 1
+
+    def evict(self):
+        self._write_accessed()
+        while self.size > self.max_size:
+            row = self.db.execute(
+                'SELECT key, size FROM entries ORDER BY accessed '
+                'LIMIT 1').fetchone()
+            if row is None:
+                break
+            with self.db:
+                self.db.execute('DELETE FROM entries WHERE key = ?',
+                                (row[0],))
+            self.size -= row[1]
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'bytes_saved': self.bytes_saved, 'size': self.size}
+
+    def close(self):
+        logger = logging.getLogger(__name__)
+        logger.info('Cache: {hits} hits, {misses} misses, {bytes_saved} '
+                    'bytes saved'.format(**self.stats))
+        self.executor.submit(self._close).result()
+        self.executor.shutdown()
+
+    def _close(self):
+        self._write_accessed()
+        self.db.close()
+
+    def _write_accessed(self):
+        if not self._accessed:
+            return
+        accessed, self._accessed = self._accessed, {}
+        with self.db:
+            self.db.executemany(
+                'UPDATE entries SET accessed = ? WHERE key = ?',
+                [(t, key) for key, t in accessed.items()])
+
+
+class Entry:
+    def __init__(self, key, etag, last_modified, headers, body):
+        self.key, self.etag, self.last_modified = key, etag, last_modified
+        self.headers, self.body = headers, body
+
+    @property
+    def validators(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def response(self, url):
+        return CachedResponse(url, self.headers, self.body)
+
+
+class CachedResponse:
+    """Stand-in for an aiohttp response whose body is already in memory."""
+    status = 200
+
+    def __init__(self, url, headers, body):
+        self.url, self.headers = url, headers
+        self.content = _Body(body)
+        self._body = body
+
+    async def read(self):
+        return self._body
+
+    async def text(self, encoding='utf-8'):
+        return self._body.decode(encoding)
+
+    async def json(self):
+        return json.loads(self._body.decode('utf-8'))
+
+    def raise_for_status(self):
+        pass
+
+    async def release(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Body:
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    async def read(self, n=-1):
+        end = len(self._data) if n < 0 else self._pos + n
+        chunk = self._data[self._pos:end]
+        self._pos += len(chunk)
+        return chunk
+
+    def iter_chunked(self, n):
+        return _Chunks(self, n)
+
+
+class _Chunks:
+    def __init__(self, body, n):
+        self.body, self.n = body, n
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.body.read(self.n)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
@@ -1,15 +1,25 @@
 import asyncio
+from datetime import datetime, timezone
 import logging
 import logging.config
 import signal
 import sys
+import time
 
 from aioes import Elasticsearch
 import click
 
-from pit.es import Index
-from pit.index import Indexer, index_collection
+from pit import metrics
+from pit.cache import Cache
+from pit.es import BulkIndex, Index
+from pit.fedora import Client
+from pit.index import (ChangeFilter, Indexer, index_collection,
+                       parse_datetime)
 from pit.logging import BASE_CONFIG
+from pit.parse import ParsePool
+from pit.pcdm import TextReader
+from pit.profiling import Profiler
+from pit.spool import Spool
 from pit.stomp import Protocol
 from pit.worker import work, cleanup
 
@@ -26,19 +36,97 @@ def main():
 @click.option('--index-port', default=9200)
 @click.option('--repo-host', default='localhost')
 @click.option('--repo-port', default=80)
+@click.option('--repo-connections', default=10)
+@click.option('--repo-timeout', default=300)
+@click.option('--cache-dir', type=click.Path(file_okay=False))
+@click.option('--cache-size', default=1024)
 @click.option('--queue', default='/queue/fedora')
+@click.option('--bulk-size', default=0)
+@click.option('--quiet-period', default=0.0)
+@click.option('--max-delay', default=30.0)
+@click.option('--max-text-bytes', default=10485760)
+@click.option('--text-overflow', default='truncate',
+              type=click.Choice(['truncate', 'drop']))
+@click.option('--normalize-text', is_flag=True)
+@click.option('--versioned', is_flag=True)
+@click.option('--parse-workers', default=0)
+@click.option('--ack', default='client-individual',
+              type=click.Choice(['client-individual', 'auto']))
+@click.option('--prefetch', default=20)
+@click.option('--max-in-flight', default=20)
+@click.option('--spool', type=click.Path(dir_okay=False))
+@click.option('--replay-interval', default=30.0)
+@click.option('--metrics-host', default='0.0.0.0')
+@click.option('--metrics-port', default=0)
+@click.option('--profile', type=click.Path(dir_okay=False))
+@click.option('--profile-seconds', type=float)
+@click.option('--profile-documents', type=int)
+@click.option('--profile-top', default=25)
+@click.option('--slow-callback', default=0.1)
 def run(broker_host, broker_port, index_host, index_port, repo_host,
-        repo_port, queue):
+        repo_port, repo_connections, repo_timeout, cache_dir, cache_size,
+        queue, bulk_size, quiet_period, max_delay, max_text_bytes,
+        text_overflow, normalize_text, versioned, parse_workers, ack,
+        prefetch, max_in_flight, spool, replay_interval, metrics_host,
+        metrics_port, profile, profile_seconds, profile_documents,
+        profile_top, slow_callback):
     """Start the indexing worker process.
 
     This will start the worker process whose job it is to watch Fedora's
     message queue for new items and add them to the Elasticsearch index.
+    If --bulk-size is greater than 0, documents are buffered and written
+    with the bulk API in batches of up to that size.
+
+    If --quiet-period is greater than 0, modification events for the same
+    thesis are held until no new event has arrived for that many seconds
+    (but no longer than --max-delay seconds) and indexed only once.
+
+    At most --max-text-bytes of each full text file are read. Longer
+    files are truncated, or left out of the document if --text-overflow
+    is drop.
+
+    With --versioned, a thesis's modification time in Fedora is used as
+    the document version, so a stale or repeated event never overwrites
+    a newer copy in the index.
+
+    If --parse-workers is greater than 0, RDF is parsed and documents are
+    built in that many worker processes instead of on the event loop.
+
+    Messages are acknowledged once the thesis they are about has been
+    written to the index, and negatively acknowledged if that failed, so
+    ActiveMQ redelivers them. The broker sends at most --prefetch
+    unacknowledged messages and no more than --max-in-flight are handled
+    at the same time. Use --ack auto to acknowledge messages on receipt.
+    If the connection to ActiveMQ is lost, the worker reconnects and
+    resubscribes on its own.
+
+    With --spool, theses that can't be indexed because Fedora or
+    Elasticsearch is unavailable are recorded in that SQLite file and
+    their messages acknowledged. Every --replay-interval seconds, if
+    Elasticsearch is reachable, the spooled theses are indexed again.
+    Theses that fail for other reasons, such as RDF that can't be
+    parsed, are not spooled. A spooled thesis is dropped after failing
+    10 times while Fedora and Elasticsearch are both up.
+
+    If --metrics-port is set, counters and latency histograms for each
+    stage of indexing are served in the Prometheus text format on
+    /metrics on that port.
+
+    With --profile, the worker is profiled with cProfile and the stats
+    are written to that file, and the functions taking the most
+    cumulative time (--profile-top of them) are logged. Profiling stops
+    after --profile-seconds, after --profile-documents theses have been
+    indexed, on SIGUSR1 or when the worker exits. While profiling, every
+    event loop callback that takes longer than --slow-callback seconds is
+    logged. Only the main process is profiled, so leave --parse-workers
+    at 0 to include RDF parsing.
     """
     logger = logging.getLogger(__name__)
     es_conn = "{}:{}".format(index_host, index_port)
     loop = asyncio.get_event_loop()
+    pool = ParsePool(parse_workers, loop)
     es = Elasticsearch([es_conn], loop=loop)
-    idx = Index(es, 'theses')
+    idx = Index(es, 'theses', versioned=versioned)
     loop.run_until_complete(idx.initialize())
     logger.debug('Connected to Elasticsearch on {}'.format(es_conn))
 
@@ -53,42 +141,206 @@ def run(broker_host, broker_port, index_host, index_port, repo_host,
         logger.error('Exception while connecting to ActiveMQ: {}'.format(e))
         sys.exit(0)
     logger.info('Connected to ActiveMQ')
-    idxer = Indexer(idx, loop)
-    asyncio.ensure_future(work(stomp, idxer.on_message, loop))
+    if bulk_size:
+        idx = BulkIndex(idx, size=bulk_size, loop=loop)
+    cache = Cache(cache_dir, cache_size * 1048576) if cache_dir else None
+    client = Client(limit_per_host=repo_connections,
+                    read_timeout=repo_timeout, cache=cache, loop=loop)
+    reader = TextReader(max_text_bytes, text_overflow, normalize_text)
+    spool = Spool(spool) if spool else None
+    idxer = Indexer(idx, loop, client, quiet=quiet_period,
+                    max_delay=max_delay, text_reader=reader, pool=pool,
+                    spool=spool)
+    asyncio.ensure_future(work(stomp, idxer.on_message, loop, queue, ack,
+                               prefetch, max_in_flight))
+    if spool:
+        asyncio.ensure_future(idxer.replay(replay_interval))
+    server = None
+    if metrics_port:
+        register_gauges(stomp, idxer)
+        server = loop.run_until_complete(
+            metrics.serve(metrics_host, metrics_port, loop))
+        logger.info('Serving metrics on port {}'.format(metrics_port))
+    profiler = None
+    if profile:
+        profiler = Profiler(profile, loop, profile_seconds,
+                            profile_documents, profile_top, slow_callback)
+        profiler.start()
     for signame in ('SIGINT', 'SIGTERM'):
         loop.add_signal_handler(getattr(signal, signame), loop.stop)
     try:
         loop.run_forever()
     finally:
         logger.info('Cleaning up before loop exit')
+        if profiler:
+            profiler.stop()
+        if server:
+            server.close()
+        if idxer.coalescer:
+            c = idxer.coalescer
+            logger.info('Coalesced {} of {} events'
+                        .format(c.absorbed, c.received))
+            loop.run_until_complete(c.flush())
+        if bulk_size:
+            loop.run_until_complete(idx.close())
+        loop.run_until_complete(client.close())
+        pool.close()
         tasks = asyncio.Task.all_tasks()
         cleanup(tasks, loop, timeout=5)
+        if spool:
+            spool.close()
         loop.close()
 
 
+def register_gauges(stomp, idxer):
+    def heartbeat_age():
+        # Nothing has been received before the first connection.
+        if stomp.lastReceived is None:
+            return 0
+        return time.time() - stomp.lastReceived
+
+    metrics.Gauge('pit_heartbeat_age_seconds',
+                  'Seconds since anything was received from ActiveMQ.',
+                  func=heartbeat_age)
+    if idxer.coalescer:
+        metrics.Gauge('pit_coalescer_pending',
+                      'Theses waiting for their quiet period to end.',
+                      func=lambda: idxer.coalescer.pending)
+    if isinstance(idxer.index, BulkIndex):
+        metrics.Gauge('pit_bulk_pending',
+                      'Documents waiting to be sent in a bulk request.',
+                      func=lambda: idxer.index.pending)
+    if idxer.spool:
+        metrics.Gauge('pit_spool_depth',
+                      'Theses waiting in the spool to be indexed again.',
+                      func=lambda: len(idxer.spool))
+
+
 @main.command()
 @click.argument('collection')
 @click.option('--index-host', default='localhost')
 @click.option('--index-port', default=9200)
 @click.option('--index-name', default='theses')
-def reindex(collection, index_host, index_port, index_name):
+@click.option('--repo-connections', default=10)
+@click.option('--repo-timeout', default=300)
+@click.option('--cache-dir', type=click.Path(file_okay=False))
+@click.option('--cache-size', default=1024)
+@click.option('--bulk-size', default=0)
+@click.option('--stream/--no-stream', default=False)
+@click.option('--max-text-bytes', default=10485760)
+@click.option('--text-overflow', default='truncate',
+              type=click.Choice(['truncate', 'drop']))
+@click.option('--normalize-text', is_flag=True)
+@click.option('--since')
+@click.option('--versioned', is_flag=True)
+@click.option('--bulk-load/--no-bulk-load', default=True)
+@click.option('--wait-for', default='yellow',
+              type=click.Choice(['green', 'yellow']))
+@click.option('--force-merge', default=0)
+@click.option('--parse-workers', default=0)
+@click.option('--profile', type=click.Path(dir_okay=False))
+@click.option('--profile-seconds', type=float)
+@click.option('--profile-documents', type=int)
+@click.option('--profile-top', default=25)
+@click.option('--slow-callback', default=0.1)
+def reindex(collection, index_host, index_port, index_name, repo_connections,
+            repo_timeout, cache_dir, cache_size, bulk_size, stream,
+            max_text_bytes, text_overflow, normalize_text, since, versioned,
+            bulk_load, wait_for, force_merge, parse_workers, profile,
+            profile_seconds, profile_documents, profile_top, slow_callback):
     """Reindex the Fedora COLLECTION.
 
     This will reindex the full theses collection in Fedora. COLLECTION
     should be the URL to the theses collection. The theses index in
     Elasticsearch is an alias. This script will create a new, versioned
     index and when it is done it will point the alias to the new version
-    and remove the old version.
+    and remove the old version. If --bulk-size is greater than 0,
+    documents are written with the bulk API in batches of up to that size.
+    With --stream, only the collection's containment listing is requested
+    and theses are indexed as their URIs arrive. The full text options
+    and cache options are the same as for pit run.
+
+    With --since, the collection is reindexed incrementally into the
+    current index instead. Only theses modified after the given timestamp
+    are fetched. If --since is "index", each thesis is compared to the
+    modification time stored in the index, which also picks up theses
+    missing from it. --versioned and --parse-workers are the same as for
+    pit run.
+
+    Unless --no-bulk-load is given, the new version is filled with
+    refreshes and replicas turned off. Once every thesis is indexed the
+    settings of the current version are restored and the alias is only
+    moved when the new version's health is --wait-for. If it doesn't get
+    there within 30 minutes the new version is deleted and the alias is
+    left alone. Only wait for green on a cluster with room for the
+    replicas. If --force-merge is greater than 0, the new version is
+    first merged down to that many segments.
+
+    The --profile options are the same as for pit run. Unless stopped
+    earlier, profiling ends once every thesis has been indexed.
     """
     logger = logging.getLogger(__name__)
+    if since not in (None, 'index') and parse_datetime(since) is None:
+        raise click.BadParameter('Invalid timestamp: {}'.format(since),
+                                 param_hint='--since')
+    started = datetime.now(timezone.utc).isoformat()
     es_conn = '{}:{}'.format(index_host, index_port)
     loop = asyncio.get_event_loop()
+    pool = ParsePool(parse_workers, loop)
     es = Elasticsearch([es_conn], loop=loop)
-    idx = Index(es, index_name)
+    idx = Index(es, index_name, versioned=versioned)
     loop.run_until_complete(idx.initialize())
-    fut = asyncio.ensure_future(idx.new_version())
-    loop.run_until_complete(fut)
-    new = fut.result()
-    loop.run_until_complete(index_collection(collection, idx))
-    loop.run_until_complete(idx.set_current(new))
-    logger.info('Finished indexing collection')
+    cache = Cache(cache_dir, cache_size * 1048576) if cache_dir else None
+    client = Client(limit_per_host=repo_connections,
+                    read_timeout=repo_timeout, cache=cache, loop=loop)
+    reader = TextReader(max_text_bytes, text_overflow, normalize_text)
+    changes = None
+    if since == 'index':
+        indexed = loop.run_until_complete(idx.modified())
+        changes = ChangeFilter(client, indexed=indexed)
+    elif since:
+        changes = ChangeFilter(client, since=since)
+    else:
+        settings = loop.run_until_complete(idx.settings())
+        new = loop.run_until_complete(idx.new_version(bulk_load=bulk_load))
+    target = idx if changes else Index(es, new, versioned=versioned)
+    profiler = None
+    if profile:
+        profiler = Profiler(profile, loop, profile_seconds,
+                            profile_documents, profile_top, slow_callback)
+        profiler.start()
+    try:
+        loop.run_until_complete(index_collection(collection, target, client,
+                                                 bulk_size=bulk_size,
+                                                 stream=stream,
+                                                 text_reader=reader,
+                                                 changes=changes,
+                                                 pool=pool))
+    finally:
+        if profiler:
+            profiler.stop()
+        loop.run_until_complete(client.close())
+        pool.close()
+    if changes is None:
+        loop.run_until_complete(idx.set_current(
+            new, settings=settings if bulk_load else None, wait_for=wait_for,
+            max_num_segments=force_merge))
+    logger.info('Finished indexing collection. Use --since {} to catch up '
+                'from this run.'.format(started))
+
+
+@main.command()
+@click.option('--index-host', default='localhost')
+@click.option('--index-port', default=9200)
+@click.option('--index-name', default='theses')
+def dedupe(index_host, index_port, index_name):
+    """Remove duplicate theses from the index.
+
+    Older versions of pit added a new copy of a thesis every time it was
+    indexed. This keeps the most recently modified copy of each thesis,
+    stored under the ID derived from its URI, and deletes the rest.
+    """
+    es_conn = '{}:{}'.format(index_host, index_port)
+    loop = asyncio.get_event_loop()
+    es = Elasticsearch([es_conn], loop=loop)
+    loop.run_until_complete(Index(es, index_name).dedupe())
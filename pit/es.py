@@ -1,43 +1,82 @@
+import asyncio
 from datetime import datetime
+import hashlib
+import json
+import logging
 
+from aioes.exception import ConflictError
 
-thesis_map = {
-    'mappings': {
-        'thesis': {
-            'properties': {
-                'abstract': {'type': 'string'},
-                'advisor': {'type': 'string', 'index': 'not_analyzed'},
-                'author': {'type': 'string', 'index': 'not_analyzed'},
-                'copyright_date': {'type': 'integer'},
-                'degree': {'type': 'string'},
-                'department': {'type': 'string', 'index': 'not_analyzed'},
-                'description': {'type': 'string'},
-                'handle': {'type': 'string', 'index': 'not_analyzed'},
-                'published_date': {'type': 'integer'},
-                'title': {'type': 'string'},
-                'uri': {'type': 'string', 'index': 'not_analyzed'},
-                'full_text': {'type': 'string'},
-            }
-        }
-    }
-}
+from pit import consume_exception, schema
+
+
+thesis_map = schema.thesis.mapping()
+
+# Settings for a new index version while it is being filled. Refreshes
+# and replicas are restored before the alias is pointed at it.
+BULK_LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+DEFAULT_SETTINGS = {'refresh_interval': '1s', 'number_of_replicas': 1}
+
+
+def doc_id(uri):
+    """Return the stable document ID for a Fedora URI."""
+    return hashlib.sha1(uri.encode('utf-8')).hexdigest()
+
+
+def doc_version(document):
+    """Return an external version number for a document, or ``None``.
+
+    The version is the document's modification time in milliseconds, so a
+    document is only replaced by one modified later.
+    """
+    modified = schema.parse_datetime(document.get('modified'))
+    if modified is not None:
+        return int(modified.timestamp() * 1000)
 
 
 class Index:
-    def __init__(self, conn, name):
+    """The theses index, an alias pointing to the current index version.
+
+    Documents are stored under an ID derived from their URI. If
+    ``versioned`` is set, Fedora's modification time is used as an
+    external version so Elasticsearch ignores stale or repeated updates.
+    """
+    def __init__(self, conn, name, versioned=False):
         self.conn = conn
         self.name = name
+        self.versioned = versioned
+
+    async def healthy(self):
+        return await self.conn.ping()
 
     async def initialize(self):
         if not await self.conn.indices.exists_alias(self.name):
             version = await self.new_version()
             await self.set_current(version)
 
-    async def new_version(self):
+    async def new_version(self, bulk_load=False):
         version = '{}-{}'.format(self.name, datetime.utcnow().timestamp())
-        await self.conn.indices.create(version, thesis_map)
+        body = thesis_map
+        if bulk_load:
+            body = dict(thesis_map, settings={'index': BULK_LOAD_SETTINGS})
+        await self.conn.indices.create(version, body)
         return version
 
+    async def settings(self):
+        """Return the refresh and replica settings of the current version.
+
+        These are the settings a bulk loaded version is given before it
+        replaces the current one. :data:`DEFAULT_SETTINGS` are used for
+        anything the current version doesn't set.
+        """
+        settings = dict(DEFAULT_SETTINGS)
+        if await self.conn.indices.exists_alias(self.name):
+            resp = await self.conn.indices.get_settings(self.name)
+            for version in resp.values():
+                current = version['settings']['index']
+                settings.update((k, current[k]) for k in DEFAULT_SETTINGS
+                                if k in current)
+        return settings
+
     @property
     async def versions(self):
         if await self.conn.indices.exists_alias(self.name):
@@ -45,7 +84,30 @@ class Index:
             return list(indices.keys())
         return []
 
-    async def set_current(self, version):
+    async def set_current(self, version, settings=None, wait_for='yellow',
+                          max_num_segments=None):
+        """Point the alias at ``version`` and delete the old versions.
+
+        With ``max_num_segments`` the new version is first force merged
+        down to that many segments. If ``settings`` are given they are
+        applied to ``version`` and the alias isn't moved until the cluster
+        health for ``version`` reaches ``wait_for``. If it doesn't,
+        ``version`` is deleted and :class:`IndexNotReady` is raised.
+        """
+        if max_num_segments:
+            # Merge before adding replicas so they copy the merged segments.
+            await self.conn.transport.perform_request(
+                'POST', '/{}/_forcemerge'.format(version),
+                params={'max_num_segments': max_num_segments})
+        if settings is not None:
+            await self.conn.indices.put_settings({'index': settings},
+                                                 version)
+            resp = await self.conn.cluster.health(
+                version, wait_for_status=wait_for, timeout='30m')
+            if resp.get('timed_out'):
+                await self.conn.indices.delete(index=version)
+                raise IndexNotReady(
+                    '{} did not reach {} health'.format(version, wait_for))
         body = {"actions": []}
         versions = await self.versions
         for idx in versions:
@@ -57,5 +119,232 @@ class Index:
         if versions:
             await self.conn.indices.delete(index=",".join(versions))
 
+    async def modified(self):
+        """Map the URI of every indexed document to its ``modified`` value.
+
+        Documents indexed before the field existed map to ``None``.
+        """
+        modified = {}
+        async for hit in Scroll(self.conn, self.name, ['uri', 'modified']):
+            modified[hit['_source']['uri']] = hit['_source'].get('modified')
+        return modified
+
+    async def dedupe(self, batch=500):
+        """Keep one copy of each thesis, stored under its stable ID.
+
+        Indexes written before documents had stable IDs hold a copy of a
+        thesis for every time it was indexed. The most recently modified
+        copy is rewritten under the stable ID and the others are deleted.
+        Documents are scrolled in URI order, so only the copies of one
+        thesis are held at a time, and deleted in batches of ``batch``.
+        Returns the number of documents deleted.
+        """
+        logger = logging.getLogger(__name__)
+        old = []
+        deleted = theses = 0
+        hits = Scroll(self.conn, self.name, ['uri', 'modified'], sort='uri')
+        copies = []
+        async for hit in hits:
+            if copies and hit['_source']['uri'] != copies[0]['_source']['uri']:
+                old.extend(await self._keep_newest(copies))
+                theses += 1
+                copies = []
+            copies.append(hit)
+            if len(old) >= batch:
+                await self.conn.bulk(old)
+                deleted += len(old)
+                old = []
+        if copies:
+            old.extend(await self._keep_newest(copies))
+            theses += 1
+        if old:
+            await self.conn.bulk(old)
+            deleted += len(old)
+        logger.info('Deleted {} duplicate documents for {} theses'
+                    .format(deleted, theses))
+        return deleted
+
+    async def _keep_newest(self, copies):
+        """Make sure a copy of a thesis is stored under its stable ID.
+
+        Returns the bulk delete actions for the other copies.
+        """
+        stable = doc_id(copies[0]['_source']['uri'])
+        if not any(h['_id'] == stable for h in copies):
+            newest = max(copies, key=lambda h: doc_version(h['_source']) or 0)
+            doc = await self.conn.get(newest['_index'], newest['_id'],
+                                      'thesis')
+            await self.add(doc['_source'])
+        return [{'delete': {'_index': h['_index'], '_type': 'thesis',
+                            '_id': h['_id']}}
+                for h in copies if h['_id'] != stable]
+
+    async def add(self, document):
+        kwargs = {}
+        version = doc_version(document) if self.versioned else None
+        if version is not None:
+            kwargs = {'version': version, 'version_type': 'external'}
+        try:
+            await self.conn.index(self.name, 'thesis', document,
+                                  doc_id(document['uri']), op_type='index',
+                                  **kwargs)
+        except ConflictError:
+            # A copy at least as new is already indexed.
+            pass
+
+    async def add_many(self, documents):
+        """Add a batch of documents with a single ``_bulk`` request.
+
+        Returns a list with one entry per document, in order. The entry is
+        ``None`` if the document was indexed, otherwise it is the error
+        Elasticsearch reported for that document.
+        """
+        if not documents:
+            return []
+        body = []
+        for document in documents:
+            action = {'_index': self.name, '_type': 'thesis',
+                      '_id': doc_id(document['uri'])}
+            version = doc_version(document) if self.versioned else None
+            if version is not None:
+                action.update(_version=version, _version_type='external')
+            body.append({'index': action})
+            body.append(document)
+        resp = await self.conn.bulk(body)
+        errors = []
+        for item in resp['items']:
+            result = list(item.values())[0]
+            # Version conflicts mean a copy at least as new is indexed.
+            errors.append(None if result.get('status') == 409
+                          else result.get('error'))
+        return errors
+
+
+class BulkIndex:
+    """Buffer documents and write them to an :class:`Index` in bulk.
+
+    The buffer is flushed when it holds ``size`` documents, when the
+    serialized documents reach ``max_bytes`` or ``interval`` seconds after
+    the first document was buffered, whichever happens first. A document
+    rejected by Elasticsearch is logged and does not affect the rest of
+    its batch.
+    """
+    def __init__(self, index, size=500, max_bytes=5242880, interval=1.0,
+                 loop=None):
+        self.index = index
+        self.size, self.max_bytes, self.interval = size, max_bytes, interval
+        self.loop = loop or asyncio.get_event_loop()
+        self.indexed = 0
+        self.failed = 0
+        self._buffer = []
+        self._bytes = 0
+        self._timer = None
+        self._lock = asyncio.Lock(loop=self.loop)
+
+    @property
+    def name(self):
+        return self.index.name
+
+    @property
+    def pending(self):
+        return len(self._buffer)
+
+    async def modified(self):
+        return await self.index.modified()
+
+    async def healthy(self):
+        return await self.index.healthy()
+
     async def add(self, document):
-        await self.conn.index(self.name, 'thesis', document, op_type='index')
+        """Buffer a document for indexing.
+
+        Returns a future that resolves once the document has been written,
+        or raises :class:`BulkItemError` if it was rejected.
+        """
+        fut = asyncio.Future(loop=self.loop)
+        fut.add_done_callback(consume_exception)
+        self._buffer.append((document, fut))
+        self._bytes += len(json.dumps(document))
+        if len(self._buffer) >= self.size or self._bytes >= self.max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.interval, self._expire)
+        return fut
+
+    async def flush(self):
+        logger = logging.getLogger(__name__)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._buffer, self._bytes = self._buffer, [], 0
+        if not batch:
+            return
+        async with self._lock:
+            try:
+                errors = await self.index.add_many([d for d, _ in batch])
+            except Exception as e:
+                logger.warn('Bulk request of {} documents failed: {}'
+                            .format(len(batch), e))
+                self.failed += len(batch)
+                for _, fut in batch:
+                    fut.set_exception(e)
+                return
+        for (document, fut), error in zip(batch, errors):
+            if error is None:
+                self.indexed += 1
+                fut.set_result(document.get('uri'))
+            else:
+                logger.warn('Error while indexing document {}: {}'
+                            .format(document.get('uri'), error))
+                self.failed += 1
+                fut.set_exception(BulkItemError(error))
+
+    async def close(self):
+        await self.flush()
+
+    def _expire(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush(), loop=self.loop)
+
+
+class Scroll:
+    """Iterate over every document in an index with the scroll API.
+
+    Only ``fields`` of each document's source are fetched, ``size`` hits
+    at a time, optionally sorted by the field ``sort``.
+    """
+    def __init__(self, conn, index, fields, sort=None, size=1000):
+        self.conn, self.index = conn, index
+        self.body = {'_source': fields, 'query': {'match_all': {}}}
+        if sort is not None:
+            self.body['sort'] = [sort]
+        self.size = size
+        self._hits = []
+        self._scroll_id = None
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._hits:
+            if self._done:
+                raise StopAsyncIteration
+            if self._scroll_id is None:
+                resp = await self.conn.search(self.index, 'thesis',
+                                              self.body, scroll='1m',
+                                              size=self.size)
+            else:
+                resp = await self.conn.scroll(self._scroll_id, scroll='1m')
+            self._scroll_id = resp['_scroll_id']
+            self._hits = resp['hits']['hits'][::-1]
+            self._done = not self._hits
+        return self._hits.pop()
+
+
+class IndexNotReady(Exception):
+    pass
+
+
+class BulkItemError(Exception):
+    pass
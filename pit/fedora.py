@@ -0,0 +1,62 @@
+import asyncio
+
+import aiohttp
+
+
+class Client:
+    """Long-lived HTTP client for talking to Fedora.
+
+    A single client should be shared by everything that fetches resources
+    from Fedora so that connections are pooled and kept alive between
+    requests instead of paying for a new handshake on every object. If a
+    :class:`pit.cache.Cache` is given, responses to :meth:`get` are
+    revalidated against it with conditional requests. :meth:`request`
+    always goes straight to Fedora, so its response can be streamed.
+    """
+    def __init__(self, session=None, limit=100, limit_per_host=10,
+                 conn_timeout=10, read_timeout=300, keepalive_timeout=30,
+                 cache=None, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.cache = cache
+        self.limit_per_host = limit_per_host
+        if session is None:
+            connector = aiohttp.TCPConnector(
+                limit=limit, limit_per_host=limit_per_host,
+                keepalive_timeout=keepalive_timeout, loop=self.loop)
+            session = aiohttp.ClientSession(
+                connector=connector, conn_timeout=conn_timeout,
+                read_timeout=read_timeout, loop=self.loop,
+                headers={'Accept-Encoding': 'gzip, deflate'})
+        self.session = session
+
+    async def request(self, method, url, *args, **kwargs):
+        return await self.session.request(method, url, *args, **kwargs)
+
+    async def get(self, url, *args, **kwargs):
+        if self.cache is None:
+            return await self.session.get(url, *args, **kwargs)
+        headers = dict(kwargs.pop('headers', None) or {})
+        key = self.cache.key(url, headers)
+        entry = await self._cache(self.cache.get, key)
+        if entry is not None:
+            headers.update(entry.validators)
+        resp = await self.session.get(url, *args, headers=headers, **kwargs)
+        if entry is not None and resp.status == 304:
+            await resp.release()
+            await self._cache(self.cache.hit, entry)
+            return entry.response(url)
+        if resp.status == 200 and self.cache.cacheable(resp):
+            self.cache.miss()
+            body = await resp.read()
+            entry = await self._cache(self.cache.put, key, resp.headers, body)
+            return entry.response(url)
+        return resp
+
+    def _cache(self, func, *args):
+        # SQLite blocks, so the cache is only used from its own thread.
+        return self.loop.run_in_executor(self.cache.executor, func, *args)
+
+    async def close(self):
+        await self.session.close()
+        if self.cache is not None:
+            self.cache.close()
@@ -1,13 +1,21 @@
 import asyncio
 from functools import partial
+import json
 import logging
 
+from aioes.exception import TransportError
 import aiohttp
 import rdflib
 
-from pit import rewrite_host
-from pit.namespaces import BIBO, F4EV, MODS, MSL, PCDM, DCTERMS, RDF, RDA
-from pit.pcdm import PREFER_HEADER, PcdmObject, collection
+from pit import consume_exception, metrics, rewrite_host, schema
+from pit.es import BulkIndex, BulkItemError
+from pit.fedora import Client
+from pit.namespaces import F4EV, PCDM, RDF
+from pit.parse import ParsePool
+from pit.pcdm import (PCDM_PREDICATES, PREFER_HEADER, RDF_ACCEPT,
+                      CollectionMembers, PcdmObject, TextReader, collection,
+                      parse_graph)
+from pit.schema import parse_datetime
 
 
 def indexable(headers):
@@ -16,78 +24,454 @@ def indexable(headers):
 
 
 def uri_from_message(data, msg_format='json-ld'):
+    """Return the URI of the ``pcdm:Object`` a Fedora message is about.
+
+    Common JSON-LD message shapes are decoded with :mod:`json` directly.
+    Anything that isn't recognized is parsed into an RDF graph instead.
+    """
+    if msg_format == 'json-ld':
+        uri = _uri_from_json(data)
+        if uri is not None:
+            return uri
+    return _uri_from_graph(data, msg_format)
+
+
+def _uri_from_graph(data, msg_format='json-ld'):
     g = rdflib.Graph().parse(data=data, format=msg_format)
     uri = g.value(subject=None, predicate=RDF.type, object=PCDM.Object,
                   any=False)
     return str(uri)
 
 
-async def create_thesis(url, client=None):
-    client = aiohttp.ClientSession()
+AS_CONTEXT = 'https://www.w3.org/ns/activitystreams'
+
+
+def _uri_from_json(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    try:
+        doc = json.loads(data)
+    except ValueError:
+        return None
+    if isinstance(doc, list):
+        # Expanded JSON-LD can be a bare list of nodes.
+        doc = {'@graph': doc}
+    if not isinstance(doc, dict):
+        return None
+    ids, types, prefixes = {'@id'}, {'@type'}, {}
+    context = doc.get('@context', [])
+    for ctx in context if isinstance(context, list) else [context]:
+        if ctx == AS_CONTEXT:
+            ids.add('id')
+            types.add('type')
+        elif isinstance(ctx, dict):
+            for term, value in ctx.items():
+                if value == '@id':
+                    ids.add(term)
+                elif value == '@type':
+                    types.add(term)
+                elif isinstance(value, str):
+                    prefixes[term] = value
+        else:
+            # Remote contexts can't be interpreted without fetching them.
+            return None
+    nodes = [doc]
+    while nodes:
+        node = nodes.pop()
+        node_id, node_types = None, []
+        for key, value in node.items():
+            if key in ids:
+                node_id = value
+            elif key in types:
+                node_types.extend(value if isinstance(value, list)
+                                  else [value])
+            elif key != '@context':
+                values = value if isinstance(value, list) else [value]
+                nodes.extend(v for v in values if isinstance(v, dict))
+        for t in node_types:
+            prefix, _, suffix = t.partition(':')
+            if prefixes.get(prefix, prefix + ':') + suffix == str(PCDM.Object):
+                return node_id
+    return None
+
+
+async def create_thesis(url, client=None, text_reader=None, pool=None):
+    if client is None:
+        client = Client()
+        try:
+            return await create_thesis(url, client, text_reader, pool)
+        finally:
+            await client.close()
+    pool = pool or ParsePool()
+    text_reader = text_reader or TextReader()
     url = rewrite_host(url)
-    resp = await client.get(url, headers={'Prefer': PREFER_HEADER,
-                                          'Accept': 'text/n3'})
-    data = await resp.text()
-    graph = rdflib.Graph().parse(data=data, format='n3')
-    t = ThesisResource(graph, client)
-    full_text = await t.full_text
-    return {
-        'abstract': t.abstract,
-        'advisor': t.advisor,
-        'author': t.author,
-        'copyright_date': t.copyright_date,
-        'degree': t.degree,
-        'department': t.department,
-        'description': t.description,
-        'handle': t.handle,
-        'published_date': t.published_date,
-        'title': t.title,
-        'uri': t.uri,
-        'full_text': full_text,
-    }
-
-
-async def index_collection(coll_url, index, client=None):
+    with metrics.stage('fetch'):
+        resp = await client.get(url, headers={'Prefer': PREFER_HEADER,
+                                              'Accept': RDF_ACCEPT})
+        resp.raise_for_status()
+        data = await resp.read()
+    with metrics.stage('parse'):
+        document, text_uri = await pool.run(
+            thesis_document, data, resp.headers.get('Content-Type', ''))
+    document['full_text'] = None
+    if text_uri is not None:
+        with metrics.stage('full_text'):
+            resp = await client.get(rewrite_host(text_uri))
+            document['full_text'] = await text_reader.read(resp)
+    return document
+
+
+def thesis_document(data, content_type):
+    """Build the document for a thesis from its RDF description.
+
+    Returns the document, without its full text, and the URI of the
+    thesis' plain text file or ``None``. This is run in a
+    :class:`pit.parse.ParsePool`.
+    """
+    graph = parse_graph(data, content_type, THESIS_PREDICATES)
+    t = ThesisResource(graph, None)
+    f = t.resource.file('text/plain')
+    return t.document, str(f.uri) if f is not None else None
+
+
+def collection_members(data):
+    graph = rdflib.Graph().parse(data=data.decode('utf-8'), format='n3')
+    return [str(m) for m in collection(graph)]
+
+
+async def index_collection(coll_url, index, client=None, bulk_size=0,
+                           stream=False, text_reader=None, changes=None,
+                           pool=None):
+    """Index every thesis in the collection at ``coll_url``.
+
+    If ``changes`` is a :class:`ChangeFilter`, theses it reports as
+    unchanged are skipped.
+    """
     logger = logging.getLogger(__name__)
-    client = client or aiohttp.ClientSession()
-    ex = CoroExecutor(size=10)
-    idx = partial(index_thesis, index)
-    resp = await client.get(coll_url, headers={'Prefer': PREFER_HEADER,
-                                               'Accept': 'text/n3'})
-    data = await resp.text()
-    graph = rdflib.Graph().parse(data=data, format='n3')
-    fs = ex.map(idx, collection(graph))
-    for fut in asyncio.as_completed(fs):
+    if client is None:
+        client = Client()
         try:
-            res = await fut
-            logger.info('Indexed {}'.format(res))
-        except Exception as e:
-            logger.warn(e)
-
-
-async def index_thesis(index, url):
-    thesis = await create_thesis(url)
-    await index.add(thesis)
-    return url
+            return await index_collection(coll_url, index, client, bulk_size,
+                                          stream, text_reader, changes, pool)
+        finally:
+            await client.close()
+    if bulk_size:
+        index = BulkIndex(index, size=bulk_size)
+    ex = QueueExecutor(size=10)
+    pool = pool or ParsePool()
+    idx = partial(index_thesis, index, client=client,
+                  text_reader=text_reader, pool=pool)
+    if changes is not None:
+        idx = partial(changes.index_if_changed, idx)
+    if stream:
+        members = CollectionMembers(coll_url, client)
+    else:
+        resp = await client.get(coll_url, headers={'Prefer': PREFER_HEADER,
+                                                   'Accept': 'text/n3'})
+        data = await resp.read()
+        members = await pool.run(collection_members, data)
+    results = ex.map(idx, members)
+    try:
+        async for fut in results:
+            try:
+                res = fut.result()
+            except Exception as e:
+                logger.warn(e)
+                continue
+            if isinstance(res, asyncio.Future):
+                # Buffered for a bulk request; report it once it's written.
+                res.add_done_callback(_log_indexed)
+            elif res is not None:
+                logger.info('Indexed {}'.format(res))
+    finally:
+        results.cancel()
+    if changes is not None:
+        logger.info('Skipped {} unchanged theses'.format(changes.unchanged))
+    if bulk_size:
+        await index.close()
+
+
+async def index_thesis(index, url, client=None, text_reader=None,
+                       pool=None, wait=False):
+    """Index the thesis at ``url`` and return ``url``.
+
+    A :class:`pit.es.BulkIndex` only buffers the thesis, so a future that
+    resolves to ``url`` once the batch has been written is returned
+    instead. With ``wait`` this doesn't return until then.
+    """
+    thesis = await create_thesis(url, client, text_reader, pool)
+    with metrics.stage('index'):
+        written = await index.add(thesis)
+        if written is None:
+            return url
+        if wait:
+            return await written
+    return written
+
+
+def _log_indexed(fut):
+    # Failures are logged by BulkIndex when the batch is written.
+    if not fut.cancelled() and fut.exception() is None:
+        logger = logging.getLogger(__name__)
+        logger.info('Indexed {}'.format(fut.result()))
+
+
+class ChangeFilter:
+    """Skip theses that haven't changed since they were last indexed.
+
+    Each thesis' Last-Modified header is fetched with a HEAD request and
+    compared to ``indexed``, a mapping of URIs to the modification times
+    already in the index (see :meth:`pit.es.Index.modified`), or, for
+    theses missing from it, to the ``since`` watermark. Theses with no
+    known modification time are always reindexed.
+    """
+    def __init__(self, client, since=None, indexed=None):
+        self.client = client
+        self.since = parse_datetime(since) if isinstance(since, str) \
+            else since
+        self.indexed = indexed
+        self.unchanged = 0
+
+    async def changed(self, uri):
+        resp = await self.client.request('HEAD', rewrite_host(uri))
+        await resp.release()
+        modified = parse_datetime(resp.headers.get('Last-Modified'))
+        if self.indexed is not None and uri in self.indexed:
+            last = parse_datetime(self.indexed[uri])
+        else:
+            last = self.since
+        # HTTP dates have whole seconds, so compare at that precision.
+        return modified is None or last is None or \
+            modified > last.replace(microsecond=0)
+
+    async def index_if_changed(self, func, uri):
+        if await self.changed(uri):
+            return await func(uri)
+        self.unchanged += 1
 
 
 class Indexer:
-    def __init__(self, index, loop=None):
+    """Index theses in response to Fedora modification messages.
+
+    If ``quiet`` is greater than 0, messages for the same URI are
+    coalesced by a :class:`Coalescer` so a burst of events results in a
+    single indexing job.
+
+    :meth:`on_message` returns once the thesis has been written to the
+    index and raises if indexing it failed, so the message can be
+    acknowledged accordingly. If a :class:`pit.spool.Spool` is given,
+    theses that fail are added to it instead and :meth:`replay` indexes
+    them once the index is reachable again.
+    """
+    def __init__(self, index, loop=None, client=None, quiet=0,
+                 max_delay=30, text_reader=None, pool=None, spool=None):
         self.index = index
         self.loop = loop or asyncio.get_event_loop()
+        self.client = client or Client(loop=self.loop)
+        self.text_reader = text_reader
+        self.pool = pool or ParsePool(loop=self.loop)
+        self.spool = spool
+        self.coalescer = None
+        if quiet:
+            self.coalescer = Coalescer(self.index_uri, quiet, max_delay,
+                                       self.loop)
 
     async def on_message(self, frame):
         logger = logging.getLogger(__name__)
         if indexable(frame.headers):
             logger.debug('Processing message {}'
                          .format(frame.headers['message-id']))
-            uri = uri_from_message(frame.body)
+            with metrics.stage('decode'):
+                uri = _uri_from_json(frame.body)
+                if uri is None:
+                    uri = await self.pool.run(_uri_from_graph, frame.body)
+            if self.coalescer:
+                await self.coalescer.submit(uri)
+            else:
+                await self.index_uri(uri)
+
+    async def index_uri(self, uri):
+        logger = logging.getLogger(__name__)
+        try:
+            await index_thesis(self.index, uri, self.client,
+                               self.text_reader, self.pool, wait=True)
+            logger.info('Indexed {}'.format(uri))
+        except Exception as e:
+            logger.warn('Error while indexing document {}: {}'
+                        .format(uri, e))
+            if self.spool is None or not transient(e):
+                raise
+            await self._spool(self.spool.add, uri)
+            logger.info('Spooled {}'.format(uri))
+
+    async def replay(self, interval=30, batch=100, max_attempts=10):
+        """Drain the spool every ``interval`` seconds."""
+        logger = logging.getLogger(__name__)
+        while True:
+            await asyncio.sleep(interval, loop=self.loop)
             try:
-                await index_thesis(self.index, uri)
-                logger.info('Indexed {}'.format(uri))
+                indexed = await self.drain(batch, max_attempts)
             except Exception as e:
-                logger.warn('Error while indexing document {}: {}'
-                            .format(uri, e))
+                logger.warn('Error while replaying spool: {}'.format(e))
+                continue
+            if indexed:
+                logger.info('Replayed {} theses from the spool, {} left'
+                            .format(indexed, len(self.spool)))
+
+    async def drain(self, batch=100, max_attempts=10):
+        """Index spooled theses while the index is reachable.
+
+        Theses are taken from the spool ``batch`` at a time until it is
+        empty or none of a batch could be indexed. A thesis that fails
+        ``max_attempts`` times while Fedora and the index are both up is
+        dropped; failures during an outage don't count. Returns the number
+        indexed.
+        """
+        indexed = 0
+        replay = partial(self._replay, max_attempts=max_attempts)
+        while len(self.spool) and await self.index.healthy():
+            ok = 0
+            ex = QueueExecutor(size=10, loop=self.loop)
+            uris = await self._spool(self.spool.take, batch)
+            results = ex.map(replay, uris)
+            try:
+                async for fut in results:
+                    ok += fut.result()
+            finally:
+                results.cancel()
+            indexed += ok
+            if not ok:
+                break
+        return indexed
+
+    async def _replay(self, uri, max_attempts):
+        logger = logging.getLogger(__name__)
+        try:
+            await index_thesis(self.index, uri, self.client,
+                               self.text_reader, self.pool, wait=True)
+        except Exception as e:
+            if not transient(e):
+                await self._spool(self.spool.remove, uri)
+                logger.error('Giving up on {}: {}'.format(uri, e))
+            elif not await self._reachable(uri):
+                await self._spool(self.spool.failed, uri, False)
+            elif await self._spool(self.spool.failed, uri) >= max_attempts:
+                await self._spool(self.spool.remove, uri)
+                logger.error('Giving up on {} after {} attempts: {}'
+                             .format(uri, max_attempts, e))
+            return False
+        await self._spool(self.spool.remove, uri)
+        logger.info('Indexed {}'.format(uri))
+        return True
+
+    async def _reachable(self, uri):
+        # Whether Fedora, asked about the thesis, and the index are up.
+        try:
+            resp = await self.client.request('HEAD', uri)
+            await resp.release()
+            return resp.status < 500 and await self.index.healthy()
+        except Exception:
+            return False
+
+    def _spool(self, func, *args):
+        # SQLite blocks, so the spool is only used from its own thread.
+        return self.loop.run_in_executor(self.spool.executor, func, *args)
+
+
+# Bulk item errors Elasticsearch reports when it is overloaded.
+TRANSIENT_BULK_ERRORS = {'es_rejected_execution_exception',
+                         'unavailable_shards_exception'}
+
+
+def transient(exc):
+    """Return whether indexing failed with ``exc`` might succeed later.
+
+    Timeouts, connection errors and server errors from Fedora or
+    Elasticsearch are transient. Anything else, such as a missing thesis
+    or RDF that can't be parsed, fails the same way every time.
+    """
+    if isinstance(exc, BulkItemError):
+        error = exc.args[0] if exc.args else None
+        return isinstance(error, dict) and \
+            error.get('type') in TRANSIENT_BULK_ERRORS
+    if isinstance(exc, TransportError):
+        status = exc.status_code
+        return not isinstance(status, int) or status == 429 or status >= 500
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.code == 429 or exc.code >= 500
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError,
+                            OSError))
+
+
+class Coalescer:
+    """Collapse bursts of events for the same URI into a single call.
+
+    ``func`` is called with a URI once no new event for it has been
+    submitted for ``quiet`` seconds, or ``max_delay`` seconds after the
+    first event of the burst, whichever comes first. The ``received``,
+    ``absorbed`` and ``dispatched`` counters report how many events were
+    submitted, how many were folded into an already pending job and how
+    many jobs were run.
+    """
+    def __init__(self, func, quiet=2, max_delay=30, loop=None):
+        self.func = func
+        self.quiet, self.max_delay = quiet, max_delay
+        self.loop = loop or asyncio.get_event_loop()
+        self.received = 0
+        self.absorbed = 0
+        self.dispatched = 0
+        self._pending = {}
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def submit(self, uri):
+        """Schedule ``func`` for ``uri``.
+
+        Returns a future, shared by every event of the burst, that
+        resolves with the result of the call.
+        """
+        now = self.loop.time()
+        self.received += 1
+        if uri in self._pending:
+            first, handle, fut, count = self._pending[uri]
+            handle.cancel()
+            self.absorbed += 1
+        else:
+            first, fut, count = now, asyncio.Future(loop=self.loop), 0
+            fut.add_done_callback(consume_exception)
+        delay = max(0, min(self.quiet, first + self.max_delay - now))
+        handle = self.loop.call_later(delay, self._dispatch, uri)
+        self._pending[uri] = (first, handle, fut, count + 1)
+        return fut
+
+    async def flush(self):
+        """Run every pending job now and wait for them to finish."""
+        futs = []
+        for uri in list(self._pending):
+            futs.append(self._pending[uri][2])
+            self._pending[uri][1].cancel()
+            self._dispatch(uri)
+        if futs:
+            await asyncio.wait(futs, loop=self.loop)
+
+    def _dispatch(self, uri):
+        logger = logging.getLogger(__name__)
+        _, _, fut, count = self._pending.pop(uri)
+        self.dispatched += 1
+        if count > 1:
+            logger.debug('Coalesced {} events for {}'.format(count, uri))
+        asyncio.ensure_future(self._run(uri, fut), loop=self.loop)
+
+    async def _run(self, uri, fut):
+        try:
+            fut.set_result(await self.func(uri))
+        except Exception as e:
+            fut.set_exception(e)
+
+
+THESIS_PREDICATES = PCDM_PREDICATES | schema.thesis.predicates
 
 
 class ThesisResource(object):
@@ -99,67 +483,109 @@ class ThesisResource(object):
         return str(self.resource.uri)
 
     @property
-    def abstract(self):
-        return self._get(DCTERMS.abstract)
-
-    @property
-    def advisor(self):
-        return self._get(RDA['60420'])
-
-    @property
-    def author(self):
-        return self._get(DCTERMS.creator)
+    def document(self):
+        """The Elasticsearch document for this thesis, minus the full text.
 
-    @property
-    def copyright_date(self):
-        return self._get(DCTERMS.dateCopyrighted)
+        Fields are extracted as described by :data:`pit.schema.thesis`.
+        """
+        return schema.thesis.extract(self.resource.g, self.resource.uri)
 
-    @property
-    def degree(self):
-        return self._get(MSL.degreeGrantedForCompletion)
 
-    @property
-    def department(self):
-        return self._get(MSL.associatedDepartment)
+class QueueExecutor:
+    """Run a coroutine function over many items with a fixed worker pool.
 
-    @property
-    def description(self):
-        return self._get(MODS.note)
+    Items are fed to ``size`` workers through a queue holding at most
+    ``maxsize`` items, so producers wait whenever the workers fall behind
+    and memory use doesn't grow with the number of items.
+    """
+    def __init__(self, size=1, maxsize=100, loop=None):
+        self.size, self.maxsize = size, maxsize
+        self.loop = loop or asyncio.get_event_loop()
 
-    @property
-    def handle(self):
-        return self._get(BIBO.handle)
+    def map(self, func, iterable):
+        """Apply ``func`` to every item of a (possibly async) iterable.
 
-    @property
-    def published_date(self):
-        return self._get(DCTERMS.issued)
+        Returns an async iterator of completed futures in the order they
+        finish. Its ``cancel()`` method stops the feeder and the workers.
+        They keep running if iteration stops early, so call ``cancel()``
+        when leaving the loop before the iterator is exhausted.
+        """
+        return _QueueIterator(func, iterable, self.size, self.maxsize,
+                              self.loop)
 
-    @property
-    def title(self):
-        return self._get(DCTERMS.title)
 
-    @property
-    async def full_text(self):
-        for f in self.resource.files:
-            if f.mimetype == 'text/plain':
-                resp = await f.read()
-                return await resp.text()
+_STOP = object()
 
-    def _get(self, prop):
-        return list(map(str, self.resource.g.objects(subject=self.resource.uri,
-                                                     predicate=prop)))
 
+class _QueueIterator:
+    def __init__(self, func, iterable, size, maxsize, loop):
+        self.func, self.loop = func, loop
+        self._items = asyncio.Queue(maxsize=maxsize, loop=loop)
+        self._results = asyncio.Queue(maxsize=maxsize, loop=loop)
+        self._running = size
+        self._error = None
+        self._cancelled = False
+        self._feeder = asyncio.ensure_future(self._feed(iterable, size),
+                                             loop=loop)
+        self._workers = [asyncio.ensure_future(self._work(), loop=loop)
+                         for _ in range(size)]
 
-class CoroExecutor:
-    def __init__(self, size=1):
-        self.semaphore = asyncio.BoundedSemaphore(value=size)
+    def __aiter__(self):
+        return self
 
-    def submit(self, func, *args, **kwargs):
-        return asyncio.ensure_future(self._run(func, *args, **kwargs))
-
-    def map(self, func, iterable, timeout=None):
-        return [self.submit(func, arg) for arg in iterable]
+    async def __anext__(self):
+        while self._running:
+            try:
+                fut = await self._results.get()
+            except asyncio.CancelledError:
+                self.cancel()
+                raise
+            if fut is _STOP:
+                self._running -= 1
+            else:
+                return fut
+        if self._error is not None:
+            raise self._error
+        raise StopAsyncIteration
+
+    def cancel(self):
+        self._cancelled = True
+        self._feeder.cancel()
+        for worker in self._workers:
+            worker.cancel()
+
+    async def _feed(self, iterable, size):
+        try:
+            if hasattr(iterable, '__aiter__'):
+                async for item in iterable:
+                    await self._items.put(item)
+            else:
+                for item in iterable:
+                    await self._items.put(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Let the workers drain, then raise from the iterator.
+            self._error = e
+        for _ in range(size):
+            await self._items.put(_STOP)
 
-    async def _run(self, func, *args, **kwargs):
-        async with self.semaphore:
-            return await func(*args, **kwargs)
+    async def _work(self):
+        try:
+            while True:
+                item = await self._items.get()
+                if item is _STOP:
+                    return
+                fut = asyncio.Future(loop=self.loop)
+                try:
+                    fut.set_result(await self.func(item))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    fut.set_exception(e)
+                await self._results.put(fut)
+        finally:
+            # However the worker stops, tell the iterator unless nobody is
+            # left to read it.
+            if not self._cancelled:
+                await self._results.put(_STOP)
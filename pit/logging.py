@@ -4,7 +4,12 @@ BASE_CONFIG = {
         'pit': {
             'handlers': ['console'],
             'level': 'DEBUG',
-        }
+        },
+        # Slow callbacks are reported here when the loop is in debug mode.
+        'asyncio': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
     },
     'handlers': {
         'console': {
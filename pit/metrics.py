@@ -0,0 +1,173 @@
+"""Counters, gauges and histograms exposed in the Prometheus text format.
+
+Metrics are module level so any part of the worker can record to them
+without having them passed around. Recording is an addition and, for
+histograms, a bisect over a handful of buckets, which is cheap enough to
+leave on. :func:`serve` starts an HTTP endpoint that renders every
+registered metric on ``/metrics``.
+"""
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+import time
+
+from aiohttp import web
+
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+           30, 60)
+
+REGISTRY = []
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        registry.append(self)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for key, value in sorted(self._values.items()):
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        yield '{}{} {}'.format(self.name, _labels(self.labels, key), value)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from ``func`` when the
+    metrics are rendered."""
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), func=None, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.func = func
+        if not labels:
+            self._values[()] = 0
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self):
+        if self.func is not None:
+            self._values[()] = self.func()
+        return super().render()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS,
+                 registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        counts = self._values.get(labels)
+        if counts is None:
+            # One count per bucket, one for +Inf, then the sum.
+            counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, *labels):
+        """Return the number of values observed."""
+        counts = self._values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def _samples(self, key, counts):
+        names = self.labels + ('le',)
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            total += count
+            yield '{}_bucket{} {}'.format(self.name,
+                                          _labels(names, key + (bound,)),
+                                          total)
+        yield '{}_count{} {}'.format(self.name, _labels(self.labels, key),
+                                     total)
+        yield '{}_sum{} {}'.format(self.name, _labels(self.labels, key),
+                                   counts[-1])
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for n, v in zip(names, values):
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append('{}="{}"'.format(n, v))
+    return '{' + ','.join(pairs) + '}'
+
+
+def render(registry=REGISTRY):
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def serve(host, port, loop, registry=REGISTRY):
+    """Serve the metrics in ``registry`` on ``http://host:port/metrics``.
+
+    Returns the server, to be closed on shutdown.
+    """
+    async def handler(request):
+        return web.Response(text=render(registry),
+                            content_type='text/plain')
+
+    app = web.Application(loop=loop)
+    app.router.add_get('/metrics', handler)
+    return await loop.create_server(app.make_handler(), host, port)
+
+
+STAGE_SECONDS = Histogram(
+    'pit_stage_seconds', 'Time spent in each stage of indexing a thesis.',
+    ['stage'])
+STAGE_ERRORS = Counter(
+    'pit_stage_errors_total', 'Errors raised in each stage.', ['stage'])
+FRAMES = Counter(
+    'pit_frames_received_total', 'STOMP frames received, by command.',
+    ['command'])
+MESSAGES = Counter(
+    'pit_messages_total', 'Messages handled, by outcome.', ['outcome'])
+IN_FLIGHT = Gauge(
+    'pit_messages_in_flight', 'Messages currently being handled.')
+
+
+@contextmanager
+def stage(name):
+    """Time a stage and count the errors it raises."""
+    try:
+        with STAGE_SECONDS.time(name):
+            yield
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        STAGE_ERRORS.inc(name)
+        raise
@@ -0,0 +1,145 @@
+"""A small N-Triples parser and read-only graph.
+
+Parsing a thesis into a full :class:`rdflib.Graph` is the most expensive
+part of indexing it. Fedora can return the same description as
+N-Triples, one triple per line, which can be parsed with a regular
+expression and stored in a couple of dictionaries. Only the predicates
+the caller asks for are kept, so everything else is skipped before any
+terms are built.
+
+:class:`Graph` implements the subset of the rdflib graph API that
+:mod:`pit.pcdm` and :mod:`pit.index` use and holds rdflib terms, so it
+can be used wherever those modules expect an rdflib graph.
+"""
+import re
+
+from rdflib import BNode, Literal, URIRef
+
+
+_BNODE = r'_:([A-Za-z0-9_\-]+(?:\.[A-Za-z0-9_\-]+)*)'
+_TRIPLE = re.compile(
+    r'[ \t]*(?:<([^>]*)>|' + _BNODE + r')'
+    r'[ \t]+<([^>]*)>[ \t]+'
+    r'(?:<([^>]*)>|' + _BNODE + r'|'
+    r'"((?:[^"\\]|\\.)*)"(?:@([a-zA-Z]+(?:-[a-zA-Z0-9]+)*)|\^\^<([^>]*)>)?)'
+    r'[ \t]*\.[ \t]*(?:#.*)?$')
+_ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|.)')
+_ESCAPES = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f',
+            '"': '"', "'": "'", '\\': '\\'}
+
+
+def _unescape(match):
+    esc = match.group(1)
+    if esc[0] in 'uU':
+        return chr(int(esc[1:], 16))
+    try:
+        return _ESCAPES[esc]
+    except KeyError:
+        raise ValueError('Invalid N-Triples escape: \\{}'.format(esc))
+
+
+class Graph:
+    def __init__(self):
+        self._spo = {}
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self.triples((None, None, None))
+
+    def add(self, triple):
+        s, p, o = triple
+        self._spo.setdefault(s, {}).setdefault(p, []).append(o)
+        self._len += 1
+
+    def triples(self, triple):
+        s, p, o = triple
+        if s is not None:
+            subjects = [(s, self._spo.get(s, {}))]
+        else:
+            subjects = self._spo.items()
+        for subj, preds in subjects:
+            for pred, objs in preds.items():
+                if p is None or p == pred:
+                    for obj in objs:
+                        if o is None or o == obj:
+                            yield subj, pred, obj
+
+    def objects(self, subject=None, predicate=None):
+        for _, _, o in self.triples((subject, predicate, None)):
+            yield o
+
+    def value(self, subject=None, predicate=None, object=None, default=None,
+              any=True):
+        for s, p, o in self.triples((subject, predicate, object)):
+            if subject is None:
+                return s
+            if predicate is None:
+                return p
+            return o
+        return default
+
+
+class Parser:
+    """Incrementally parse N-Triples into a :class:`Graph`.
+
+    Data can be passed to :meth:`feed` in chunks of any size. If
+    ``predicates`` is given only triples with one of those predicates are
+    added. A line that isn't valid N-Triples raises :class:`ValueError`.
+    """
+    def __init__(self, graph=None, predicates=None):
+        self.graph = graph if graph is not None else Graph()
+        self.predicates = None
+        if predicates is not None:
+            self.predicates = set(str(p) for p in predicates)
+        self._buffer = b''
+        self._uris = {}
+
+    def feed(self, data):
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def close(self):
+        self._line(self._buffer)
+        self._buffer = b''
+        return self.graph
+
+    def _line(self, line):
+        line = line.decode('utf-8').strip()
+        if not line or line.startswith('#'):
+            return
+        m = _TRIPLE.match(line)
+        if m is None:
+            raise ValueError('Invalid N-Triples line: {}'.format(line))
+        s_iri, s_bnode, p, o_iri, o_bnode, lex, lang, datatype = m.groups()
+        if self.predicates is not None and p not in self.predicates:
+            return
+        s = self._uri(s_iri) if s_iri is not None else BNode(s_bnode)
+        if o_iri is not None:
+            o = self._uri(o_iri)
+        elif o_bnode is not None:
+            o = BNode(o_bnode)
+        else:
+            if '\\' in lex:
+                lex = _ESCAPE.sub(_unescape, lex)
+            o = Literal(lex, lang=lang,
+                        datatype=URIRef(datatype) if datatype else None)
+        self.graph.add((s, self._uri(p), o))
+
+    def _uri(self, iri):
+        # The same few subjects and predicates repeat on every line.
+        uri = self._uris.get(iri)
+        if uri is None:
+            uri = self._uris[iri] = URIRef(iri)
+        return uri
+
+
+def parse(data, predicates=None):
+    """Parse a complete N-Triples document into a :class:`Graph`."""
+    parser = Parser(predicates=predicates)
+    parser.feed(data)
+    return parser.close()
@@ -1,63 +1,251 @@
+import asyncio
+from collections import deque
 import logging
 import os.path
 import tempfile
 import uuid
 
-import aiohttp
-import rdflib
+from pit import consume_exception
+from pit.archive import archive, STREAMING
+from pit.fedora import Client
+from pit.pcdm import (PCDM_PREDICATES, PREFER_HEADER, RDF_ACCEPT, PcdmObject,
+                      read_graph)
 
-from pit.archive import archive
-from pit.pcdm import PcdmObject, PREFER_HEADER
+
+CHUNK_SIZE = 262144
+# PDFs downloaded ahead are kept in memory up to this size.
+SPOOL_SIZE = 8388608
 
 
 class DocumentSet:
-    def __init__(self, members, client):
-        self.members = members
+    """Iterate over the members of a docset as PCDM objects.
+
+    Up to ``lookahead`` members are fetched ahead of the one being
+    consumed, with no more than ``concurrency`` requests at a time, and
+    members are returned in their original order.
+    """
+    def __init__(self, members, client, pool=None, lookahead=10,
+                 concurrency=5, loop=None):
+        self.members = deque(members)
         self.client = client
+        self.pool = pool
+        self.lookahead = lookahead
+        self.loop = loop or asyncio.get_event_loop()
+        self._slots = asyncio.Semaphore(concurrency, loop=self.loop)
+        self._pending = deque()
 
     def __aiter__(self):
         return self
 
     async def __anext__(self):
-        try:
-            doc = self.members.pop(0)
-        except IndexError:
+        if self._pending:
+            doc = self._pending.popleft()
+        elif self.members:
+            doc = self._fetch(self.members.popleft())
+        else:
             raise StopAsyncIteration
-        res = await self.client.get(doc, headers={'Prefer': PREFER_HEADER,
-                                                  'Accept': 'text/n3'})
-        data = await res.text()
-        graph = rdflib.Graph().parse(data=data, format='n3')
+        self._fill()
+        return await doc
+
+    def close(self):
+        """Cancel the members still being fetched."""
+        while self._pending:
+            self._pending.popleft().cancel()
+
+    def _fill(self):
+        while self.members and len(self._pending) < self.lookahead:
+            self._pending.append(asyncio.ensure_future(
+                self._fetch(self.members.popleft()), loop=self.loop))
+
+    async def _fetch(self, uri):
+        async with self._slots:
+            res = await self.client.get(uri, headers={
+                'Prefer': PREFER_HEADER, 'Accept': RDF_ACCEPT})
+            graph = await read_graph(res, PCDM_PREDICATES, self.pool)
         return PcdmObject(graph, self.client)
 
 
-async def create_package(url, session=None):
-    session = session or aiohttp.ClientSession()
+class Download:
+    """A PDF downloaded ahead of being written to the archive.
+
+    The body is read into a spooled temporary file, holding one of
+    ``slots`` while the response is open. Once the download is iterated
+    over, reading ahead stops and the chunks come from the spool and
+    then straight from the response.
+
+    Where the archive can't stream members it adds them from files, so
+    the whole body is downloaded to a named temporary file instead and
+    :meth:`filename` returns its name.
+    """
+    def __init__(self, uri, client, slots, loop):
+        self.uri = uri
+        self.name = uri.split('/')[-1]
+        self.client, self.slots = client, slots
+        if STREAMING:
+            self.spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        else:
+            self.spool = tempfile.NamedTemporaryFile()
+        self.resp = None
+        self._claimed = self._complete = self._slot = False
+        self._task = asyncio.ensure_future(self._prefetch(), loop=loop)
+        self._task.add_done_callback(consume_exception)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._claimed:
+            self._claimed = True
+            await self._task
+            self.spool.seek(0)
+        chunk = self.spool.read(CHUNK_SIZE)
+        if chunk:
+            return chunk
+        if not self._complete:
+            chunk = await self.resp.content.read(CHUNK_SIZE)
+        if not chunk:
+            self._complete = True
+            raise StopAsyncIteration
+        return chunk
+
+    async def filename(self):
+        """Finish the download and return the name of its file."""
+        await self._task
+        self.spool.flush()
+        return self.spool.name
+
+    async def close(self):
+        """Release the response and its slot."""
+        self._task.cancel()
+        if self.resp is not None:
+            if self._complete:
+                await self.resp.release()
+            else:
+                # Don't reuse a connection with a body left unread.
+                self.resp.close()
+            self.resp = None
+        if self._slot:
+            self.slots.release()
+            self._slot = False
+        self.spool.close()
+
+    async def _prefetch(self):
+        await self.slots.acquire()
+        self._slot = True
+        self.resp = await self.client.get(self.uri)
+        while not self._claimed:
+            chunk = await self.resp.content.read(CHUNK_SIZE)
+            if not chunk:
+                self._complete = True
+                break
+            self.spool.write(chunk)
+
+
+class Downloads:
+    """Iterate over the PDFs in ``docs`` as :class:`Download` objects.
+
+    Up to ``window`` PDFs are downloaded ahead of the one being written,
+    with at most ``connections`` responses open at a time. Every open
+    response holds a pooled connection, so ``connections`` should leave
+    the client enough for fetching ``docs``. Downloads acquire their
+    connection in order, so the PDF being written never waits for one
+    held by a PDF behind it.
+    """
+    def __init__(self, docs, client, connections, window, loop):
+        self.docs, self.client, self.loop = docs, client, loop
+        self.slots = asyncio.Semaphore(connections, loop=loop)
+        self._queue = asyncio.Queue(window, loop=loop)
+        self._current = None
+        self._error = None
+        self._feeder = asyncio.ensure_future(self._feed(), loop=loop)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self._current = await self._queue.get()
+        if self._current is None:
+            if self._error is not None:
+                raise self._error
+            raise StopAsyncIteration
+        return self._current
+
+    async def close(self):
+        self._feeder.cancel()
+        self.docs.close()
+        pending = [self._current] if self._current is not None else []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for download in pending:
+            if download is not None:
+                await download.close()
+
+    async def _feed(self):
+        try:
+            async for doc in self.docs:
+                for f in doc.files_by_mimetype.get('application/pdf', []):
+                    await self._queue.put(Download(
+                        str(f.uri), self.client, self.slots, self.loop))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._error = e
+        await self._queue.put(None)
+
+
+async def create_package(url, client=None, pool=None, lookahead=10,
+                         concurrency=5):
+    """Package the PDFs of every member of the docset at ``url``.
+
+    Members are fetched concurrently, up to ``lookahead`` ahead of the
+    one being written, with no more than ``concurrency`` requests at a
+    time. PDFs are downloaded concurrently on the client's remaining
+    connections. Everything is added to the archive in docset order.
+    Returns the path to the archive.
+    """
+    if client is None:
+        client = Client()
+        try:
+            return await create_package(url, client, pool, lookahead,
+                                        concurrency)
+        finally:
+            await client.close()
     tmp = tempfile.gettempdir()
     archive_name = os.path.join(tmp, uuid.uuid4().hex) + '.zip'
-    res = await session.get(url)
+    res = await client.get(url)
     docset = await res.json()
-    with archive(archive_name) as arxv:
-        async for doc in DocumentSet(docset.get('members'), session):
-            for f in doc.files:
-                if f.mimetype == 'application/pdf':
-                    r = await session.get(str(f.uri))
-                    with tempfile.NamedTemporaryFile() as fp:
-                        async for chunk in r.content.iter_chunked(1024):
-                            fp.write(chunk)
-                        arxv.write(fp.name, f.uri.split('/')[-1])
+    docs = DocumentSet(docset.get('members'), client, pool, lookahead,
+                       concurrency)
+    connections = max(1, client.limit_per_host - concurrency)
+    downloads = Downloads(docs, client, connections, lookahead, docs.loop)
+    try:
+        with archive(archive_name, loop=docs.loop) as arxv:
+            async for download in downloads:
+                if STREAMING:
+                    await arxv.write_stream(download, download.name)
+                else:
+                    await arxv.write_file(await download.filename(),
+                                          download.name)
+                await download.close()
+    finally:
+        await downloads.close()
     return archive_name
 
 
 class Packager:
-    def __init__(self, bucket, session=None):
+    def __init__(self, bucket, client=None, pool=None, lookahead=10,
+                 concurrency=5):
         self.bucket = bucket
-        self.session = session or aiohttp.ClientSession()
+        self.client = client or Client()
+        self.pool = pool
+        self.lookahead, self.concurrency = lookahead, concurrency
 
     async def on_message(self, frame):
         logger = logging.getLogger(__name__)
         docset = frame.body.strip()
         try:
-            arxv = await create_package(docset, self.session)
+            arxv = await create_package(docset, self.client, self.pool,
+                                        self.lookahead, self.concurrency)
         except Exception as e:
             logger.error('Error creating package for docset {}: {}'
                          .format(docset, e))
@@ -0,0 +1,31 @@
+"""Run CPU-bound parsing outside the event loop.
+
+Parsing RDF and building documents from it is pure computation. Done on
+the event loop it delays heartbeats and network I/O for every other
+task, so :class:`ParsePool` can hand it to a pool of worker processes
+instead. The functions it runs must be importable at module level, and
+their arguments and results are pickled.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+
+class ParsePool:
+    """Run functions in ``workers`` processes.
+
+    With no workers, functions are called directly on the event loop,
+    which avoids the cost of pickling for small workloads.
+    """
+    def __init__(self, workers=0, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(workers) if workers else None
+
+    async def run(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
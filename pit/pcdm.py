@@ -1,18 +1,77 @@
+import cgi
+import codecs
+import logging
+import re
+
 import rdflib
 
-from pit import rewrite_host
+from pit import ntriples, rewrite_host
 from pit.namespaces import EBU, LDP, PCDM, RDF
 
 
 PREFER_HEADER = 'return=representation; include="http://fedora.info/' \
                 'definitions/v4/repository#EmbedResources"'
 
+CONTAINMENT_PREFER_HEADER = 'return=representation; ' \
+    'include="http://www.w3.org/ns/ldp#PreferContainment"; ' \
+    'omit="http://www.w3.org/ns/ldp#PreferMembership ' \
+    'http://www.w3.org/ns/ldp#PreferMinimalContainer"'
+
+RDF_ACCEPT = 'application/n-triples, text/n3;q=0.5'
+
+# Media types of the RDF serializations Fedora can return.
+RDF_TYPES = frozenset(['application/ld+json', 'application/n-triples',
+                       'application/rdf+xml', 'text/n3', 'text/rdf+n3',
+                       'text/turtle'])
+
+PCDM_PREDICATES = frozenset([RDF.type, PCDM.hasFile, EBU.hasMimeType])
+
+_CONTAINS = re.compile(r'^\s*<([^>]*)>\s+<' + re.escape(str(LDP.contains)) +
+                       r'>\s+<([^>]*)>\s*\.')
+_NEXT_LINK = re.compile(r'<([^>]*)>\s*;[^,]*rel="?next"?')
+
 
 class PcdmBase:
+    _uri = None
+
     @property
     def uri(self):
-        return self.g.value(subject=None, predicate=RDF.type,
-                            object=self.type, any=False)
+        if self._uri is None:
+            self._uri = self.g.value(subject=None, predicate=RDF.type,
+                                     object=self.type, any=False)
+        return self._uri
+
+
+async def read_graph(resp, predicates=None, pool=None):
+    """Parse a Fedora response requested with ``RDF_ACCEPT`` into a graph.
+
+    The body is parsed by :func:`parse_graph`, in ``pool`` (a
+    :class:`pit.parse.ParsePool`) if one is given.
+    """
+    content_type = resp.headers.get('Content-Type', '')
+    data = await resp.read()
+    if pool is not None:
+        return await pool.run(parse_graph, data, content_type, predicates)
+    return parse_graph(data, content_type, predicates)
+
+
+def parse_graph(data, content_type, predicates=None):
+    """Parse an RDF response body into a graph.
+
+    N-Triples are parsed into a lightweight :class:`pit.ntriples.Graph`
+    holding only ``predicates`` (or every triple if not given). Any other
+    representation, or N-Triples the lightweight parser can't handle, is
+    parsed with rdflib.
+    """
+    content_type = content_type.split(';')[0].strip()
+    if content_type != 'application/n-triples':
+        return rdflib.Graph().parse(data=data.decode('utf-8'), format='n3')
+    try:
+        return ntriples.parse(data, predicates)
+    except ValueError as e:
+        logger = logging.getLogger(__name__)
+        logger.debug('Falling back to rdflib: {}'.format(e))
+        return rdflib.Graph().parse(data=data.decode('utf-8'), format='nt')
 
 
 def collection(graph):
@@ -20,27 +79,108 @@ def collection(graph):
         yield str(item)
 
 
+class CollectionMembers:
+    """Asynchronously iterate over the members of a collection.
+
+    Only the containment triples are requested, as N-Triples, and member
+    URIs are yielded as soon as their line has been read from the response
+    so indexing can start before the whole listing has arrived. If Fedora
+    pages the listing the ``next`` links are followed.
+    """
+    def __init__(self, url, client, chunk_size=65536):
+        self.url = url
+        self.client = client
+        self.chunk_size = chunk_size
+        self._resp = None
+        self._buffer = b''
+        self._uris = []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._uris:
+            if self._resp is None:
+                if self.url is None:
+                    raise StopAsyncIteration
+                await self._open()
+            await self._read()
+        return self._uris.pop()
+
+    async def _open(self):
+        # Not a GET, so a caching client doesn't read the whole listing
+        # into memory before it can be streamed.
+        resp = await self.client.request(
+            'GET', self.url, headers={'Prefer': CONTAINMENT_PREFER_HEADER,
+                                      'Accept': 'application/n-triples'})
+        try:
+            resp.raise_for_status()
+        except Exception:
+            await resp.release()
+            raise
+        self._resp = resp
+        link = _NEXT_LINK.search(self._resp.headers.get('Link', ''))
+        self.url = link.group(1) if link else None
+
+    async def _read(self):
+        chunk = await self._resp.content.read(self.chunk_size)
+        if chunk:
+            lines = (self._buffer + chunk).split(b'\n')
+            self._buffer = lines.pop()
+        else:
+            lines, self._buffer = [self._buffer], b''
+            await self._resp.release()
+            self._resp = None
+        for line in reversed(lines):
+            match = _CONTAINS.match(line.decode('utf-8'))
+            if match:
+                self._uris.append(match.group(2))
+
+
 class PcdmObject(PcdmBase):
     type = PCDM.Object
 
     def __init__(self, graph, client):
         self.g = graph
         self.client = client
+        self._files = None
+        self._mimetypes = None
 
     @property
     def files(self):
-        for o in self.g.objects(subject=None, predicate=PCDM.hasFile):
-            graph = rdflib.Graph()
-            graph += self.g.triples((o, None, None))
-            yield PcdmFile(graph, self.client)
+        if self._files is None:
+            self._files = [PcdmFile(self.g, self.client, o) for o in
+                           self.g.objects(subject=None,
+                                          predicate=PCDM.hasFile)]
+        return self._files
+
+    @property
+    def files_by_mimetype(self):
+        if self._mimetypes is None:
+            self._mimetypes = {}
+            for f in self.files:
+                self._mimetypes.setdefault(f.mimetype, []).append(f)
+        return self._mimetypes
+
+    def file(self, mimetype):
+        """Return the first file with the given mimetype, or ``None``."""
+        files = self.files_by_mimetype.get(mimetype)
+        return files[0] if files else None
 
 
 class PcdmFile(PcdmBase):
+    """A file of a PCDM object.
+
+    ``graph`` is usually the graph of the parent object. Passing ``uri``
+    binds the file to its subject in that graph, so no triples need to be
+    copied; otherwise the graph is searched for the single ``pcdm:File``.
+    """
     type = PCDM.File
 
-    def __init__(self, graph, client):
+    def __init__(self, graph, client, uri=None):
         self.g = graph
         self.client = client
+        self._uri = uri
 
     @property
     def mimetype(self):
@@ -51,3 +191,71 @@ class PcdmFile(PcdmBase):
     async def read(self):
         url = rewrite_host(str(self.uri))
         return await self.client.get(url)
+
+
+class TextReader:
+    """Read a text response in chunks, keeping at most ``max_bytes``.
+
+    The body is decoded incrementally using the charset from the
+    Content-Type header (UTF-8 if none is given). When a body is larger
+    than ``max_bytes`` the ``overflow`` policy decides what is returned:
+    ``'truncate'`` keeps the text read so far and ``'drop'`` returns
+    ``None``. With ``normalize`` set, runs of whitespace are collapsed to a
+    single space as the text is read.
+    """
+    def __init__(self, max_bytes=10485760, overflow='truncate',
+                 normalize=False, chunk_size=65536):
+        if overflow not in ('truncate', 'drop'):
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+        self.max_bytes, self.overflow = max_bytes, overflow
+        self.normalize, self.chunk_size = normalize, chunk_size
+
+    async def read(self, resp):
+        logger = logging.getLogger(__name__)
+        _, params = cgi.parse_header(resp.headers.get('Content-Type', ''))
+        try:
+            decoder = codecs.getincrementaldecoder(
+                params.get('charset', 'utf-8'))(errors='replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        parts, size, space = [], 0, False
+        while True:
+            chunk = await resp.content.read(self.chunk_size)
+            final, truncated = not chunk, False
+            if self.max_bytes is not None and \
+                    size + len(chunk) > self.max_bytes:
+                chunk = chunk[:self.max_bytes - size]
+                final = truncated = True
+                logger.debug('Text at {} is larger than {} bytes'
+                             .format(resp.url, self.max_bytes))
+                resp.close()
+                if self.overflow == 'drop':
+                    return None
+            size += len(chunk)
+            # A character cut in half by truncation is dropped, not replaced.
+            text = decoder.decode(chunk, final and not truncated)
+            if self.normalize:
+                text, space = _collapse(text, space)
+            parts.append(text)
+            if final:
+                break
+        text = ''.join(parts)
+        return text.strip() if self.normalize else text
+
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _collapse(text, space):
+    """Collapse whitespace in a piece of a longer text.
+
+    ``space`` says whether the previous piece ended in whitespace, so runs
+    spanning pieces are collapsed too. Returns the collapsed text and
+    whether it ends in whitespace.
+    """
+    text = _WHITESPACE.sub(' ', text)
+    if space and text.startswith(' '):
+        text = text[1:]
+    if text:
+        space = text.endswith(' ')
+    return text, space
@@ -0,0 +1,80 @@
+"""Profile a running worker or reindex without patching the code.
+
+:class:`Profiler` collects :mod:`cProfile` statistics for the process
+and switches the event loop to debug mode, so asyncio logs a warning
+for every callback that blocks the loop longer than ``slow_callback``
+seconds. Profiling stops after ``seconds``, once ``documents`` theses
+have been indexed, on SIGUSR1 or when the process exits, whichever
+comes first. The statistics are then written to ``path`` for
+:mod:`pstats` or a viewer such as snakeviz, and the functions with the
+most cumulative time are logged.
+
+Only the main process is profiled, so use no parse workers to see the
+cost of parsing RDF.
+"""
+import cProfile
+import io
+import logging
+import pstats
+import signal
+
+from pit import metrics
+
+
+class Profiler:
+    def __init__(self, path, loop, seconds=None, documents=None, top=25,
+                 slow_callback=0.1):
+        self.path, self.loop = path, loop
+        self.seconds, self.documents = seconds, documents
+        self.top, self.slow_callback = top, slow_callback
+        self.profile = cProfile.Profile()
+        self.running = False
+        self._timer = self._poll = None
+
+    def start(self):
+        logger = logging.getLogger(__name__)
+        self.loop.set_debug(True)
+        self.loop.slow_callback_duration = self.slow_callback
+        self._indexed = self.indexed()
+        if self.seconds:
+            self._timer = self.loop.call_later(self.seconds, self.stop)
+        if self.documents:
+            self._poll = self.loop.call_later(1, self._check)
+        self.loop.add_signal_handler(signal.SIGUSR1, self.stop)
+        self.running = True
+        self.profile.enable()
+        logger.info('Profiling to {}'.format(self.path))
+
+    def stop(self):
+        """Stop profiling, write the statistics and log a summary.
+
+        Does nothing if the profiler isn't running.
+        """
+        if not self.running:
+            return
+        self.profile.disable()
+        self.running = False
+        logger = logging.getLogger(__name__)
+        for handle in (self._timer, self._poll):
+            if handle is not None:
+                handle.cancel()
+        self.loop.set_debug(False)
+        self.loop.remove_signal_handler(signal.SIGUSR1)
+        self.profile.dump_stats(self.path)
+        logger.info('Wrote profile to {}; top {} functions by cumulative '
+                    'time:\n{}'.format(self.path, self.top, self.summary()))
+
+    def summary(self):
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        return out.getvalue()
+
+    def indexed(self):
+        return metrics.STAGE_SECONDS.count('index')
+
+    def _check(self):
+        if self.indexed() - self._indexed >= self.documents:
+            self.stop()
+        else:
+            self._poll = self.loop.call_later(1, self._check)
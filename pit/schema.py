@@ -0,0 +1,131 @@
+"""Declarative description of the documents written to Elasticsearch.
+
+A :class:`Schema` maps document fields to the RDF predicates they are
+read from. The same schema produces the Elasticsearch mapping and
+extracts documents from a graph, so the two can't drift apart.
+"""
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import re
+
+from pit.namespaces import BIBO, DCTERMS, F4, MODS, MSL, RDA
+
+
+def integer(value):
+    return int(str(value))
+
+
+_XSD_DATETIME = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)'
+                           r'(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$')
+
+
+def parse_datetime(value):
+    """Parse an xsd:dateTime or HTTP date into an aware datetime.
+
+    Times without a zone are taken to be UTC. Returns ``None`` if the value
+    can't be parsed.
+    """
+    if not value:
+        return None
+    m = _XSD_DATETIME.match(value)
+    if m is None:
+        try:
+            return parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    year, month, day, hour, minute, second, fraction, zone = m.groups()
+    tz = timezone.utc
+    if zone and zone != 'Z':
+        zone = zone.replace(':', '')
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[3:]))
+        tz = timezone(-offset if zone[0] == '-' else offset)
+    micro = int((fraction or '0')[:6].ljust(6, '0'))
+    return datetime(int(year), int(month), int(day), int(hour), int(minute),
+                    int(second), micro, tzinfo=tz)
+
+
+def timestamp(value):
+    """Normalize a date and time to ISO 8601, whichever parser read it."""
+    parsed = parse_datetime(str(value))
+    if parsed is None:
+        raise ValueError('Invalid timestamp: {}'.format(value))
+    return parsed.isoformat()
+
+
+class Field:
+    """A document field read from the objects of ``predicate``.
+
+    Values are converted with ``coerce``. Fields with ``many`` set hold
+    a list of every value, otherwise only the first value is kept.
+    """
+    def __init__(self, name, predicate, mapping, many=True, coerce=str):
+        self.name, self.predicate, self.mapping = name, predicate, mapping
+        self.many, self.coerce = many, coerce
+
+
+class Schema:
+    """A set of fields making up one Elasticsearch document type.
+
+    ``properties`` holds mappings for fields that aren't read from a
+    predicate, such as the document's URI.
+    """
+    def __init__(self, doc_type, fields, properties=None):
+        self.doc_type = doc_type
+        self.fields = fields
+        self.properties = properties or {}
+        self._by_predicate = {f.predicate: f for f in fields}
+
+    @property
+    def predicates(self):
+        return frozenset(self._by_predicate)
+
+    def mapping(self):
+        properties = {f.name: dict(f.mapping) for f in self.fields}
+        properties.update((k, dict(v)) for k, v in self.properties.items())
+        return {'mappings': {self.doc_type: {'properties': properties}}}
+
+    def extract(self, graph, subject):
+        """Build a document from the triples of ``subject`` in one pass."""
+        logger = logging.getLogger(__name__)
+        document = {f.name: [] if f.many else None for f in self.fields}
+        document['uri'] = str(subject)
+        for _, p, o in graph.triples((subject, None, None)):
+            field = self._by_predicate.get(p)
+            if field is None:
+                continue
+            try:
+                value = field.coerce(o)
+            except ValueError:
+                logger.debug('Dropping invalid {} value for {}: {}'
+                             .format(field.name, subject, o))
+                continue
+            if field.many:
+                document[field.name].append(value)
+            elif document[field.name] is None:
+                document[field.name] = value
+        return document
+
+
+STRING = {'type': 'string'}
+KEYWORD = {'type': 'string', 'index': 'not_analyzed'}
+INTEGER = {'type': 'integer'}
+DATE = {'type': 'date'}
+
+thesis = Schema('thesis', [
+    Field('abstract', DCTERMS.abstract, STRING),
+    Field('advisor', RDA['60420'], KEYWORD),
+    Field('author', DCTERMS.creator, KEYWORD),
+    Field('copyright_date', DCTERMS.dateCopyrighted, INTEGER, coerce=integer),
+    Field('degree', MSL.degreeGrantedForCompletion, STRING),
+    Field('department', MSL.associatedDepartment, KEYWORD),
+    Field('description', MODS.note, STRING),
+    Field('handle', BIBO.handle, KEYWORD),
+    Field('modified', F4.lastModified, DATE, many=False,
+          coerce=timestamp),
+    Field('published_date', DCTERMS.issued, INTEGER, coerce=integer),
+    Field('title', DCTERMS.title, STRING),
+], properties={
+    'uri': KEYWORD,
+    'full_text': STRING,
+})
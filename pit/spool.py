@@ -0,0 +1,85 @@
+"""Durable record of theses that still need to be indexed.
+
+If a thesis can't be indexed because Elasticsearch or Fedora is
+unavailable, its URI is written to a SQLite database instead of being
+dropped. Each URI is stored once however many events arrive for it, and
+the spool is drained once the index is reachable again, so an outage
+only requires catching up on the theses that were missed rather than a
+full reindex.
+
+The database is only touched from :attr:`Spool.executor`, so callers on
+the event loop can keep disk I/O off it. The number of spooled theses
+is kept in memory and can be read from anywhere.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import os.path
+import sqlite3
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uris (
+    uri TEXT PRIMARY KEY,
+    added REAL,
+    attempts INTEGER DEFAULT 0
+)
+"""
+
+
+class Spool:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.executor = ThreadPoolExecutor(1)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(SCHEMA)
+        self.db.execute('CREATE INDEX IF NOT EXISTS added_idx '
+                        'ON uris (added)')
+        self.size = self.db.execute(
+            'SELECT COUNT(*) FROM uris').fetchone()[0]
+
+    def __len__(self):
+        return self.size
+
+    def add(self, uri):
+        with self.db:
+            cursor = self.db.execute('INSERT OR IGNORE INTO uris '
+                                     '(uri, added) VALUES (?, ?)',
+                                     (uri, time.time()))
+        self.size += cursor.rowcount
+
+    def take(self, n):
+        """Return up to ``n`` URIs, the least recently added first."""
+        rows = self.db.execute('SELECT uri FROM uris ORDER BY added '
+                               'LIMIT ?', (n,))
+        return [row[0] for row in rows]
+
+    def remove(self, uri):
+        with self.db:
+            cursor = self.db.execute('DELETE FROM uris WHERE uri = ?',
+                                     (uri,))
+        self.size -= cursor.rowcount
+
+    def failed(self, uri, count=True):
+        """Move ``uri`` to the back of the spool after a failed attempt.
+
+        Unless ``count`` is false the attempt is added to the number of
+        failed attempts to index it, which is returned.
+        """
+        with self.db:
+            self.db.execute('UPDATE uris SET added = ?, '
+                            'attempts = attempts + ? WHERE uri = ?',
+                            (time.time(), int(count), uri))
+        row = self.db.execute('SELECT attempts FROM uris WHERE uri = ?',
+                              (uri,)).fetchone()
+        return row[0] if row else 0
+
+    def close(self):
+        logger = logging.getLogger(__name__)
+        logger.info('Spool: {} theses waiting to be indexed'
+                    .format(len(self)))
+        self.executor.submit(self.db.close).result()
+        self.executor.shutdown()
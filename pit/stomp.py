@@ -1,18 +1,31 @@
 import asyncio
 from collections import deque
+import re
 
-from stompest.protocol import StompParser, StompSession, StompSpec
-from stompest.protocol.frame import StompHeartBeat
+from stompest.protocol import StompSession, StompSpec
+from stompest.protocol.frame import StompFrame, StompHeartBeat
+
+from pit import metrics
 
 
 class Protocol:
-    def __init__(self, host, port, loop):
+    """A STOMP 1.2 client.
+
+    ``heartbeats`` is the pair of intervals, in milliseconds, at which the
+    client offers to send heartbeats and wants to receive them. The
+    agreed client interval is :attr:`heartbeat_interval`. ``connections``
+    counts the connections made, so frames received on a connection that
+    has since been replaced can be told apart.
+    """
+    def __init__(self, host, port, loop, heartbeats=(30000, 60000)):
         self._transport = AsyncTransport(host, port, loop)
         self.session = StompSession(version=StompSpec.VERSION_1_2)
+        self.heartbeats = heartbeats
+        self.connections = 0
 
     async def connect(self):
         await self._transport.connect()
-        frame = self.session.connect(heartBeats=(0, 60000))
+        frame = self.session.connect(heartBeats=self.heartbeats)
         await self.send_frame(frame)
         while True:
             # The heartbeat can sometimes come before the CONNECTED frame
@@ -20,6 +33,28 @@ class Protocol:
             if frame != StompHeartBeat():
                 break
         self.session.connected(frame)
+        self.connections += 1
+
+    async def reconnect(self):
+        """Open a new connection and renew the current subscriptions."""
+        subscriptions = list(self.session.replay())
+        try:
+            self._transport.disconnect()
+        except Exception:
+            pass
+        self.session.close()
+        await self.connect()
+        for destination, headers, receipt, context in subscriptions:
+            frame, _ = self.session.subscribe(destination, headers, receipt,
+                                              context)
+            await self.send_frame(frame)
+
+    @property
+    def heartbeat_interval(self):
+        return self.session.clientHeartBeat / 1000
+
+    async def beat(self):
+        await self.send_frame(self.session.beat())
 
     async def disconnect(self):
         await self.send_frame(self.session.disconnect())
@@ -28,12 +63,29 @@ class Protocol:
     async def send(self, destination, body=b'', headers=None):
         await self.send_frame(self.session.send(destination, body, headers))
 
-    async def subscribe(self, destination, context=None):
-        frame, token = self.session.subscribe(destination, headers={'id': '1'},
+    async def subscribe(self, destination, context=None, ack='auto',
+                        prefetch=None):
+        """Subscribe to ``destination``.
+
+        With an ``ack`` mode of ``client`` or ``client-individual`` every
+        message has to be acknowledged with :meth:`ack` or :meth:`nack`.
+        ``prefetch`` limits how many unacknowledged messages ActiveMQ
+        dispatches to this subscription.
+        """
+        headers = {'id': '1', 'ack': ack}
+        if prefetch:
+            headers['activemq.prefetchSize'] = str(prefetch)
+        frame, token = self.session.subscribe(destination, headers=headers,
                                               context=context)
         await self.send_frame(frame)
         return token
 
+    async def ack(self, frame):
+        await self.send_frame(self.session.ack(frame))
+
+    async def nack(self, frame):
+        await self.send_frame(self.session.nack(frame))
+
     def message(self, frame):
         return self.session.message(frame)
 
@@ -42,10 +94,12 @@ class Protocol:
 
     async def send_frame(self, frame):
         await self._transport.send(frame)
+        self.session.sent()
 
     async def receive_frame(self):
         frame = await self._transport.receive()
         self.session.received()
+        metrics.FRAMES.inc(getattr(frame, 'command', 'HEARTBEAT'))
         return frame
 
     @property
@@ -54,17 +108,33 @@ class Protocol:
 
 
 class AsyncTransport:
-    def __init__(self, host, port, loop):
+    """Read and write STOMP frames over a TCP connection.
+
+    Reads start at ``read_size`` bytes and double, up to
+    ``max_read_size``, whenever a read fills the buffer, so a backlog of
+    large messages is read in a few big chunks rather than many small
+    ones. Frames sent in the same iteration of the event loop, such as a
+    burst of ACKs, are written to the socket together.
+    """
+    def __init__(self, host, port, loop, read_size=16384,
+                 max_read_size=1048576):
         self.host, self.port, self.loop = host, port, loop
-        self._parser = StompParser(StompSpec.VERSION_1_2)
+        self.min_read_size = self.read_size = read_size
+        self.max_read_size = max_read_size
+        self._parser = FrameParser(StompSpec.VERSION_1_2)
         self._frames = deque()
+        self._out = []
 
     async def connect(self):
         self._reader, self._writer = \
             await asyncio.open_connection(self.host, self.port, loop=self.loop)
         self._parser.reset()
+        self._frames.clear()
+        self._out = []
+        self.read_size = self.min_read_size
 
     def disconnect(self):
+        self._write()
         self._writer.close()
 
     async def receive(self):
@@ -73,18 +143,137 @@ class AsyncTransport:
         return self._frames.popleft()
 
     async def send(self, frame):
-        self._writer.write(bytes(frame))
+        self._out.append(bytes(frame))
+        if len(self._out) == 1:
+            try:
+                # Let frames sent by other tasks in the meantime join this
+                # write.
+                await asyncio.sleep(0, loop=self.loop)
+            finally:
+                self._write()
         await self._writer.drain()
 
+    def _write(self):
+        if self._out:
+            data, self._out = b''.join(self._out), []
+            self._writer.write(data)
+
     async def _read_frames(self):
         while not self._parser.canRead():
-            data = await self._reader.read(1024)
+            data = await self._reader.read(self.read_size)
             if not data:
                 raise BrokenSocketError()
-            self._parser.add(data)
+            if len(data) == self.read_size:
+                self.read_size = min(self.read_size * 2, self.max_read_size)
+            with metrics.stage('parse_frames'):
+                self._parser.add(data)
         while self._parser.canRead():
-            frame = self._parser.get()
+            self._frames.append(self._parser.get())
+
+
+_HEADERS_END = re.compile(b'\r?\n\r?\n')
+_UNESCAPE = re.compile(r'\\(.)')
+_ESCAPES = {'r': '\r', 'n': '\n', 'c': ':', '\\': '\\'}
+
+
+class FrameParser:
+    """Incrementally parse STOMP frames from a byte stream.
+
+    A drop-in replacement for stompest's ``StompParser`` that keeps
+    unparsed data in a single ``bytearray`` and only copies a frame's
+    body out of it once the whole frame has arrived.
+    """
+    def __init__(self, version=StompSpec.VERSION_1_2):
+        self.version = version
+        self.reset()
+
+    def reset(self):
+        self._buffer = bytearray()
+        self._frames = deque()
+        self._frame = None
+        self._scanned = 0
+
+    def canRead(self):
+        return bool(self._frames)
+
+    def get(self):
+        return self._frames.popleft()
+
+    def add(self, data):
+        self._buffer += data
+        pos = 0
+        while pos < len(self._buffer):
+            pos, frame = self._parse(pos)
+            if frame is None:
+                break
             self._frames.append(frame)
+        del self._buffer[:pos]
+        self._scanned = max(0, self._scanned - pos)
+
+    def _parse(self, pos):
+        buf = self._buffer
+        if self._frame is None:
+            if buf[pos] == 0x0a:
+                return pos + 1, StompHeartBeat()
+            if buf[pos] == 0x0d:
+                if len(buf) == pos + 1:
+                    return pos, None
+                if buf[pos + 1] == 0x0a:
+                    return pos + 2, StompHeartBeat()
+            m = _HEADERS_END.search(buf, pos)
+            if m is None:
+                return pos, None
+            command, headers = self._headers(bytes(buf[pos:m.start()]))
+            length = headers.get(StompSpec.CONTENT_LENGTH_HEADER)
+            length = int(length) if length is not None else None
+            self._frame = (command, headers, m.end() - pos, length)
+            self._scanned = m.end()
+        command, headers, offset, length = self._frame
+        start = pos + offset
+        if length is not None:
+            end = start + length
+            if len(buf) <= end:
+                return pos, None
+            if buf[end] != 0:
+                raise StompFrameError(
+                    'Missing NULL after {} byte body'.format(length))
+        else:
+            end = buf.find(b'\x00', self._scanned)
+            if end < 0:
+                self._scanned = len(buf)
+                return pos, None
+        self._frame = None
+        self._scanned = end + 1
+        return end + 1, StompFrame(command, headers, bytes(buf[start:end]),
+                                   version=self.version)
+
+    def _headers(self, data):
+        lines = data.decode('utf-8').split('\n')
+        command = lines[0].rstrip('\r')
+        # CONNECT and CONNECTED frames don't escape their headers.
+        escaped = command not in (StompSpec.CONNECT, StompSpec.CONNECTED)
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.rstrip('\r').partition(':')
+            if not sep:
+                raise StompFrameError('Invalid header: {}'.format(line))
+            if escaped and '\\' in line:
+                name = _UNESCAPE.sub(_unescape, name)
+                value = _UNESCAPE.sub(_unescape, value)
+            # The first of repeated headers wins.
+            headers.setdefault(name, value)
+        return command, headers
+
+
+def _unescape(match):
+    try:
+        return _ESCAPES[match.group(1)]
+    except KeyError:
+        raise StompFrameError('Invalid escape: \\{}'.format(match.group(1)))
+
+
+class StompFrameError(Exception):
+    pass
 
 
 class BrokenSocketError(Exception):
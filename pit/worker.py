@@ -1,18 +1,34 @@
 import asyncio
 import logging
+import random
 import time
 
+from stompest.protocol import StompSpec
+
+from pit import metrics
 from pit.stomp import BrokenSocketError
 
 
-async def listen(client):
+async def listen(client, max_in_flight=None, loop=None):
+    """Read frames from ``client`` and dispatch messages to their handlers.
+
+    If ``max_in_flight`` is set, no more frames are read while that many
+    handlers are running. It should be at least the subscription's
+    prefetch size, or the broker's heartbeats will stop being read too.
+    """
+    slots = None
+    if max_in_flight:
+        slots = asyncio.Semaphore(max_in_flight, loop=loop)
     while True:
         frame = await client.receive_frame()
         try:
             if frame.command == 'MESSAGE':
                 token = client.message(frame)
                 coro = client.subscription(token)
-                asyncio.ensure_future(coro(frame))
+                if slots is not None:
+                    await slots.acquire()
+                asyncio.ensure_future(handle(client, coro, frame, slots),
+                                      loop=loop)
             elif frame.command == 'RECEIPT':
                 pass
             elif frame.command == 'ERROR':
@@ -22,7 +38,43 @@ async def listen(client):
             pass
 
 
+async def handle(client, callback, frame, slots=None):
+    """Run ``callback`` for a message and acknowledge it if required.
+
+    Messages from subscriptions with an explicit ack mode carry an ack
+    header. They are acknowledged once the callback has finished, or
+    negatively acknowledged if it raised so the broker redelivers them.
+    Messages received on a connection that has since been replaced are
+    redelivered by the broker anyway and aren't acknowledged.
+    """
+    logger = logging.getLogger(__name__)
+    connection = client.connections
+    metrics.IN_FLIGHT.inc()
+    try:
+        try:
+            await callback(frame)
+        except Exception as e:
+            logger.warn('Error while handling message {}: {}'
+                        .format(frame.headers.get('message-id'), e))
+            metrics.MESSAGES.inc('failed')
+            reply = client.nack
+        else:
+            metrics.MESSAGES.inc('handled')
+            reply = client.ack
+        if StompSpec.ACK_HEADER in frame.headers and \
+                client.connections == connection:
+            await reply(frame)
+    except Exception as e:
+        logger.warn('Error while acknowledging message {}: {}'
+                    .format(frame.headers.get('message-id'), e))
+    finally:
+        metrics.IN_FLIGHT.dec()
+        if slots is not None:
+            slots.release()
+
+
 async def heartbeat(client, period, multiplier=1.0, loop=None):
+    """Return once nothing has been received for ``period * multiplier``."""
     grace_period = period * multiplier
     while True:
         last = client.lastReceived
@@ -33,31 +85,95 @@ async def heartbeat(client, period, multiplier=1.0, loop=None):
         elif delta <= period:
             wait = period - delta
         else:
-            loop.stop()
             return
-        await asyncio.sleep(wait)
+        await asyncio.sleep(wait, loop=loop)
+
+
+async def send_heartbeats(client, loop=None):
+    """Send heartbeats at the interval agreed with the broker."""
+    interval = client.heartbeat_interval
+    if not interval:
+        return await asyncio.Future(loop=loop)
+    while True:
+        await asyncio.sleep(interval, loop=loop)
+        await client.beat()
 
 
-async def work(client, callback, loop=None):
+def backoff(attempt, base=0.5, cap=30):
+    """Seconds to wait before reconnect ``attempt``, with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def work(client, callback, loop=None, destination='/queue/fedora',
+               ack='auto', prefetch=None, max_in_flight=None,
+               connect_timeout=5):
+    """Subscribe ``callback`` to ``destination`` and handle its messages.
+
+    If the connection breaks or the broker misses its heartbeats, the
+    client reconnects, backing off exponentially with jitter between
+    attempts, and its subscription is renewed.
+    """
     loop = loop or asyncio.get_event_loop()
     logger = logging.getLogger(__name__)
     try:
-        await client.subscribe('/queue/fedora', callback)
-        asyncio.ensure_future(heartbeat(client, 60, 2.5, loop))
-        await listen(client)
-    except BrokenSocketError:
-        logger.warn('Socket unexpectedly closed')
-        loop.stop()
+        await client.subscribe(destination, callback, ack=ack,
+                               prefetch=prefetch)
+        while True:
+            tasks = [
+                asyncio.ensure_future(listen(client, max_in_flight, loop),
+                                      loop=loop),
+                asyncio.ensure_future(heartbeat(client, 60, 2.5, loop),
+                                      loop=loop),
+                asyncio.ensure_future(send_heartbeats(client, loop),
+                                      loop=loop),
+            ]
+            try:
+                done, _ = await asyncio.wait(
+                    tasks, loop=loop, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            for task in done:
+                error = None if task.cancelled() else task.exception()
+                if isinstance(error, BrokenSocketError):
+                    logger.warn('Socket unexpectedly closed')
+                elif error is not None:
+                    logger.warn('Exception encountered: {}'.format(error))
+                else:
+                    logger.warn('Missed heartbeats from ActiveMQ')
+            await reconnect(client, loop, connect_timeout)
     except asyncio.CancelledError:
         pass
     except Exception as e:
         logger.error('Exception encountered: {}'.format(e))
         loop.stop()
     finally:
-        await client.disconnect()
+        try:
+            await client.disconnect()
+        except Exception:
+            pass
         logger.debug('Stomp client disconnected')
 
 
+async def reconnect(client, loop, timeout=5):
+    logger = logging.getLogger(__name__)
+    attempt = 0
+    while True:
+        delay = backoff(attempt)
+        logger.info('Reconnecting to ActiveMQ in {:.1f}s'.format(delay))
+        await asyncio.sleep(delay, loop=loop)
+        try:
+            await asyncio.wait_for(client.reconnect(), timeout, loop=loop)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warn('Reconnecting to ActiveMQ failed: {}'.format(e))
+            attempt += 1
+        else:
+            logger.info('Reconnected to ActiveMQ')
+            return
+
+
 async def cancel_task(task):
     task.cancel()
     await task
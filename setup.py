@@ -22,7 +22,7 @@ setup(
     license=license,
     author='Mike Graves',
     author_email='mgraves@mit.edu',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['benchmarks', 'tests']),
     install_requires=requirements,
     entry_points={
         'console_scripts': [
@@ -2,6 +2,7 @@ from collections import namedtuple
 from functools import partial
 from unittest.mock import patch
 
+from aiohttp import ClientResponseError
 from aiohttp.streams import StreamReader
 
 
@@ -14,8 +15,12 @@ class Request:
         self.url = url
         self.args = args
         self.kwargs = kwargs
+        content = kwargs.get('content')
+        if content is None and kwargs.get('text') is not None:
+            content = kwargs['text'].encode('utf-8')
+        self._body = content
         self.content = StreamReader()
-        self.content.feed_data(kwargs.get('content'))
+        self.content.feed_data(content)
         self.content.feed_eof()
 
     def match(self, method, url):
@@ -31,7 +36,11 @@ class Request:
     def headers(self):
         return self.kwargs.get('headers', {})
 
-    def raise_for_status(self): ...
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise ClientResponseError(code=self.status)
+
+    def close(self): ...
 
     async def release(self): ...
 
@@ -41,6 +50,9 @@ class Request:
     async def text(self):
         return self.kwargs.get('text')
 
+    async def read(self):
+        return self._body
+
 
 class Mock:
     def __init__(self):
@@ -55,6 +67,7 @@ class Mock:
         instance.get.side_effect = partial(self._request, 'GET')
         instance.put.side_effect = partial(self._request, 'PUT')
         instance.post.side_effect = partial(self._request, 'POST')
+        instance.close.side_effect = self._close
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
@@ -68,6 +81,8 @@ class Mock:
     def called(self):
         return self.call_count > 0
 
+    async def _close(self): ...
+
     async def _request(self, method, url, *args, **kwargs):
         self.request_history.append(
             ClientRequest(method=method,
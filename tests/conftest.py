@@ -47,6 +47,12 @@ def thesis_1():
         return fp.read()
 
 
+@pytest.fixture
+def thesis_1_nt():
+    with open('tests/fixtures/thesis_1.nt', 'rb') as fp:
+        return fp.read()
+
+
 @pytest.fixture
 def thesis_1_pdf():
     with open('tests/fixtures/thesis_1.pdf', 'rb') as fp:
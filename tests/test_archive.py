@@ -1,10 +1,13 @@
+import asyncio
 import os
 import tempfile
+import time
 import zipfile
 
 import pytest
 
-from pit.archive import archive, Zip
+import pit.archive
+from pit.archive import archive, compression_for, Zip
 
 
 @pytest.yield_fixture
@@ -38,3 +41,85 @@ def test_archive_deletes_archive_on_error():
         with archive(fp.name):
             raise Exception
     assert not os.path.isfile(fp.name)
+
+
+class Chunks:
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.chunks:
+            raise StopAsyncIteration
+        return self.chunks.pop(0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('streaming', [True, False])
+async def test_zip_writes_stream_to_archive(streaming, monkeypatch):
+    if streaming and not pit.archive.STREAMING:
+        pytest.skip('ZipFile.open() cannot write on this Python')
+    monkeypatch.setattr(pit.archive, 'STREAMING', streaming)
+    with tempfile.TemporaryFile() as fp:
+        arx = Zip(fp)
+        await arx.write_stream(Chunks(b'foo', b'bar'), 'test.txt')
+        arx.close()
+        with zipfile.ZipFile(fp) as zf:
+            assert b'foobar' == zf.read('test.txt')
+
+
+@pytest.mark.parametrize('name,compression', [
+    ('thesis.pdf', zipfile.ZIP_STORED),
+    ('thesis.tar.gz', zipfile.ZIP_STORED),
+    ('scan.jpg', zipfile.ZIP_STORED),
+    ('thesis.txt', zipfile.ZIP_DEFLATED),
+    ('thesis', zipfile.ZIP_DEFLATED),
+])
+def test_compression_for_stores_compressed_types(name, compression):
+    assert compression_for(name) == compression
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('streaming', [True, False])
+async def test_zip_stores_pdfs_and_deflates_text(streaming, monkeypatch):
+    if streaming and not pit.archive.STREAMING:
+        pytest.skip('ZipFile.open() cannot write on this Python')
+    monkeypatch.setattr(pit.archive, 'STREAMING', streaming)
+    with tempfile.TemporaryFile() as fp:
+        arx = Zip(fp)
+        await arx.write_stream(Chunks(b'%PDF'), 'test.pdf')
+        await arx.write_stream(Chunks(b'foobar'), 'test.txt')
+        arx.close()
+        with zipfile.ZipFile(fp) as zf:
+            assert zf.getinfo('test.pdf').compress_type == zipfile.ZIP_STORED
+            assert zf.getinfo('test.txt').compress_type == \
+                zipfile.ZIP_DEFLATED
+            assert zf.read('test.pdf') == b'%PDF'
+
+
+@pytest.mark.asyncio
+async def test_zip_stays_valid_if_write_is_cancelled(event_loop,
+                                                     monkeypatch):
+    if not pit.archive.STREAMING:
+        pytest.skip('ZipFile.open() cannot write on this Python')
+    write = zipfile._ZipWriteFile.write
+
+    def slow_write(self, data):
+        time.sleep(0.1)
+        return write(self, data)
+
+    monkeypatch.setattr(zipfile._ZipWriteFile, 'write', slow_write)
+    with tempfile.TemporaryFile() as fp:
+        arx = Zip(fp, loop=event_loop)
+        task = asyncio.ensure_future(arx.write_stream(
+            Chunks(b'foo', b'bar'), 'test.txt'), loop=event_loop)
+        await asyncio.sleep(0.05, loop=event_loop)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        arx.close()
+        with zipfile.ZipFile(fp) as zf:
+            assert zf.testzip() is None
+            assert zf.read('test.txt') == b'foo'
@@ -3,7 +3,45 @@ from unittest.mock import Mock
 
 import pytest
 
-from pit.es import Index
+from aioes.exception import ConflictError
+
+from pit.es import (BulkIndex, BulkItemError, Index, IndexNotReady,
+                    doc_id)
+from pit.index import create_thesis
+from tests import air_mock
+
+
+class FakeElasticsearch:
+    """Just enough of an Elasticsearch client to store documents."""
+    def __init__(self):
+        self.docs = {}
+
+    async def index(self, index, doc_type, body, id, op_type='index',
+                    version=None, version_type=None):
+        old = self.docs.get(id)
+        if version_type == 'external' and old is not None and \
+                old[1] is not None and old[1] >= version:
+            raise ConflictError(409, 'version_conflict_engine_exception')
+        self.docs[id] = (dict(body), version)
+
+    async def get(self, index, id, doc_type):
+        return {'_source': self.docs[id][0]}
+
+    async def search(self, index, doc_type, body, scroll, size):
+        hits = [{'_index': index, '_id': id, '_source': doc}
+                for id, (doc, _) in self.docs.items()]
+        if body.get('sort'):
+            hits.sort(key=lambda h: h['_source'][body['sort'][0]])
+        self._pages = [hits[i:i + size] for i in range(0, len(hits), size)]
+        return await self.scroll('s', scroll)
+
+    async def scroll(self, scroll_id, scroll):
+        page = self._pages.pop(0) if self._pages else []
+        return {'_scroll_id': scroll_id, 'hits': {'hits': page}}
+
+    async def bulk(self, body):
+        for action in body:
+            del self.docs[action['delete']['_id']]
 
 
 @pytest.mark.asyncio
@@ -28,6 +66,28 @@ async def test_new_version_creates_new_version():
     assert v.startswith('theses-')
 
 
+@pytest.mark.asyncio
+async def test_new_version_can_disable_refresh_and_replicas():
+    es = Mock()
+    es.indices.create.side_effect = coroutine(Mock())
+    idx = Index(es, 'theses')
+    await idx.new_version(bulk_load=True)
+    settings = es.indices.create.call_args[0][1]['settings']['index']
+    assert settings == {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+
+@pytest.mark.asyncio
+async def test_settings_returns_current_version_settings():
+    es = Mock()
+    es.indices.exists_alias.side_effect = coroutine(Mock(return_value=True))
+    es.indices.get_settings.side_effect = coroutine(Mock(return_value={
+        'v1': {'settings': {'index': {'number_of_replicas': '2',
+                                      'number_of_shards': '5'}}}}))
+    idx = Index(es, 'theses')
+    assert await idx.settings() == {'refresh_interval': '1s',
+                                    'number_of_replicas': '2'}
+
+
 @pytest.mark.asyncio
 async def test_versions_lists_current_versions():
     es = Mock()
@@ -58,6 +118,42 @@ async def test_set_current_sets_new_version():
                 {'add': {'index': 'v3', 'alias': 'theses'}}]})
 
 
+@pytest.mark.asyncio
+async def test_set_current_restores_settings_before_moving_alias():
+    es = Mock()
+    calls = []
+    es.transport.perform_request.side_effect = coroutine(
+        Mock(side_effect=lambda *a, **kw: calls.append('merge')))
+    es.indices.put_settings.side_effect = coroutine(
+        Mock(side_effect=lambda *a: calls.append('settings')))
+    es.cluster.health.side_effect = coroutine(Mock(
+        side_effect=lambda *a, **kw: calls.append('health') or {}))
+    es.indices.exists_alias.side_effect = coroutine(Mock(return_value=False))
+    es.indices.update_aliases.side_effect = coroutine(
+        Mock(side_effect=lambda *a: calls.append('alias')))
+    idx = Index(es, 'theses')
+    await idx.set_current('v2', settings={'number_of_replicas': 1},
+                          max_num_segments=1)
+    assert calls == ['merge', 'settings', 'health', 'alias']
+    es.indices.put_settings.assert_called_with(
+        {'index': {'number_of_replicas': 1}}, 'v2')
+    assert es.cluster.health.call_args[1]['wait_for_status'] == 'yellow'
+
+
+@pytest.mark.asyncio
+async def test_set_current_deletes_version_that_is_not_ready():
+    es = Mock()
+    es.indices.put_settings.side_effect = coroutine(Mock())
+    es.indices.delete.side_effect = coroutine(Mock())
+    es.cluster.health.side_effect = coroutine(
+        Mock(return_value={'timed_out': True}))
+    idx = Index(es, 'theses')
+    with pytest.raises(IndexNotReady):
+        await idx.set_current('v2', settings={'number_of_replicas': 1})
+    assert not es.indices.update_aliases.called
+    es.indices.delete.assert_called_once_with(index='v2')
+
+
 @pytest.mark.asyncio
 async def test_set_current_removes_old_versions():
     es = Mock()
@@ -72,3 +168,179 @@ async def test_set_current_removes_old_versions():
                 {'remove': {'index': 'v1', 'alias': 'theses'}},
                 {'add': {'index': 'v2', 'alias': 'theses'}}]})
     es.indices.delete.assert_called_with(index='v1')
+
+
+@pytest.mark.asyncio
+async def test_add_many_sends_bulk_request():
+    es = Mock()
+    es.bulk.side_effect = coroutine(Mock(return_value={'items': [
+        {'index': {'status': 201}}, {'index': {'status': 201}}]}))
+    idx = Index(es, 'theses')
+    errors = await idx.add_many([{'uri': 'foo'}, {'uri': 'bar'}])
+    body = es.bulk.call_args[0][0]
+    assert body[0] == {'index': {'_index': 'theses', '_type': 'thesis',
+                                 '_id': doc_id('foo')}}
+    assert body[1] == {'uri': 'foo'}
+    assert body[3] == {'uri': 'bar'}
+    assert errors == [None, None]
+
+
+@pytest.mark.asyncio
+async def test_add_many_returns_item_errors():
+    es = Mock()
+    es.bulk.side_effect = coroutine(Mock(return_value={'items': [
+        {'index': {'status': 400, 'error': 'bad'}},
+        {'index': {'status': 201}}]}))
+    idx = Index(es, 'theses')
+    assert await idx.add_many([{'uri': 'foo'}, {'uri': 'bar'}]) == \
+        ['bad', None]
+
+
+@pytest.mark.asyncio
+async def test_add_many_uses_external_versions():
+    es = Mock()
+    es.bulk.side_effect = coroutine(Mock(return_value={'items': [
+        {'index': {'status': 409, 'error': 'version_conflict'}}]}))
+    idx = Index(es, 'theses', versioned=True)
+    errors = await idx.add_many([{'uri': 'foo',
+                                  'modified': '2017-01-01T00:00:00Z'}])
+    action = es.bulk.call_args[0][0][0]['index']
+    assert action['_version'] == 1483228800000
+    assert action['_version_type'] == 'external'
+    assert errors == [None]
+
+
+def test_doc_id_is_stable():
+    assert doc_id('http://example.com/1') == doc_id('http://example.com/1')
+    assert doc_id('http://example.com/1') != doc_id('http://example.com/2')
+
+
+@pytest.mark.asyncio
+async def test_add_uses_stable_id():
+    es = Mock()
+    es.index.side_effect = coroutine(Mock())
+    idx = Index(es, 'theses')
+    await idx.add({'uri': 'foo'})
+    assert es.index.call_args[0][3] == doc_id('foo')
+
+
+@pytest.mark.asyncio
+async def test_add_ignores_version_conflicts():
+    es = Mock()
+    es.index.side_effect = coroutine(Mock(side_effect=ConflictError(
+        409, 'version_conflict', {})))
+    idx = Index(es, 'theses', versioned=True)
+    await idx.add({'uri': 'foo', 'modified': '2017-01-01T00:00:00Z'})
+    assert es.index.call_args[1]['version_type'] == 'external'
+
+
+@pytest.mark.asyncio
+async def test_dedupe_keeps_one_copy_under_stable_id():
+    es = Mock()
+    hits = [{'_index': 'v1', '_id': 'a', '_source': {
+                'uri': 'foo', 'modified': '2017-01-01T00:00:00Z'}},
+            {'_index': 'v1', '_id': 'b', '_source': {
+                'uri': 'foo', 'modified': '2017-02-01T00:00:00Z'}},
+            {'_index': 'v1', '_id': doc_id('bar'), '_source': {'uri': 'bar'}}]
+    es.search.side_effect = coroutine(Mock(return_value={
+        '_scroll_id': 's', 'hits': {'hits': hits}}))
+    es.scroll.side_effect = coroutine(Mock(return_value={
+        '_scroll_id': 's', 'hits': {'hits': []}}))
+    es.get.side_effect = coroutine(Mock(return_value={
+        '_source': {'uri': 'foo', 'title': 'Newest'}}))
+    es.index.side_effect = coroutine(Mock())
+    es.bulk.side_effect = coroutine(Mock())
+    idx = Index(es, 'theses')
+    assert await idx.dedupe() == 2
+    es.get.assert_called_once_with('v1', 'b', 'thesis')
+    assert es.index.call_args[0][2] == {'uri': 'foo', 'title': 'Newest'}
+    assert es.index.call_args[0][3] == doc_id('foo')
+    deleted = [a['delete']['_id'] for a in es.bulk.call_args[0][0]]
+    assert deleted == ['a', 'b']
+
+
+@pytest.mark.asyncio
+async def test_bulk_index_flushes_when_full(event_loop):
+    idx = Mock()
+    idx.add_many.side_effect = coroutine(Mock(return_value=[None, None]))
+    bulk = BulkIndex(idx, size=2, loop=event_loop)
+    await bulk.add({'uri': 'foo'})
+    assert not idx.add_many.called
+    await bulk.add({'uri': 'bar'})
+    idx.add_many.assert_called_once_with([{'uri': 'foo'}, {'uri': 'bar'}])
+    assert bulk.indexed == 2
+
+
+@pytest.mark.asyncio
+async def test_bulk_index_flushes_on_bytes(event_loop):
+    idx = Mock()
+    idx.add_many.side_effect = coroutine(Mock(return_value=[None]))
+    bulk = BulkIndex(idx, size=10, max_bytes=10, loop=event_loop)
+    await bulk.add({'full_text': 'a' * 20})
+    assert idx.add_many.called
+
+
+@pytest.mark.asyncio
+async def test_bulk_index_flushes_after_interval(event_loop):
+    idx = Mock()
+    idx.add_many.side_effect = coroutine(Mock(return_value=[None]))
+    bulk = BulkIndex(idx, size=10, interval=0.01, loop=event_loop)
+    fut = await bulk.add({'uri': 'foo'})
+    assert await fut == 'foo'
+    assert idx.add_many.called
+
+
+@pytest.mark.asyncio
+async def test_bulk_index_isolates_rejected_documents(event_loop):
+    idx = Mock()
+    idx.add_many.side_effect = coroutine(Mock(return_value=['bad', None]))
+    bulk = BulkIndex(idx, size=2, loop=event_loop)
+    f1 = await bulk.add({'uri': 'foo'})
+    f2 = await bulk.add({'uri': 'bar'})
+    with pytest.raises(BulkItemError):
+        await f1
+    assert await f2 == 'bar'
+    assert bulk.failed == 1
+    assert bulk.indexed == 1
+
+
+@pytest.mark.asyncio
+async def test_modified_maps_uris_to_modification_times():
+    es = Mock()
+    es.search.side_effect = coroutine(Mock(return_value={
+        '_scroll_id': '1', 'hits': {'hits': [
+            {'_source': {'uri': 'foo', 'modified': '2016-01-01T00:00:00Z'}},
+            {'_source': {'uri': 'bar'}}]}}))
+    es.scroll.side_effect = coroutine(Mock(return_value={
+        '_scroll_id': '1', 'hits': {'hits': []}}))
+    idx = Index(es, 'theses')
+    assert await idx.modified() == {'foo': '2016-01-01T00:00:00Z',
+                                    'bar': None}
+
+
+@pytest.mark.asyncio
+async def test_dedupe_keeps_newest_copy_of_indexed_theses(thesis_1,
+                                                          thesis_2):
+    es = FakeElasticsearch()
+    idx = Index(es, 'theses', versioned=True)
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses/1', text=thesis_1)
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        m.get('mock://example.com/theses/2', text=thesis_2)
+        m.get('mock://example.com/theses/2/2.txt', text='FOOBAR')
+        thesis = await create_thesis('mock://example.com/theses/1')
+        other = await create_thesis('mock://example.com/theses/2')
+    # Copies left by older versions of pit, under random IDs.
+    stale = dict(thesis, modified='2016-01-01T00:00:00+00:00',
+                 title=['Stale'])
+    es.docs['a'] = (stale, None)
+    es.docs['b'] = (thesis, None)
+    es.docs['c'] = (stale, None)
+    await idx.add(other)
+    await idx.add(other)
+    assert await idx.dedupe(batch=1) == 3
+    assert sorted(es.docs) == sorted([doc_id('mock://example.com/theses/1'),
+                                      doc_id('mock://example.com/theses/2')])
+    kept = es.docs[doc_id('mock://example.com/theses/1')]
+    assert kept[0] == thesis
+    assert kept[1] is not None
@@ -0,0 +1,124 @@
+import pytest
+
+from tests import air_mock
+from pit.cache import Cache
+from pit.fedora import Client
+
+
+@pytest.mark.asyncio
+async def test_client_gets_url():
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/foo', text='FOOBAR')
+        c = Client()
+        resp = await c.get('mock://example.com/foo')
+        assert await resp.text() == 'FOOBAR'
+
+
+@pytest.mark.asyncio
+async def test_client_reuses_session():
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/foo')
+        m.get('mock://example.com/bar')
+        c = Client()
+        await c.get('mock://example.com/foo')
+        await c.get('mock://example.com/bar')
+        assert m.call_count == 2
+        assert c.session.get.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_client_closes_session():
+    with air_mock.Mock():
+        c = Client()
+        await c.close()
+        assert c.session.close.called
+
+
+@pytest.fixture
+def cache(tmpdir):
+    c = Cache(str(tmpdir))
+    yield c
+    c.close()
+
+
+@pytest.mark.asyncio
+async def test_client_stores_response_in_cache(cache):
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/foo', content=b'FOOBAR',
+              headers={'ETag': '"1"', 'Content-Type': 'text/n3'})
+        c = Client(cache=cache)
+        resp = await c.get('mock://example.com/foo')
+        assert await resp.read() == b'FOOBAR'
+        assert cache.get(cache.key('mock://example.com/foo', {})).etag == \
+            '"1"'
+        assert cache.misses == 1
+
+
+@pytest.mark.asyncio
+async def test_client_streams_responses_that_are_not_rdf(cache):
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/foo.txt', content=b'FOOBAR',
+              headers={'ETag': '"1"', 'Content-Type': 'text/plain',
+                       'Content-Length': '6'})
+        c = Client(cache=cache)
+        resp = await c.get('mock://example.com/foo.txt')
+        assert resp is m.requests[0]
+        assert cache.size == 0
+        assert cache.misses == 0
+
+
+def test_cache_does_not_store_large_bodies(tmpdir):
+    cache = Cache(str(tmpdir), max_entry_size=5)
+    entry = cache.put('a', {'ETag': '"a"'}, b'aaaaaa')
+    assert entry.body == b'aaaaaa'
+    assert cache.get('a') is None
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_client_serves_not_modified_from_cache(cache):
+    cache.put(cache.key('mock://example.com/foo', {'Accept': 'text/plain'}),
+              {'ETag': '"1"',
+               'Last-Modified': 'Tue, 01 Nov 2016 00:00:00 GMT'}, b'FOOBAR')
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/foo', status=304)
+        c = Client(cache=cache)
+        resp = await c.get('mock://example.com/foo',
+                           headers={'Accept': 'text/plain'})
+        assert await resp.text() == 'FOOBAR'
+        assert m.request_history[0].headers['If-None-Match'] == '"1"'
+        assert m.request_history[0].headers['If-Modified-Since'] == \
+            'Tue, 01 Nov 2016 00:00:00 GMT'
+        assert cache.hits == 1
+        assert cache.bytes_saved == 6
+
+
+@pytest.mark.asyncio
+async def test_client_passes_through_uncacheable_response(cache):
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/foo', content=b'FOOBAR')
+        c = Client(cache=cache)
+        resp = await c.get('mock://example.com/foo')
+        assert resp is m.requests[0]
+        assert cache.size == 0
+        assert cache.misses == 0
+
+
+def test_cache_evicts_least_recently_used(tmpdir):
+    cache = Cache(str(tmpdir), max_size=10)
+    cache.put('a', {'ETag': '"a"'}, b'aaaaa')
+    cache.put('b', {'ETag': '"b"'}, b'bbbbb')
+    cache.hit(cache.get('a'))
+    cache.put('c', {'ETag': '"c"'}, b'ccccc')
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.size == 10
+    cache.db.close()
+
+
+def test_cache_persists_entries(tmpdir):
+    Cache(str(tmpdir)).put('a', {'ETag': '"a"'}, b'aaaaa')
+    cache = Cache(str(tmpdir))
+    assert cache.get('a').body == b'aaaaa'
+    assert cache.size == 5
+    cache.db.close()
@@ -1,17 +1,32 @@
+import asyncio
 from asyncio import coroutine
+from datetime import datetime, timezone
 import json
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
+from aioes.exception import ConnectionError, TransportError
+import aiohttp
 import pytest
 from rdflib import Graph
 
 from tests import air_mock
-from pit.index import (create_thesis,
+from pit.es import BulkItemError
+from pit.fedora import Client
+from pit.parse import ParsePool
+from pit.spool import Spool
+from pit.index import (_uri_from_json,
+                       ChangeFilter,
+                       Coalescer,
+                       create_thesis,
                        indexable,
                        index_collection,
                        index_thesis,
                        Indexer,
+                       parse_datetime,
+                       QueueExecutor,
+                       thesis_document,
                        ThesisResource,
+                       transient,
                        uri_from_message,)
 
 
@@ -27,6 +42,26 @@ def test_uri_from_message_returns_uri():
     assert uri_from_message(msg) == 'mock://example.com/1'
 
 
+@pytest.mark.parametrize('fixture', ['activitystreams', 'expanded',
+                                     'expanded_array', 'graph'])
+def test_uri_from_message_decodes_recorded_messages(fixture):
+    with open('tests/fixtures/messages/{}.json'.format(fixture)) as fp:
+        msg = fp.read()
+    assert uri_from_message(msg) == 'mock://example.com/theses/1'
+
+
+def test_uri_from_json_reads_top_level_node_list():
+    with open('tests/fixtures/messages/expanded_array.json') as fp:
+        msg = fp.read()
+    assert _uri_from_json(msg) == 'mock://example.com/theses/1'
+
+
+def test_uri_from_message_falls_back_to_rdflib():
+    msg = ('{"@context": {"Object": {"@id": "http://pcdm.org/models#Object"}},'
+           '"@id": "mock://example.com/1", "@type": "Object"}')
+    assert uri_from_message(msg) == 'mock://example.com/1'
+
+
 def test_indexable_returns_true_for_indexable_events():
     assert indexable({
         'org.fcrepo.jms.resourceType': 'http://pcdm.org/models#Object',
@@ -52,7 +87,7 @@ async def test_create_thesis_fetches_full_text(thesis_1):
 async def test_index_thesis_adds_thesis(thesis_1):
     with air_mock.Mock() as m:
         es = Mock()
-        es.add.side_effect = coroutine(Mock())
+        es.add.side_effect = coroutine(Mock(return_value=None))
         m.get('mock://example.com/theses/1', text=thesis_1)
         m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
         t = await index_thesis(es, 'mock://example.com/theses/1')
@@ -81,7 +116,7 @@ async def test_index_collection_adds_each_item(theses, thesis_1, thesis_2):
 @pytest.mark.asyncio
 async def test_indexer_adds_indexable_item(thesis_1):
     es = Mock()
-    es.add.side_effect = coroutine(Mock())
+    es.add.side_effect = coroutine(Mock(return_value=None))
     headers = {'org.fcrepo.jms.resourceType': 'http://pcdm.org/models#Object',
                'org.fcrepo.jms.eventType': 'http://fedora.info/definitions/'
                                            'v4/event#ResourceModification',
@@ -97,22 +132,441 @@ async def test_indexer_adds_indexable_item(thesis_1):
         assert es.add.called
 
 
-def test_thesis_properties_return_mutliple(graph):
+def test_thesis_resource_returns_document(graph):
     t = ThesisResource(graph, None)
-    assert 'Title 1' in t.title
-    assert 'Title 2' in t.title
+    doc = t.document
+    assert sorted(doc['title']) == ['Title 1', 'Title 2']
+    assert 'This is an abstract' in doc['abstract']
+    assert 'Baz, Foo' in doc['advisor']
+    assert 'Bar' in doc['author']
+    assert doc['copyright_date'] == [2001]
+    assert 'Engineering' in doc['degree']
+    assert 'Comp Sci' in doc['department']
+    assert 'This is a thesis' in doc['description']
+    assert 'http://handle.org/1' in doc['handle']
+    assert doc['published_date'] == [2002]
+    assert t.uri == 'mock://example.com/theses/1'
 
 
-def test_thesis_resource_returns_properties(graph):
-    t = ThesisResource(graph, None)
-    assert 'This is an abstract' in t.abstract
-    assert 'Baz, Foo' in t.advisor
-    assert 'Bar' in t.author
-    assert '2001' in t.copyright_date
-    assert 'Engineering' in t.degree
-    assert 'Comp Sci' in t.department
-    assert 'This is a thesis' in t.description
-    assert 'http://handle.org/1' in t.handle
-    assert '2002' in t.published_date
-    assert 'Title 1' in t.title
-    assert t.uri == 'mock://example.com/theses/1'
+@pytest.mark.asyncio
+async def test_index_collection_uses_bulk_api(theses, thesis_1, thesis_2):
+    es = Mock()
+    es.add_many.side_effect = coroutine(Mock(return_value=[None, None]))
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses', text=theses)
+        m.get('mock://example.com/theses/1', text=thesis_1)
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        m.get('mock://example.com/theses/2', text=thesis_2)
+        m.get('mock://example.com/theses/2/2.txt', text='FOOBAZ')
+        await index_collection('mock://example.com/theses', es, bulk_size=10)
+        assert es.add_many.call_count == 1
+        assert not es.add.called
+        assert len(es.add_many.call_args[0][0]) == 2
+
+
+@pytest.mark.asyncio
+async def test_index_collection_reports_theses_once_written(theses, thesis_1,
+                                                            thesis_2):
+    es = Mock()
+    es.add_many.side_effect = coroutine(Mock(return_value=[None, 'Nope']))
+    with air_mock.Mock() as m, \
+            patch('pit.index.logging.getLogger') as getLogger:
+        m.get('mock://example.com/theses', text=theses)
+        m.get('mock://example.com/theses/1', text=thesis_1)
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        m.get('mock://example.com/theses/2', text=thesis_2)
+        m.get('mock://example.com/theses/2/2.txt', text='FOOBAZ')
+        await index_collection('mock://example.com/theses', es, bulk_size=10)
+        await asyncio.sleep(0)
+    indexed = [c[0][0] for c in getLogger.return_value.info.call_args_list
+               if c[0][0].startswith('Indexed')]
+    assert len(indexed) == 1
+
+
+@pytest.mark.asyncio
+async def test_create_thesis_uses_client(thesis_1):
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses/1', text=thesis_1)
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        client = Client()
+        await create_thesis('mock://example.com/theses/1', client)
+        assert client.session.get.call_count == 2
+        assert not client.session.close.called
+
+
+@pytest.mark.asyncio
+async def test_index_collection_streams_members(thesis_1, thesis_2):
+    es = Mock()
+    es.add.side_effect = coroutine(Mock())
+    listing = (b'<mock://example.com/theses> '
+               b'<http://www.w3.org/ns/ldp#contains> '
+               b'<mock://example.com/theses/1> .\n'
+               b'<mock://example.com/theses> '
+               b'<http://www.w3.org/ns/ldp#contains> '
+               b'<mock://example.com/theses/2> .\n')
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses', content=listing)
+        m.get('mock://example.com/theses/1', text=thesis_1)
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        m.get('mock://example.com/theses/2', text=thesis_2)
+        m.get('mock://example.com/theses/2/2.txt', text='FOOBAZ')
+        await index_collection('mock://example.com/theses', es, stream=True)
+        assert es.add.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_queue_executor_maps_over_items(event_loop):
+    async def double(x):
+        return x * 2
+    ex = QueueExecutor(size=2, maxsize=1, loop=event_loop)
+    results = []
+    async for fut in ex.map(double, range(10)):
+        results.append(fut.result())
+    assert sorted(results) == [x * 2 for x in range(10)]
+
+
+@pytest.mark.asyncio
+async def test_queue_executor_bounds_pending_items(event_loop):
+    fed = []
+
+    def items():
+        for x in range(100):
+            fed.append(x)
+            yield x
+
+    async def ident(x):
+        return x
+    ex = QueueExecutor(size=1, maxsize=2, loop=event_loop)
+    it = ex.map(ident, items())
+    await it.__anext__()
+    assert len(fed) < 10
+    it.cancel()
+
+
+@pytest.mark.asyncio
+async def test_queue_executor_returns_exceptions(event_loop):
+    async def fail(x):
+        raise ValueError(x)
+    ex = QueueExecutor(size=2, loop=event_loop)
+    async for fut in ex.map(fail, [1]):
+        with pytest.raises(ValueError):
+            fut.result()
+
+
+@pytest.mark.asyncio
+async def test_queue_executor_cancel_stops_workers(event_loop):
+    calls = []
+
+    async def work(x):
+        calls.append(x)
+        await asyncio.sleep(0, loop=event_loop)
+        return x
+    ex = QueueExecutor(size=2, maxsize=1, loop=event_loop)
+    results = ex.map(work, range(100))
+    async for fut in results:
+        break
+    results.cancel()
+    await asyncio.sleep(0.01, loop=event_loop)
+    assert all(w.done() for w in results._workers)
+    assert len(calls) < 10
+
+
+@pytest.mark.asyncio
+async def test_queue_executor_finishes_when_worker_is_cancelled(event_loop):
+    async def work(x):
+        if x == 2:
+            raise asyncio.CancelledError()
+        return x
+    ex = QueueExecutor(size=2, maxsize=1, loop=event_loop)
+
+    async def consume():
+        results = []
+        async for f in ex.map(work, [1, 2, 3]):
+            results.append(f.result())
+        return results
+    results = await asyncio.wait_for(consume(), 1, loop=event_loop)
+    assert sorted(results) == [1, 3]
+
+
+@pytest.mark.asyncio
+async def test_coalescer_collapses_duplicate_events(event_loop):
+    calls = []
+
+    async def func(uri):
+        calls.append(uri)
+        return uri
+    c = Coalescer(func, quiet=0.01, loop=event_loop)
+    f1 = c.submit('mock://example.com/theses/1')
+    f2 = c.submit('mock://example.com/theses/1')
+    c.submit('mock://example.com/theses/2')
+    assert f1 is f2
+    assert await f1 == 'mock://example.com/theses/1'
+    await c.flush()
+    assert sorted(calls) == ['mock://example.com/theses/1',
+                             'mock://example.com/theses/2']
+    assert c.received == 3
+    assert c.absorbed == 1
+    assert c.dispatched == 2
+
+
+@pytest.mark.asyncio
+async def test_coalescer_caps_delay(event_loop):
+    async def func(uri):
+        return uri
+    c = Coalescer(func, quiet=10, max_delay=0.01, loop=event_loop)
+    fut = c.submit('mock://example.com/theses/1')
+    await asyncio.wait_for(fut, 1, loop=event_loop)
+    assert c.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_indexer_raises_if_write_fails(thesis_1, event_loop):
+    written = asyncio.Future(loop=event_loop)
+    written.set_exception(Exception('rejected'))
+    es = Mock()
+    es.add.side_effect = coroutine(Mock(return_value=written))
+    headers = {'org.fcrepo.jms.resourceType': 'http://pcdm.org/models#Object',
+               'org.fcrepo.jms.eventType': 'http://fedora.info/definitions/'
+                                           'v4/event#ResourceModification',
+               'message-id': '1234'}
+    body = {'@id': 'mock://example.com/theses/1',
+            '@type': 'http://pcdm.org/models#Object'}
+    with air_mock.Mock() as m:
+        frame = Mock(headers=headers, body=json.dumps(body))
+        idxer = Indexer(es)
+        m.get('mock://example.com/theses/1', text=thesis_1)
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        with pytest.raises(Exception):
+            await idxer.on_message(frame)
+
+
+@pytest.mark.asyncio
+async def test_indexer_spools_failed_theses(thesis_1, tmpdir):
+    es = Mock()
+    es.add.side_effect = coroutine(Mock(
+        side_effect=ConnectionError('N/A', 'ES down', None)))
+    spool = Spool(str(tmpdir.join('spool.db')))
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses/1', text=thesis_1)
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        idxer = Indexer(es, spool=spool)
+        await idxer.index_uri('mock://example.com/theses/1')
+    assert es.add.called
+    assert spool.take(10) == ['mock://example.com/theses/1']
+
+
+@pytest.mark.asyncio
+async def test_indexer_raises_permanent_errors_with_spool(thesis_1, tmpdir):
+    es = Mock()
+    es.add.side_effect = coroutine(Mock(
+        side_effect=BulkItemError({'type': 'mapper_parsing_exception'})))
+    spool = Spool(str(tmpdir.join('spool.db')))
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses/1', text=thesis_1)
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        idxer = Indexer(es, spool=spool)
+        with pytest.raises(BulkItemError):
+            await idxer.index_uri('mock://example.com/theses/1')
+    assert len(spool) == 0
+
+
+@pytest.mark.parametrize('exc,expected', [
+    (ConnectionError('N/A', 'refused', None), True),
+    (TransportError(503, 'unavailable', None), True),
+    (TransportError(400, 'bad request', None), False),
+    (asyncio.TimeoutError(), True),
+    (aiohttp.ClientOSError(), True),
+    (BulkItemError({'type': 'es_rejected_execution_exception'}), True),
+    (BulkItemError({'type': 'mapper_parsing_exception'}), False),
+    (ValueError('bad RDF'), False),
+])
+def test_transient_classifies_errors(exc, expected):
+    assert transient(exc) == expected
+
+
+@pytest.mark.asyncio
+async def test_indexer_drops_permanent_failures_from_spool(tmpdir):
+    es = Mock()
+    es.healthy.side_effect = coroutine(Mock(return_value=True))
+    spool = Spool(str(tmpdir.join('spool.db')))
+    spool.add('mock://example.com/theses/1')
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses/1', text='not RDF',
+              headers={'Content-Type': 'text/n3'})
+        idxer = Indexer(es, spool=spool)
+        assert await idxer.drain(max_attempts=10) == 0
+    assert len(spool) == 0
+
+
+@pytest.mark.asyncio
+async def test_indexer_keeps_spooled_theses_during_fedora_outage(tmpdir):
+    es = Mock()
+    es.healthy.side_effect = coroutine(Mock(return_value=True))
+    spool = Spool(str(tmpdir.join('spool.db')))
+    spool.add('mock://example.com/theses/1')
+    client = Mock()
+    client.get.side_effect = coroutine(Mock(side_effect=ConnectionResetError))
+    client.request.side_effect = coroutine(
+        Mock(side_effect=ConnectionRefusedError))
+    idxer = Indexer(es, client=client, spool=spool)
+    for _ in range(3):
+        assert await idxer.drain(max_attempts=1) == 0
+    assert spool.take(10) == ['mock://example.com/theses/1']
+
+
+@pytest.mark.asyncio
+async def test_indexer_drops_theses_that_keep_failing(tmpdir):
+    es = Mock()
+    es.healthy.side_effect = coroutine(Mock(return_value=True))
+    spool = Spool(str(tmpdir.join('spool.db')))
+    spool.add('mock://example.com/theses/1')
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses/1', status=500)
+        m.request('HEAD', 'mock://example.com/theses/1')
+        idxer = Indexer(es, spool=spool)
+        assert await idxer.drain(max_attempts=1) == 0
+    assert len(spool) == 0
+
+
+@pytest.mark.asyncio
+async def test_indexer_drains_spool(thesis_1, tmpdir):
+    es = Mock()
+    es.add.side_effect = coroutine(Mock(return_value=None))
+    es.healthy.side_effect = coroutine(Mock(return_value=True))
+    spool = Spool(str(tmpdir.join('spool.db')))
+    spool.add('mock://example.com/theses/1')
+    spool.add('mock://example.com/theses/2')
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses/1', text=thesis_1)
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        idxer = Indexer(es, spool=spool)
+        assert await idxer.drain(max_attempts=1) == 1
+    assert es.add.call_count == 1
+    assert len(spool) == 0
+
+
+@pytest.mark.asyncio
+async def test_indexer_does_not_drain_if_index_is_down(tmpdir):
+    es = Mock()
+    es.healthy.side_effect = coroutine(Mock(return_value=False))
+    spool = Spool(str(tmpdir.join('spool.db')))
+    spool.add('mock://example.com/theses/1')
+    idxer = Indexer(es, spool=spool)
+    assert await idxer.drain() == 0
+    assert len(spool) == 1
+
+
+@pytest.mark.asyncio
+async def test_indexer_coalesces_messages(thesis_1):
+    es = Mock()
+    es.add.side_effect = coroutine(Mock(return_value=None))
+    headers = {'org.fcrepo.jms.resourceType': 'http://pcdm.org/models#Object',
+               'org.fcrepo.jms.eventType': 'http://fedora.info/definitions/'
+                                           'v4/event#ResourceModification',
+               'message-id': '1234'}
+    body = {'@id': 'mock://example.com/theses/1',
+            '@type': 'http://pcdm.org/models#Object'}
+    with air_mock.Mock() as m:
+        frame = Mock(headers=headers, body=json.dumps(body))
+        idxer = Indexer(es, quiet=0.01)
+        m.get('mock://example.com/theses/1', text=thesis_1)
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        await asyncio.gather(idxer.on_message(frame),
+                             idxer.on_message(frame))
+        assert es.add.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_create_thesis_parses_ntriples(thesis_1_nt):
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses/1', content=thesis_1_nt,
+              headers={'Content-Type': 'application/n-triples'})
+        m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+        t = await create_thesis('mock://example.com/theses/1')
+        assert t['handle'] == ['http://handle.org/1']
+        assert sorted(t['title']) == ['Title 1', 'Title 2']
+        assert t['full_text'] == 'FOOBAR'
+
+
+@pytest.mark.asyncio
+async def test_create_thesis_parses_in_pool(thesis_1_nt, event_loop):
+    pool = ParsePool(2, event_loop)
+    try:
+        with air_mock.Mock() as m:
+            m.get('mock://example.com/theses/1', content=thesis_1_nt,
+                  headers={'Content-Type': 'application/n-triples'})
+            m.get('mock://example.com/theses/1/1.txt', text='FOOBAR')
+            t = await create_thesis('mock://example.com/theses/1',
+                                    pool=pool)
+            assert t['handle'] == ['http://handle.org/1']
+            assert t['full_text'] == 'FOOBAR'
+    finally:
+        pool.close()
+
+
+def test_thesis_document_returns_text_file(thesis_1):
+    doc, text_uri = thesis_document(thesis_1.encode('utf-8'), 'text/n3')
+    assert doc['handle'] == ['http://handle.org/1']
+    assert text_uri == 'mock://example.com/theses/1/1.txt'
+
+
+def test_thesis_document_includes_modification_time(thesis_1, thesis_1_nt):
+    n3, _ = thesis_document(thesis_1.encode('utf-8'), 'text/n3')
+    nt, _ = thesis_document(thesis_1_nt, 'application/n-triples')
+    assert n3['modified'] == '2017-04-28T14:00:00+00:00'
+    assert nt['modified'] == '2017-04-28T14:00:00+00:00'
+
+
+def test_parse_datetime_parses_formats():
+    utc = datetime(2016, 11, 1, 12, 30, 5, tzinfo=timezone.utc)
+    assert parse_datetime('Tue, 01 Nov 2016 12:30:05 GMT') == utc
+    assert parse_datetime('2016-11-01T12:30:05Z') == utc
+    assert parse_datetime('2016-11-01T12:30:05') == utc
+    assert parse_datetime('2016-11-01T08:30:05.000-04:00') == utc
+    assert parse_datetime('2016-11-01T12:30:05.25Z').microsecond == 250000
+    assert parse_datetime('yesterday') is None
+
+
+@pytest.mark.asyncio
+async def test_change_filter_compares_to_watermark():
+    with air_mock.Mock() as m:
+        m.request('HEAD', 'mock://example.com/theses/1',
+                  headers={'Last-Modified': 'Tue, 01 Nov 2016 00:00:00 GMT'})
+        c = ChangeFilter(Client(), since='2016-10-01T00:00:00Z')
+        assert await c.changed('mock://example.com/theses/1')
+        c = ChangeFilter(Client(), since='2016-12-01T00:00:00Z')
+        assert not await c.changed('mock://example.com/theses/1')
+
+
+@pytest.mark.asyncio
+async def test_change_filter_compares_to_index():
+    with air_mock.Mock() as m:
+        m.request('HEAD', 'mock://example.com/theses/1',
+                  headers={'Last-Modified': 'Tue, 01 Nov 2016 00:00:00 GMT'})
+        m.request('HEAD', 'mock://example.com/theses/2',
+                  headers={'Last-Modified': 'Tue, 01 Nov 2016 00:00:00 GMT'})
+        c = ChangeFilter(Client(), indexed={
+            'mock://example.com/theses/1': '2016-11-01T00:00:00.123Z'})
+        assert not await c.changed('mock://example.com/theses/1')
+        assert await c.changed('mock://example.com/theses/2')
+
+
+@pytest.mark.asyncio
+async def test_index_collection_skips_unchanged_theses(theses, thesis_2):
+    es = Mock()
+    es.add.side_effect = coroutine(Mock())
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses', text=theses)
+        m.request('HEAD', 'mock://example.com/theses/1',
+                  headers={'Last-Modified': 'Tue, 01 Nov 2016 00:00:00 GMT'})
+        m.request('HEAD', 'mock://example.com/theses/2',
+                  headers={'Last-Modified': 'Thu, 01 Dec 2016 00:00:00 GMT'})
+        m.get('mock://example.com/theses/2', text=thesis_2)
+        m.get('mock://example.com/theses/2/2.txt', text='FOOBAZ')
+        client = Client()
+        changes = ChangeFilter(client, since='2016-11-15T00:00:00Z')
+        await index_collection('mock://example.com/theses', es, client,
+                               changes=changes)
+        assert es.add.call_count == 1
+        assert es.add.call_args[0][0]['uri'] == 'mock://example.com/theses/2'
+        assert changes.unchanged == 1
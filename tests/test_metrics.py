@@ -0,0 +1,70 @@
+import aiohttp
+import pytest
+
+from pit.metrics import Counter, Gauge, Histogram, render, serve
+
+
+def test_counter_renders_labelled_values():
+    registry = []
+    c = Counter('frames_total', 'Frames.', ['command'], registry=registry)
+    c.inc('MESSAGE')
+    c.inc('MESSAGE')
+    c.inc('ERROR')
+    assert render(registry) == (
+        '# HELP frames_total Frames.\n'
+        '# TYPE frames_total counter\n'
+        'frames_total{command="ERROR"} 1\n'
+        'frames_total{command="MESSAGE"} 2\n')
+
+
+def test_gauge_reads_function():
+    registry = []
+    Gauge('depth', 'Depth.', func=lambda: 5, registry=registry)
+    assert 'depth 5\n' in render(registry)
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = []
+    h = Histogram('latency', 'Latency.', ['stage'], buckets=(0.1, 1),
+                  registry=registry)
+    h.observe(0.05, 'fetch')
+    h.observe(0.1, 'fetch')
+    h.observe(2, 'fetch')
+    lines = render(registry).splitlines()
+    assert 'latency_bucket{stage="fetch",le="0.1"} 2' in lines
+    assert 'latency_bucket{stage="fetch",le="1"} 2' in lines
+    assert 'latency_bucket{stage="fetch",le="+Inf"} 3' in lines
+    assert 'latency_count{stage="fetch"} 3' in lines
+    assert 'latency_sum{stage="fetch"} 2.15' in lines
+
+
+def test_histogram_times_block():
+    registry = []
+    h = Histogram('latency', 'Latency.', registry=registry)
+    with h.time():
+        pass
+    assert 'latency_count 1' in render(registry)
+
+
+@pytest.mark.asyncio
+async def test_serve_renders_metrics(event_loop, unused_tcp_port):
+    registry = []
+    Counter('frames_total', 'Frames.', registry=registry).inc()
+    server = await serve('127.0.0.1', unused_tcp_port, event_loop, registry)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as session:
+            url = 'http://127.0.0.1:{}/metrics'.format(unused_tcp_port)
+            async with session.get(url, headers={'Connection': 'close'}) \
+                    as resp:
+                assert 'frames_total 1' in await resp.text()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def test_histogram_counts_observations():
+    h = Histogram('latency', 'Latency.', ['stage'], registry=[])
+    assert h.count('index') == 0
+    h.observe(0.5, 'index')
+    h.observe(100, 'index')
+    assert h.count('index') == 2
@@ -0,0 +1,59 @@
+import pytest
+import rdflib
+
+from pit.namespaces import DCTERMS, PCDM, RDF
+from pit.ntriples import Graph, Parser, parse
+from pit.pcdm import PcdmObject
+
+
+def test_parse_matches_rdflib(thesis_1_nt):
+    g = parse(thesis_1_nt)
+    expected = rdflib.Graph().parse(data=thesis_1_nt.decode('utf-8'),
+                                    format='nt')
+    assert set(g) == set(expected)
+
+
+def test_parse_keeps_only_requested_predicates(thesis_1_nt):
+    g = parse(thesis_1_nt, predicates=[RDF.type])
+    assert len(g) == 3
+    assert set(g.objects(predicate=RDF.type)) == {PCDM.Object, PCDM.File}
+
+
+def test_parser_accepts_chunks(thesis_1_nt):
+    p = Parser()
+    for i in range(0, len(thesis_1_nt), 7):
+        p.feed(thesis_1_nt[i:i+7])
+    assert set(p.close()) == set(parse(thesis_1_nt))
+
+
+def test_parse_handles_literals():
+    g = parse(b'<mock://s> <mock://p> "a \\"b\\"\\n\\u00e9"@en .\n'
+              b'<mock://s> <mock://p> "2001"^^<mock://int> .\n'
+              b'_:b1 <mock://p> _:b2 .\n')
+    objs = set(g.objects(predicate=rdflib.URIRef('mock://p')))
+    assert rdflib.Literal('a "b"\né', lang='en') in objs
+    assert rdflib.Literal('2001', datatype=rdflib.URIRef('mock://int')) in \
+        objs
+    assert rdflib.BNode('b2') in objs
+
+
+def test_parse_raises_error_on_invalid_line():
+    with pytest.raises(ValueError):
+        parse(b'<mock://s> <mock://p> .\n')
+
+
+def test_parse_raises_error_on_invalid_escape():
+    with pytest.raises(ValueError):
+        parse(b'<mock://s> <mock://p> "a\\qb" .\n')
+
+
+def test_graph_supports_pcdm_object(thesis_1_nt):
+    o = PcdmObject(parse(thesis_1_nt), None)
+    assert o.uri == rdflib.URIRef('mock://example.com/theses/1')
+    assert 'mock://example.com/theses/1/1.txt' in \
+        [str(f.uri) for f in o.files]
+
+
+def test_graph_value_returns_default():
+    assert Graph().value(subject=rdflib.URIRef('mock://s'),
+                         predicate=DCTERMS.title, default='foo') == 'foo'
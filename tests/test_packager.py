@@ -1,9 +1,16 @@
+import asyncio
+from asyncio import coroutine
+from unittest.mock import Mock
 import zipfile
 
+from aiohttp.streams import StreamReader
+
 from tests import air_mock
 import pytest
 
-from pit.packager import create_package
+import pit.packager
+from pit.archive import Zip
+from pit.packager import DocumentSet, Download, create_package
 
 
 @pytest.mark.asyncio
@@ -19,6 +26,129 @@ async def test_create_package_returns_archive(thesis_1, thesis_1_pdf, thesis_2,
         m.get('mock://example.com/theses/2/2.pdf', content=thesis_2_pdf)
         pkg = await create_package('mock://example.com/docset')
         with zipfile.ZipFile(pkg) as zf:
-            members = zf.namelist()
-        assert '1.pdf' in members
-        assert '2.pdf' in members
+            assert zf.namelist() == ['1.pdf', '2.pdf']
+            assert zf.read('1.pdf') == thesis_1_pdf
+            assert zf.read('2.pdf') == thesis_2_pdf
+
+
+class SlowClient:
+    """Serve theses, the first ones slowest, and record concurrency."""
+    def __init__(self, theses, loop):
+        self.theses = theses
+        self.loop = loop
+        self.active = 0
+        self.max_active = 0
+        self.requested = []
+
+    async def get(self, url, *args, **kwargs):
+        self.requested.append(url)
+        self.active += 1
+        self.max_active = max(self.active, self.max_active)
+        n = int(url.split('/')[-1])
+        await asyncio.sleep(0.01 * (len(self.theses) - n), loop=self.loop)
+        self.active -= 1
+        return air_mock.Request('GET', url, text=self.theses[n])
+
+
+@pytest.mark.asyncio
+async def test_document_set_keeps_member_order(event_loop, thesis_1,
+                                               thesis_2):
+    client = SlowClient([thesis_1, thesis_2] * 3, event_loop)
+    members = ['mock://example.com/theses/{}'.format(i) for i in range(6)]
+    docs = DocumentSet(members, client, concurrency=3, loop=event_loop)
+    uris = []
+    async for doc in docs:
+        uris.append(doc.files[0].uri.split('/')[-2])
+    assert uris == ['1', '2', '1', '2', '1', '2']
+    assert client.max_active == 3
+
+
+@pytest.mark.asyncio
+async def test_document_set_limits_lookahead(event_loop, thesis_1):
+    client = SlowClient([thesis_1] * 10, event_loop)
+    members = ['mock://example.com/theses/{}'.format(i) for i in range(10)]
+    docs = DocumentSet(members, client, lookahead=2, loop=event_loop)
+    await docs.__anext__()
+    assert len(client.requested) == 3
+    docs.close()
+
+
+@pytest.mark.asyncio
+async def test_document_set_without_lookahead(event_loop, thesis_1):
+    client = SlowClient([thesis_1] * 2, event_loop)
+    members = ['mock://example.com/theses/{}'.format(i) for i in range(2)]
+    docs = DocumentSet(members, client, lookahead=0, loop=event_loop)
+    await docs.__anext__()
+    assert len(client.requested) == 1
+    await docs.__anext__()
+    assert len(client.requested) == 2
+
+
+class PackageClient(SlowClient):
+    """Serve a docset of two theses whose PDFs download concurrently."""
+    limit_per_host = 10
+
+    def __init__(self, theses, pdfs, loop):
+        super().__init__(theses, loop)
+        self.pdfs = pdfs
+        self.active_pdfs = 0
+        self.max_active_pdfs = 0
+
+    async def get(self, url, *args, **kwargs):
+        if url == 'mock://example.com/docset':
+            return air_mock.Request('GET', url, json={'members': [
+                'mock://example.com/theses/0', 'mock://example.com/theses/1']})
+        if not url.endswith('.pdf'):
+            return await super().get(url)
+        self.active_pdfs += 1
+        self.max_active_pdfs = max(self.active_pdfs, self.max_active_pdfs)
+        # The first PDF is the slowest, so both are in flight together.
+        n = int(url.split('/')[-1][0])
+        await asyncio.sleep(0.05 / n, loop=self.loop)
+        self.active_pdfs -= 1
+        return air_mock.Request('GET', url, content=self.pdfs[n - 1])
+
+
+@pytest.mark.asyncio
+async def test_create_package_downloads_pdfs_concurrently(
+        event_loop, thesis_1, thesis_1_pdf, thesis_2, thesis_2_pdf):
+    client = PackageClient([thesis_1, thesis_2],
+                           [thesis_1_pdf, thesis_2_pdf], event_loop)
+    pkg = await create_package('mock://example.com/docset', client)
+    with zipfile.ZipFile(pkg) as zf:
+        assert zf.namelist() == ['1.pdf', '2.pdf']
+        assert zf.read('1.pdf') == thesis_1_pdf
+    assert client.max_active_pdfs == 2
+
+
+@pytest.mark.asyncio
+async def test_create_package_adds_downloaded_files_without_streaming(
+        event_loop, monkeypatch, thesis_1, thesis_1_pdf, thesis_2,
+        thesis_2_pdf):
+    monkeypatch.setattr(pit.packager, 'STREAMING', False)
+    monkeypatch.setattr(Zip, 'write_stream', Mock(side_effect=AssertionError))
+    client = PackageClient([thesis_1, thesis_2],
+                           [thesis_1_pdf, thesis_2_pdf], event_loop)
+    pkg = await create_package('mock://example.com/docset', client)
+    with zipfile.ZipFile(pkg) as zf:
+        assert zf.namelist() == ['1.pdf', '2.pdf']
+        assert zf.read('1.pdf') == thesis_1_pdf
+        assert zf.read('2.pdf') == thesis_2_pdf
+    assert client.max_active_pdfs == 2
+
+
+@pytest.mark.asyncio
+async def test_download_releases_unread_response_on_close(event_loop):
+    resp = Mock()
+    # A body that hasn't finished arriving.
+    resp.content = StreamReader(loop=event_loop)
+    resp.content.feed_data(b'%PDF')
+    client = Mock()
+    client.get.side_effect = coroutine(Mock(return_value=resp))
+    slots = asyncio.Semaphore(1, loop=event_loop)
+    download = Download('mock://example.com/1.pdf', client, slots,
+                        event_loop)
+    await asyncio.sleep(0.01, loop=event_loop)
+    await download.close()
+    assert resp.close.called
+    assert not slots.locked()
@@ -3,7 +3,10 @@ from tests import air_mock
 import pytest
 import rdflib
 
-from pit.pcdm import collection, PcdmObject, PcdmFile
+from pit.cache import Cache
+from pit.fedora import Client
+from pit.pcdm import (collection, CollectionMembers, PcdmObject, PcdmFile,
+                      TextReader)
 
 
 def test_collection_yields_objects(theses):
@@ -35,3 +38,133 @@ def test_file_has_mimetype(thesis_1):
                     None))
     f = PcdmFile(g, None)
     assert f.mimetype == 'application/pdf'
+
+
+@pytest.fixture
+def containment():
+    return (b'<mock://example.com/theses> '
+            b'<http://www.w3.org/ns/ldp#contains> '
+            b'<mock://example.com/theses/1> .\n'
+            b'<mock://example.com/theses> '
+            b'<http://www.w3.org/ns/ldp#contains> '
+            b'<mock://example.com/theses/2> .\n')
+
+
+@pytest.mark.asyncio
+async def test_collection_members_streams_contained_uris(containment):
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses', content=containment)
+        members = CollectionMembers('mock://example.com/theses',
+                                    aiohttp.ClientSession(), chunk_size=10)
+        items = []
+        async for uri in members:
+            items.append(uri)
+        assert items == ['mock://example.com/theses/1',
+                         'mock://example.com/theses/2']
+        assert m.request_history[0].headers['Accept'] == \
+            'application/n-triples'
+
+
+@pytest.mark.asyncio
+async def test_collection_members_follows_next_link(containment):
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses', content=containment[:96],
+              headers={'Link': '<mock://example.com/theses?page=2>; '
+                               'rel="next"'})
+        m.get('mock://example.com/theses?page=2', content=containment[96:])
+        members = CollectionMembers('mock://example.com/theses',
+                                    aiohttp.ClientSession())
+        items = []
+        async for uri in members:
+            items.append(uri)
+        assert items == ['mock://example.com/theses/1',
+                         'mock://example.com/theses/2']
+
+
+@pytest.mark.asyncio
+async def test_collection_members_streams_past_the_cache(containment, tmpdir):
+    cache = Cache(str(tmpdir))
+    with air_mock.Mock() as m:
+        m.request('GET', 'mock://example.com/theses', content=containment,
+                  headers={'ETag': '"1"',
+                           'Content-Type': 'application/n-triples'})
+        members = CollectionMembers('mock://example.com/theses',
+                                    Client(cache=cache), chunk_size=10)
+        items = []
+        async for uri in members:
+            items.append(uri)
+        assert len(items) == 2
+        assert cache.size == 0
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_collection_members_raises_on_error_status():
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/theses', status=404)
+        members = CollectionMembers('mock://example.com/theses',
+                                    aiohttp.ClientSession())
+        with pytest.raises(aiohttp.ClientResponseError):
+            async for uri in members:
+                pass
+
+
+def test_file_is_bound_to_parent_graph(thesis_1):
+    g = rdflib.Graph().parse(data=thesis_1, format='n3')
+    f = PcdmFile(g, None, rdflib.URIRef('mock://example.com/theses/1/1.txt'))
+    assert f.g is g
+    assert f.mimetype == 'text/plain'
+
+
+def test_object_indexes_files_by_mimetype(thesis_1):
+    g = rdflib.Graph().parse(data=thesis_1, format='n3')
+    o = PcdmObject(g, None)
+    assert str(o.file('application/pdf').uri) == \
+        'mock://example.com/theses/1/1.pdf'
+    assert [str(f.uri) for f in o.files_by_mimetype['text/plain']] == \
+        ['mock://example.com/theses/1/1.txt']
+    assert o.file('image/png') is None
+
+
+@pytest.mark.asyncio
+async def test_text_reader_reads_text():
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/1.txt', content='Grüße'.encode('utf-8'))
+        resp = await aiohttp.ClientSession().get('mock://example.com/1.txt')
+        assert await TextReader(chunk_size=3).read(resp) == 'Grüße'
+
+
+@pytest.mark.asyncio
+async def test_text_reader_uses_charset():
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/1.txt', content='Grüße'.encode('latin-1'),
+              headers={'Content-Type': 'text/plain; charset=ISO-8859-1'})
+        resp = await aiohttp.ClientSession().get('mock://example.com/1.txt')
+        assert await TextReader().read(resp) == 'Grüße'
+
+
+@pytest.mark.asyncio
+async def test_text_reader_truncates_text():
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/1.txt', content='aaaüb'.encode('utf-8'))
+        resp = await aiohttp.ClientSession().get('mock://example.com/1.txt')
+        reader = TextReader(max_bytes=4, chunk_size=2)
+        assert await reader.read(resp) == 'aaa'
+
+
+@pytest.mark.asyncio
+async def test_text_reader_drops_oversized_text():
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/1.txt', content=b'aaaa')
+        resp = await aiohttp.ClientSession().get('mock://example.com/1.txt')
+        reader = TextReader(max_bytes=2, overflow='drop')
+        assert await reader.read(resp) is None
+
+
+@pytest.mark.asyncio
+async def test_text_reader_normalizes_whitespace():
+    with air_mock.Mock() as m:
+        m.get('mock://example.com/1.txt', content=b' foo  \n\n bar\t \tbaz ')
+        resp = await aiohttp.ClientSession().get('mock://example.com/1.txt')
+        reader = TextReader(normalize=True, chunk_size=3)
+        assert await reader.read(resp) == 'foo bar baz'
@@ -0,0 +1,40 @@
+import asyncio
+import pstats
+
+import pytest
+
+from pit import metrics
+from pit.profiling import Profiler
+
+
+@pytest.mark.asyncio
+async def test_profiler_writes_stats_after_time_window(event_loop, tmpdir):
+    path = str(tmpdir.join('pit.prof'))
+    profiler = Profiler(path, event_loop, seconds=0.05)
+    profiler.start()
+    assert event_loop.get_debug()
+    await asyncio.sleep(0.1, loop=event_loop)
+    assert not profiler.running
+    assert not event_loop.get_debug()
+    assert pstats.Stats(path).total_calls > 0
+
+
+@pytest.mark.asyncio
+async def test_profiler_stops_after_documents(event_loop, tmpdir):
+    path = str(tmpdir.join('pit.prof'))
+    profiler = Profiler(path, event_loop, documents=2)
+    profiler.start()
+    metrics.STAGE_SECONDS.observe(0.1, 'index')
+    metrics.STAGE_SECONDS.observe(0.1, 'index')
+    profiler._check()
+    assert not profiler.running
+    assert tmpdir.join('pit.prof').check()
+
+
+def test_profiler_summary_lists_functions(event_loop, tmpdir):
+    profiler = Profiler(str(tmpdir.join('pit.prof')), event_loop, top=5)
+    profiler.start()
+    sorted(range(1000))
+    profiler.stop()
+    assert 'cumulative' in profiler.summary()
+    profiler.stop()
@@ -0,0 +1,44 @@
+import rdflib
+
+from pit.es import thesis_map
+from pit.namespaces import DCTERMS
+from pit.schema import Field, Schema, integer, thesis
+
+
+URI = rdflib.URIRef('mock://example.com/theses/1')
+
+
+def test_extract_builds_document(thesis_1):
+    g = rdflib.Graph().parse(data=thesis_1, format='n3')
+    doc = thesis.extract(g, URI)
+    assert doc['uri'] == 'mock://example.com/theses/1'
+    assert sorted(doc['title']) == ['Title 1', 'Title 2']
+    assert doc['handle'] == ['http://handle.org/1']
+    assert doc['copyright_date'] == [2001]
+    assert doc['published_date'] == [2002]
+
+
+def test_extract_drops_invalid_values():
+    g = rdflib.Graph()
+    g.add((URI, DCTERMS.issued, rdflib.Literal('Spring 2002')))
+    assert thesis.extract(g, URI)['published_date'] == []
+
+
+def test_extract_keeps_first_value_of_single_field():
+    g = rdflib.Graph()
+    g.add((URI, DCTERMS.title, rdflib.Literal('Title 1')))
+    s = Schema('thesis', [Field('title', DCTERMS.title, {}, many=False)])
+    assert s.extract(g, URI)['title'] == 'Title 1'
+
+
+def test_mapping_covers_extracted_fields(thesis_1):
+    g = rdflib.Graph().parse(data=thesis_1, format='n3')
+    doc = thesis.extract(g, URI)
+    doc['full_text'] = None
+    props = thesis_map['mappings']['thesis']['properties']
+    assert set(doc) == set(props)
+    assert props['copyright_date'] == {'type': 'integer'}
+
+
+def test_integer_coerces_literal():
+    assert integer(rdflib.Literal('2001')) == 2001
@@ -0,0 +1,46 @@
+from pit.spool import Spool
+
+
+def test_add_deduplicates_uris(tmpdir):
+    spool = Spool(str(tmpdir.join('spool.db')))
+    spool.add('mock://example.com/theses/1')
+    spool.add('mock://example.com/theses/1')
+    assert len(spool) == 1
+
+
+def test_take_returns_oldest_first(tmpdir):
+    spool = Spool(str(tmpdir.join('spool.db')))
+    spool.add('mock://example.com/theses/1')
+    spool.add('mock://example.com/theses/2')
+    assert spool.take(1) == ['mock://example.com/theses/1']
+
+
+def test_failed_moves_uri_to_back(tmpdir):
+    spool = Spool(str(tmpdir.join('spool.db')))
+    spool.add('mock://example.com/theses/1')
+    spool.add('mock://example.com/theses/2')
+    assert spool.failed('mock://example.com/theses/1') == 1
+    assert spool.take(2) == ['mock://example.com/theses/2',
+                             'mock://example.com/theses/1']
+
+
+def test_failed_can_leave_attempts_uncounted(tmpdir):
+    spool = Spool(str(tmpdir.join('spool.db')))
+    spool.add('mock://example.com/theses/1')
+    assert spool.failed('mock://example.com/theses/1', count=False) == 0
+    assert spool.failed('mock://example.com/theses/1') == 1
+
+
+def test_spool_persists(tmpdir):
+    path = str(tmpdir.join('spool.db'))
+    spool = Spool(path)
+    spool.add('mock://example.com/theses/1')
+    spool.close()
+    assert Spool(path).take(10) == ['mock://example.com/theses/1']
+
+
+def test_remove_removes_uri(tmpdir):
+    spool = Spool(str(tmpdir.join('spool.db')))
+    spool.add('mock://example.com/theses/1')
+    spool.remove('mock://example.com/theses/1')
+    assert len(spool) == 0
@@ -1,10 +1,13 @@
+import asyncio
 from asyncio import coroutine
 from unittest.mock import Mock
 
 import pytest
 from stompest.protocol import StompFrame
+from stompest.protocol.frame import StompHeartBeat
 
-from pit.stomp import AsyncTransport, Protocol, BrokenSocketError
+from pit.stomp import (AsyncTransport, BrokenSocketError, FrameParser,
+                       Protocol, StompFrameError)
 
 
 @pytest.fixture
@@ -47,6 +50,26 @@ class TestAsyncTransport:
         with pytest.raises(BrokenSocketError):
             await transport._read_frames()
 
+    @pytest.mark.asyncio
+    async def test_read_frames_grows_read_size(self, transport):
+        transport.read_size = 4
+        data = [b'MESS', b'AGE\n\nFOO', b'\x00']
+        transport._reader.read.side_effect = coroutine(Mock(side_effect=data))
+        await transport._read_frames()
+        assert transport._frames.popleft().body == b'FOO'
+        assert transport.read_size == 16
+
+    @pytest.mark.asyncio
+    async def test_send_batches_frames(self, transport, event_loop):
+        await asyncio.gather(
+            transport.send(StompFrame('ACK', headers={'id': '1'})),
+            transport.send(StompFrame('ACK', headers={'id': '2'})),
+            loop=event_loop)
+        assert transport._writer.write.call_count == 1
+        data = transport._writer.write.call_args[0][0]
+        assert b'ACK\nid:1\n\n\x00' in data
+        assert b'ACK\nid:2\n\n\x00' in data
+
     def test_disconnect_closes_writer(self, transport):
         transport.disconnect()
         assert transport._writer.close.called
@@ -93,6 +116,64 @@ class TestProtocol:
         assert frame.startswith(b'SUBSCRIBE\n')
         assert b'destination:/queue/foo' in frame
 
+    @pytest.mark.asyncio
+    async def test_subscribe_sets_ack_mode_and_prefetch(self, transport):
+        p = Protocol('localhost', 61613, None)
+        p._transport = transport
+        p.session._state = p.session.CONNECTED
+        await p.subscribe('/queue/foo', ack='client-individual', prefetch=5)
+        frame = transport._writer.write.call_args[0][0]
+        assert b'ack:client-individual' in frame
+        assert b'activemq.prefetchSize:5' in frame
+
+    @pytest.mark.asyncio
+    async def test_ack_sends_ack_frame(self, transport):
+        p = Protocol('localhost', 61613, None)
+        p._transport = transport
+        p.session._state = p.session.CONNECTED
+        msg = StompFrame('MESSAGE', version='1.2', headers={
+            'ack': '42', 'message-id': '1', 'subscription': '1'})
+        await p.ack(msg)
+        frame = transport._writer.write.call_args[0][0]
+        assert frame == b'ACK\nid:42\n\n\x00'
+
+    @pytest.mark.asyncio
+    async def test_nack_sends_nack_frame(self, transport):
+        p = Protocol('localhost', 61613, None)
+        p._transport = transport
+        p.session._state = p.session.CONNECTED
+        msg = StompFrame('MESSAGE', version='1.2', headers={
+            'ack': '42', 'message-id': '1', 'subscription': '1'})
+        await p.nack(msg)
+        frame = transport._writer.write.call_args[0][0]
+        assert frame.startswith(b'NACK\nid:42')
+
+    @pytest.mark.asyncio
+    async def test_reconnect_renews_subscriptions(self, transport):
+        p = Protocol('localhost', 61613, None)
+        transport._reader.read.side_effect = \
+            coroutine(Mock(return_value=b'CONNECTED\nversion:1.2\n\n\x00'))
+        p._transport = transport
+        p.session._state = p.session.CONNECTED
+        await p.subscribe('/queue/foo', 'FOOBAR', ack='client-individual')
+        await p.reconnect()
+        frame = transport._writer.write.call_args[0][0]
+        assert frame.startswith(b'SUBSCRIBE\n')
+        assert b'ack:client-individual' in frame
+        assert p.connections == 1
+        assert p.subscription(('id', '1')) == 'FOOBAR'
+
+    @pytest.mark.asyncio
+    async def test_connect_offers_client_heartbeats(self, transport):
+        p = Protocol('localhost', 61613, None, heartbeats=(1000, 2000))
+        transport._reader.read.side_effect = coroutine(Mock(
+            return_value=b'CONNECTED\nversion:1.2\nheart-beat:0,500\n\n\x00'))
+        p._transport = transport
+        await p.connect()
+        frame = transport._writer.write.call_args_list[0][0][0]
+        assert b'heart-beat:1000,2000' in frame
+        assert p.heartbeat_interval == 1
+
     def test_subscription_returns_sub_context(self, transport):
         p = Protocol('localhost', 61613, None)
         p.session._state = p.session.CONNECTED
@@ -110,3 +191,48 @@ class TestProtocol:
                                   'subscription': '1',
                                   'message-id': '1'})) == \
             ('id', '1')
+
+
+class TestFrameParser:
+    def parse(self, *chunks):
+        parser = FrameParser()
+        frames = []
+        for chunk in chunks:
+            parser.add(chunk)
+            while parser.canRead():
+                frames.append(parser.get())
+        return frames
+
+    def test_parses_frames_split_across_chunks(self):
+        frames = self.parse(b'MESSAGE\nmessage-id:1\n', b'\nFOO',
+                            b'BAR\x00MESSAGE\n\nBAZ\x00')
+        assert frames[0].command == 'MESSAGE'
+        assert frames[0].headers == {'message-id': '1'}
+        assert frames[0].body == b'FOOBAR'
+        assert frames[1].body == b'BAZ'
+
+    def test_uses_content_length(self):
+        frames = self.parse(b'MESSAGE\ncontent-length:3\n\nA\x00', b'B\x00')
+        assert frames[0].body == b'A\x00B'
+
+    def test_parses_heartbeats(self):
+        frames = self.parse(b'\n\r', b'\nMESSAGE\n\n\x00')
+        assert frames[:2] == [StompHeartBeat(), StompHeartBeat()]
+        assert frames[2].command == 'MESSAGE'
+
+    def test_unescapes_headers(self):
+        frames = self.parse(b'MESSAGE\nfoo:a\\cb\\nc\nfoo:d\n\n\x00')
+        assert frames[0].headers == {'foo': 'a:b\nc'}
+
+    def test_does_not_unescape_connected_headers(self):
+        frames = self.parse(b'CONNECTED\nfoo:a\\cb\n\n\x00')
+        assert frames[0].headers == {'foo': 'a\\cb'}
+
+    def test_accepts_crlf(self):
+        frames = self.parse(b'MESSAGE\r\nfoo:bar\r\n\r\nBODY\x00')
+        assert frames[0].headers == {'foo': 'bar'}
+        assert frames[0].body == b'BODY'
+
+    def test_raises_error_for_missing_null(self):
+        with pytest.raises(StompFrameError):
+            self.parse(b'MESSAGE\ncontent-length:1\n\nAB')
@@ -0,0 +1,123 @@
+import asyncio
+from asyncio import coroutine
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from pit.stomp import BrokenSocketError
+from pit.worker import backoff, handle, listen, work
+
+
+def client_with_frames(frames, callback):
+    async def receive_frame():
+        if frames:
+            return frames.pop(0)
+        await asyncio.sleep(10)
+
+    client = Mock(connections=1)
+    client.receive_frame.side_effect = receive_frame
+    client.message.return_value = 'token'
+    client.subscription.return_value = callback
+    client.ack.side_effect = coroutine(Mock())
+    client.nack.side_effect = coroutine(Mock())
+    return client
+
+
+@pytest.mark.asyncio
+async def test_handle_acks_after_callback():
+    frame = Mock(headers={'ack': '1', 'message-id': '1'})
+    client = client_with_frames([], None)
+    callback = coroutine(Mock(
+        side_effect=lambda f: client.ack.assert_not_called()))
+    await handle(client, callback, frame)
+    client.ack.assert_called_once_with(frame)
+    assert not client.nack.called
+
+
+@pytest.mark.asyncio
+async def test_handle_nacks_if_callback_fails():
+    frame = Mock(headers={'ack': '1', 'message-id': '1'})
+    client = client_with_frames([], None)
+    callback = coroutine(Mock(side_effect=Exception('boom')))
+    await handle(client, callback, frame)
+    client.nack.assert_called_once_with(frame)
+    assert not client.ack.called
+
+
+@pytest.mark.asyncio
+async def test_handle_does_not_ack_auto_messages():
+    frame = Mock(headers={'message-id': '1'})
+    client = client_with_frames([], None)
+    await handle(client, coroutine(Mock()), frame)
+    assert not client.ack.called
+
+
+@pytest.mark.asyncio
+async def test_listen_limits_messages_in_flight(event_loop):
+    running = []
+    release = asyncio.Event(loop=event_loop)
+
+    async def callback(frame):
+        running.append(frame)
+        await release.wait()
+
+    frames = [Mock(command='MESSAGE', headers={'ack': str(i)})
+              for i in range(5)]
+    client = client_with_frames(frames, callback)
+    task = asyncio.ensure_future(listen(client, 2, event_loop),
+                                 loop=event_loop)
+    await asyncio.sleep(0.01, loop=event_loop)
+    assert len(running) == 2
+    assert client.receive_frame.call_count == 3
+    release.set()
+    await asyncio.sleep(0.01, loop=event_loop)
+    assert len(running) == 5
+    assert client.ack.call_count == 5
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_handle_does_not_ack_after_reconnect():
+    frame = Mock(headers={'ack': '1', 'message-id': '1'})
+    client = client_with_frames([], None)
+
+    async def callback(frame):
+        client.connections += 1
+
+    await handle(client, callback, frame)
+    assert not client.ack.called
+
+
+def test_backoff_grows_with_attempts_up_to_cap():
+    assert all(0 <= backoff(0) <= 0.5 for _ in range(100))
+    assert all(0 <= backoff(3) <= 4 for _ in range(100))
+    assert all(0 <= backoff(20) <= 30 for _ in range(100))
+
+
+@pytest.mark.asyncio
+async def test_work_reconnects_when_socket_breaks(event_loop, monkeypatch):
+    monkeypatch.setattr('pit.worker.backoff', lambda attempt: 0)
+    reconnected = asyncio.Event(loop=event_loop)
+    frames = [BrokenSocketError()]
+
+    async def receive_frame():
+        if frames:
+            raise frames.pop()
+        await asyncio.sleep(10, loop=event_loop)
+
+    async def reconnect():
+        reconnected.set()
+
+    client = Mock(heartbeat_interval=0, lastReceived=time.time())
+    client.subscribe.side_effect = coroutine(Mock())
+    client.receive_frame.side_effect = receive_frame
+    client.reconnect.side_effect = reconnect
+    client.disconnect.side_effect = coroutine(Mock())
+    task = asyncio.ensure_future(work(client, None, event_loop),
+                                 loop=event_loop)
+    await asyncio.wait_for(reconnected.wait(), 1, loop=event_loop)
+    assert client.subscribe.call_count == 1
+    task.cancel()
+    await task
+    assert client.disconnect.called